@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+        Values kept for ttl seconds after they are set, at most max_size of them, the least recently used are evicted first.
+        Only used from the event loop, so there is no locking.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 10000) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[Any, Tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def keys(self) -> List[Any]:
+        return list(self._entries.keys())
+
+    def pop(self, key: Any) -> None:
+        self._entries.pop(key, None)
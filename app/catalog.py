@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import asyncio
+import fcntl
+import json
+import time
+from pathlib import Path
+
+from imgserve.logger import simple_logger
+from imgserve.utils import atomic_write_bytes
+
+
+class ExperimentCatalog:
+    """
+        In-memory copy of the experiments listing (see vectors.get_experiments), built at startup and refreshed in the background every refresh_interval seconds.
+        Readers are always served the last complete listing without waiting (stale while revalidate), a failed refresh keeps serving it.
+        Only the very first read waits, if the listing could not be built at startup.
+        With a cache_path, server workers share the listing through that file: whichever worker refreshes first fetches and writes it,
+        the others read it until it is refresh_interval seconds old, so elasticsearch is asked once per interval however many workers there are.
+        Workers that find another one mid-fetch keep serving the previous file rather than waiting for it.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Dict[str, Any]],
+        refresh_interval: float = 300,
+        cache_path: Optional[Path] = None,
+        on_refresh: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> None:
+        self.fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.cache_path = cache_path
+        # called with the new listing after every successful refresh, e.g. to drop what was derived from the old one
+        self.on_refresh = on_refresh
+        self.experiments: Dict[str, Any] = dict()
+        self.refreshed_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refresh_loop_task: Optional[asyncio.Task] = None
+        self.log = simple_logger("api.catalog")
+
+    @property
+    def age(self) -> Optional[float]:
+        """ seconds since the listing was last refreshed """
+        if self.refreshed_at is None:
+            return None
+        return time.monotonic() - self.refreshed_at
+
+    def _read_shared(self, max_age: float) -> Optional[Dict[str, Any]]:
+        """ the listing at cache_path, if it was written less than max_age seconds ago """
+        try:
+            if time.time() - self.cache_path.stat().st_mtime < max_age:
+                # written atomically, so it is always complete without taking the lock
+                return json.loads(self.cache_path.read_text())
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _load(self, force: bool) -> Dict[str, Any]:
+        """ the listing from cache_path if another worker refreshed it recently (unless force), fetched otherwise """
+        if self.cache_path is None:
+            return self.fetch()
+        self.cache_path.parent.mkdir(exist_ok=True, parents=True)
+        if not force:
+            experiments = self._read_shared(max_age=self.refresh_interval)
+            if experiments is not None:
+                return experiments
+        # held only by the worker fetching from elasticsearch, not by readers of the shared file
+        with self.cache_path.with_suffix(".lock").open("a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if force else fcntl.LOCK_NB))
+            except BlockingIOError:
+                # another worker is refreshing, serve the listing it is replacing rather than wait for elasticsearch
+                experiments = self._read_shared(max_age=float("inf"))
+                if experiments is not None:
+                    return experiments
+                # nothing to serve yet, wait for the first listing
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not force:
+                    # the worker we waited for may have just written it
+                    experiments = self._read_shared(max_age=self.refresh_interval)
+                    if experiments is not None:
+                        return experiments
+                experiments = self.fetch()
+                atomic_write_bytes(self.cache_path, json.dumps(experiments).encode("utf-8"))
+                return experiments
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def _refresh(self, force: bool = False) -> None:
+        start = time.monotonic()
+        try:
+            # the elasticsearch client blocks, keep it off the event loop
+            experiments = await asyncio.get_event_loop().run_in_executor(None, self._load, force)
+        except Exception as exc:
+            stale = "no listing yet" if self.age is None else f"still serving the listing from {self.age:.0f} seconds ago"
+            self.log.error(f"could not refresh experiments, {stale}: {exc}")
+            return
+        self.experiments = experiments
+        if self.on_refresh is not None:
+            self.on_refresh(experiments)
+        self.refreshed_at = time.monotonic()
+        self.log.info(f"refreshed {len(experiments)} experiments in {self.refreshed_at - start:.2f} seconds")
+
+    async def refresh(self, force: bool = False) -> Dict[str, Any]:
+        """ refresh now and return the listing, concurrent callers share a single refresh. force fetches even if the shared listing is recent """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh(force=force))
+        # a cancelled caller must not cancel the refresh other callers are waiting on
+        await asyncio.shield(self._refresh_task)
+        return self.experiments
+
+    def request_refresh(self) -> None:
+        """ start a refresh in the background, unless one is already running """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+
+    async def get(self) -> Dict[str, Any]:
+        if self.refreshed_at is None:
+            return await self.refresh()
+        if self.age > 2 * self.refresh_interval:
+            # the refresh loop is behind (or failing), revalidate in the background and serve what we have
+            self.request_refresh()
+        return self.experiments
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._refresh_loop_task = asyncio.ensure_future(self._refresh_periodically())
+
+    async def stop(self) -> None:
+        for task in [self._refresh_loop_task, self._refresh_task]:
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import rapidjson
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzipped when it is not installed
+    brotli = None
+
+# responses smaller than this are not worth the CPU to compress
+GZIP_MINIMUM_SIZE = 1024
+# brotli's text quality/CPU sweet spot, 11 is far slower for a few percent
+BROTLI_QUALITY = 5
+# PNGs, JPEGs and WebPs are already compressed, and colorgram range requests must not be re-encoded
+UNCOMPRESSED_PATH_PREFIXES = ("/colorgrams/", "/thumbnails/", "/static/img/")
+
+
+def dumps(content: Any) -> str:
+    return rapidjson.dumps(content, ensure_ascii=False)
+
+
+class RapidJSONResponse(JSONResponse):
+    """ JSONResponse encoded with rapidjson, much faster for colorgram documents and their long distribution arrays """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content).encode("utf-8")
+
+
+async def send_json(websocket: WebSocket, data: Any) -> None:
+    """ WebSocket.send_json, encoded with rapidjson """
+    await websocket.send_text(dumps(data))
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """ whether an Accept-Encoding header lists encoding, without q=0 """
+    for part in accept_encoding.lower().split(","):
+        token, _, params = part.partition(";")
+        if token.strip() == encoding:
+            quality = params.replace(" ", "")
+            try:
+                return not quality.startswith("q=") or float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+class BrotliResponder:
+    """ compresses the response of app with brotli once it reaches minimum_size, the brotli counterpart of starlette's GZipResponder """
+
+    def __init__(self, app: ASGIApp, minimum_size: int) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.send: Optional[Send] = None
+        self.initial_message: Dict[str, Any] = dict()
+        self.started = False
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_with_brotli)
+
+    async def send_with_brotli(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # held back until the first body message decides whether to compress
+            self.initial_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.started:
+            if self.compressor is not None:
+                body = self.compressor.process(body) + (
+                    self.compressor.flush() if more_body else self.compressor.finish()
+                )
+            await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+            return
+
+        self.started = True
+        headers = MutableHeaders(raw=self.initial_message["headers"])
+        if (len(body) < self.minimum_size and not more_body) or "content-encoding" in headers:
+            self.compressor = None
+            await self.send(self.initial_message)
+            await self.send(message)
+            return
+        headers["Content-Encoding"] = "br"
+        vary = headers.get("vary")
+        headers["Vary"] = "Accept-Encoding" if vary is None else f"{vary}, Accept-Encoding"
+        if more_body:
+            body = self.compressor.process(body) + self.compressor.flush()
+            del headers["Content-Length"]
+        else:
+            body = self.compressor.process(body) + self.compressor.finish()
+            headers["Content-Length"] = str(len(body))
+        await self.send(self.initial_message)
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+
+class SelectiveCompressionMiddleware(GZipMiddleware):
+    """
+        GZipMiddleware, except for responses under UNCOMPRESSED_PATH_PREFIXES,
+        and brotli (smaller JSON at similar CPU) for clients that accept it when the brotli package is installed
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith(UNCOMPRESSED_PATH_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        if (
+            scope["type"] == "http"
+            and brotli is not None
+            and accepts_encoding(Headers(scope=scope).get("accept-encoding", ""), "br")
+        ):
+            await BrotliResponder(self.app, self.minimum_size)(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    """ uvicorn's websockets protocol, offering permessage-deflate to clients that ask for it """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.available_extensions = [ServerPerMessageDeflateFactory()]
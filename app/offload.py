@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from imgserve.errors import DependencyTimeoutError
+from imgserve.logger import simple_logger
+
+log = simple_logger("api.offload")
+
+
+class Dependency:
+    """
+        A blocking dependency of the server (elasticsearch, S3, the local disk) that handlers reach through run.
+        At most concurrency calls to it run at once, each in the shared thread pool, and a caller waits at most timeout seconds for its result,
+        so a slow dependency only holds up the requests that need it.
+    """
+
+    def __init__(self, name: str, concurrency: int, timeout: float) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created on first use, inside the server's event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """ fn(*args, **kwargs) in the thread pool, raises DependencyTimeoutError if waiting for a slot and the call take longer than timeout """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError as exc:
+            log.error(f"{self.name} stayed at {self.concurrency} concurrent calls for {self.timeout} seconds")
+            raise DependencyTimeoutError(f"{self.name} is busy") from exc
+        future = loop.run_in_executor(EXECUTOR, functools.partial(fn, *args, **kwargs))
+        # a timed out call keeps its thread (and its slot) until it actually returns, threads can not be interrupted
+        future.add_done_callback(lambda _: self.semaphore.release())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(0, deadline - loop.time()))
+        except asyncio.TimeoutError as exc:
+            log.error(f"{self.name} call {getattr(fn, '__name__', fn)} timed out after {self.timeout} seconds")
+            raise DependencyTimeoutError(
+                f"{self.name} did not respond within {self.timeout} seconds"
+            ) from exc
+
+    async def iterate(self, iterator: Iterator[Any]) -> AsyncGenerator[Any, None]:
+        """ advance a blocking iterator one item per run """
+        exhausted = object()
+        while True:
+            item = await self.run(next, iterator, exhausted)
+            if item is exhausted:
+                return
+            yield item
+
+
+ELASTICSEARCH = Dependency("elasticsearch", concurrency=8, timeout=30)
+S3 = Dependency("s3", concurrency=16, timeout=60)
+DISK = Dependency("disk", concurrency=8, timeout=10)
+# resizing is CPU bound, PIL releases the GIL while it decodes, resamples and encodes
+IMAGES = Dependency("images", concurrency=os.cpu_count() or 1, timeout=30)
+DEPENDENCIES = [ELASTICSEARCH, S3, DISK, IMAGES]
+
+# one thread per concurrent call any dependency allows, so a dependency at its limit never starves the others of threads
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=sum(dependency.concurrency for dependency in DEPENDENCIES),
+    thread_name_prefix="offload",
+)
+
+
+def configure(concurrency: Dict[str, int], timeout: Optional[float] = None) -> None:
+    """ set the concurrency of each dependency by name, and optionally one timeout for all of them, before the server starts """
+    global EXECUTOR
+    for dependency in DEPENDENCIES:
+        dependency.concurrency = concurrency.get(dependency.name, dependency.concurrency)
+        if timeout is not None:
+            dependency.timeout = timeout
+    EXECUTOR.shutdown(wait=False)
+    EXECUTOR = ThreadPoolExecutor(
+        max_workers=sum(dependency.concurrency for dependency in DEPENDENCIES),
+        thread_name_prefix="offload",
+    )
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+
+class RangeNotSatisfiableError(Exception):
+    pass
+
+
+def is_byte_position(value: str) -> bool:
+    return value != "" and all(c in "0123456789" for c in value)
+
+
+def byte_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+        (first, last) byte of a single "bytes=" range of a body of size bytes.
+        None if the header should be ignored (another unit, several ranges or malformed), the full body is sent then.
+        Raises RangeNotSatisfiableError if it is a well-formed range that starts past the end of the body.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if dash == "":
+        return None
+    if first == "":
+        # suffix range, the final <last> bytes
+        if not is_byte_position(last):
+            return None
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiableError(f"{range_header} of {size} bytes")
+        return max(0, size - int(last)), size - 1
+    if not is_byte_position(first) or not (last == "" or is_byte_position(last)):
+        return None
+    if last != "" and int(last) < int(first):
+        # a last byte before the first makes the range invalid, not unsatisfiable
+        return None
+    if int(first) >= size:
+        raise RangeNotSatisfiableError(f"{range_header} of {size} bytes")
+    return int(first), size - 1 if last == "" else min(int(last), size - 1)
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import argparse
+import asyncio
 import base64
 import copy
 import csv
+import functools
+import hashlib
 import os
 import json
 import logging
+import shlex
+import struct
+import sys
 from collections import defaultdict
+from dataclasses import dataclass
 from pathlib import Path
 
 import uvicorn
@@ -23,26 +30,49 @@ from starlette.authentication import (
 from starlette.requests import Request
 from starlette.responses import (
     HTMLResponse,
-    JSONResponse,
+    Response,
     StreamingResponse,
     RedirectResponse,
+    FileResponse,
 )
 from starlette.routing import Route, Mount, WebSocketRoute
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
-from starlette.websockets import WebSocket
+from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.cors import CORSMiddleware
 
-from imgserve import get_experiment_csv_path, STATIC, LOCAL_DATA_STORE
-from imgserve.api import Experiment
+from imgserve import experiment_csv_path, link_experiment_csvs, STATIC, LOCAL_DATA_STORE
+from imgserve.api import ColorgramDocument, Experiment, RawImageDocument, search_colorgrams, sync_s3_path
 from imgserve.args import get_elasticsearch_args, get_s3_args
 from imgserve.clients import get_clients
 from imgserve.elasticsearch import get_response_value
+from imgserve.errors import DependencyTimeoutError, MissingArgumentsError, NoImagesInElasticsearchError
 from imgserve.logger import simple_logger
 
+from catalog import ExperimentCatalog
+from encoding import (
+    GZIP_MINIMUM_SIZE,
+    DeflateWebSocketProtocol,
+    RapidJSONResponse,
+    SelectiveCompressionMiddleware,
+    dumps,
+    send_json,
+)
+import offload
+from cache import TTLCache
+from offload import DISK, ELASTICSEARCH, IMAGES, S3
+from ranges import RangeNotSatisfiableError, byte_range
+from variants import (
+    VARIANT_FORMATS,
+    make_variant,
+    variant_format,
+    variant_key,
+    variant_path,
+    variant_width,
+)
 from vectors import get_experiments
 
 log = simple_logger("api")
@@ -73,30 +103,24 @@ class BasicAuthBackend(AuthenticationBackend):
 
 
 def on_auth_error(request: Request, exc: Exception):
-    return JSONResponse({"error": str(exc)}, status_code=401)
+    return RapidJSONResponse({"error": str(exc)}, status_code=401)
 
 
-middleware = [
-    Middleware(
-        CORSMiddleware,
-        allow_origins=[
-            "comp-syn.ialcloud.xyz:443",
-            "comp-syn.com:443",
-            "localhost:8080",
-        ],
-        allow_headers=["*"],
-        allow_methods=["*"],
-    ),
-    Middleware(
-        AuthenticationMiddleware, backend=BasicAuthBackend(), on_error=on_auth_error
-    ),
-]
+templates = Jinja2Templates(directory="templates")
 
-app = Starlette(middleware=middleware)
-app.mount("/static", StaticFiles(directory=STATIC), name="static")
 
-templates = Jinja2Templates(directory="templates")
+# clients and settings of this worker process, see start_worker
+ELASTICSEARCH_CLIENT: Optional[Elasticsearch] = None
+S3_CLIENT: Optional[botocore.client.s3] = None
+S3_BUCKET: Optional[str] = None
+S3_URL_PREFIX: Optional[str] = None
+DEBUG = False
+
+# (catalog entry, experiment) by name, the experiment keeps its colorgram index loaded, see similar
+SIMILARITY_EXPERIMENTS = TTLCache(ttl=3600, max_size=8)
 
+# page loads and websocket handshakes read experiments from memory, see start_worker
+EXPERIMENT_CATALOG: Optional[ExperimentCatalog] = None
 
 USERS = {
     "compsyn": os.getenv("IMGSERVE_USER_COMPSYN_PASSWORD"),
@@ -112,7 +136,7 @@ def get_raw_data_link(experiment: str) -> Optional[str]:
         return None
 
 
-async def open_experiment_csv(csv_path: Path) -> Dict[str, Dict[str, Any]]:
+def read_experiment_csv(csv_path: Path) -> Dict[str, Dict[str, Any]]:
     region_column = "region"
     query_terms_column = "search_term"
     # marshal around query terms
@@ -130,6 +154,84 @@ async def open_experiment_csv(csv_path: Path) -> Dict[str, Dict[str, Any]]:
     return unique_queries
 
 
+@dataclass
+class ExperimentConfig:
+    mtime_ns: int
+    size: int
+    body: bytes  # the parsed CSV, JSON encoded
+    etag: str
+
+
+# parsed experiment CSVs by path, re-parsed only when the file changes
+EXPERIMENT_CONFIGS: Dict[Path, ExperimentConfig] = dict()
+
+
+def load_experiment_config(csv_path: Path) -> ExperimentConfig:
+    stat = csv_path.stat()
+    config = EXPERIMENT_CONFIGS.get(csv_path)
+    if config is None or (config.mtime_ns, config.size) != (stat.st_mtime_ns, stat.st_size):
+        body = dumps(read_experiment_csv(csv_path)).encode("utf-8")
+        config = ExperimentConfig(
+            mtime_ns=stat.st_mtime_ns,
+            size=stat.st_size,
+            body=body,
+            etag=f'"{hashlib.sha256(body).hexdigest()}"',
+        )
+        EXPERIMENT_CONFIGS[csv_path] = config
+    return config
+
+
+async def start_worker(args: argparse.Namespace) -> None:
+    """ runs in every worker process as it starts, so each has its own clients, thread pool and caches """
+    global ELASTICSEARCH_CLIENT
+    global S3_CLIENT
+    global S3_BUCKET
+    global S3_URL_PREFIX
+    global DEBUG
+    global VARIANT_CACHE_PATH
+    global IMAGE_URLS
+    global EXPERIMENT_CATALOG
+    offload.configure(
+        concurrency={
+            ELASTICSEARCH.name: args.elasticsearch_concurrency,
+            S3.name: args.s3_concurrency,
+            DISK.name: args.disk_concurrency,
+            IMAGES.name: args.image_concurrency,
+        },
+        timeout=args.dependency_timeout,
+    )
+    # anything still run in the default executor shares the bounded pool
+    asyncio.get_event_loop().set_default_executor(offload.EXECUTOR)
+
+    ELASTICSEARCH_CLIENT, S3_CLIENT = get_clients(args)
+    S3_BUCKET = args.s3_bucket
+    S3_URL_PREFIX = f"https://{S3_BUCKET}.s3.{S3_CLIENT.meta.region_name}.amazonaws.com"
+    DEBUG = args.debug
+    VARIANT_CACHE_PATH = args.variant_cache_path
+
+    # once, rather than on every /experiments request
+    link_experiment_csvs(local_data_store=LOCAL_DATA_STORE)
+    IMAGE_URLS = TTLCache(ttl=args.image_cache_ttl)
+    EXPERIMENT_CATALOG = ExperimentCatalog(
+        fetch=functools.partial(get_experiments, ELASTICSEARCH_CLIENT, debug=DEBUG),
+        refresh_interval=args.catalog_refresh_interval,
+        cache_path=args.catalog_cache_path,
+        on_refresh=drop_stale_similarity_experiments,
+    )
+    await EXPERIMENT_CATALOG.start()
+    log.info(f"worker {os.getpid()} started")
+
+
+async def stop_worker() -> None:
+    await EXPERIMENT_CATALOG.stop()
+    ELASTICSEARCH_CLIENT.transport.close()
+    offload.EXECUTOR.shutdown(wait=False)
+
+
+async def dependency_timeout(request: Request, exc: DependencyTimeoutError) -> RapidJSONResponse:
+    return RapidJSONResponse({"error": str(exc)}, status_code=504)
+
+
 async def respond_with_404(request: Request, message: str):
     response = templates.TemplateResponse(
         "404.html", {"request": request, "message": message,},
@@ -137,24 +239,24 @@ async def respond_with_404(request: Request, message: str):
     return response
 
 
-@app.route("/")
 @requires("authenticated")
 async def home(request: Request):
     template = "home.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT, debug=DEBUG)
-    results = [p.name for p in Path("static/img/colorgrams").glob("*")]
+    experiments = await EXPERIMENT_CATALOG.get()
+    results = await DISK.run(
+        lambda: [p.name for p in Path("static/img/colorgrams").glob("*")]
+    )
 
     context = {"request": request, "experiments": experiments, "results": results}
     return templates.TemplateResponse(template, context)
 
 
-@app.route("/archive")
 @requires("authenticated", redirect="homepage")
 async def archive(request: Request):
     if "experiment" in request.query_params:
         experiment = request.query_params["experiment"]
-        dl_link = get_raw_data_link(experiment)
+        dl_link = await DISK.run(get_raw_data_link, experiment)
         if dl_link is None:
             response = await respond_with_404(
                 request=request, message=f"No download link available for {experiment}"
@@ -163,25 +265,23 @@ async def archive(request: Request):
             response = RedirectResponse(url=dl_link)
     else:
         template = "archive.html"
-        experiments = get_experiments(ELASTICSEARH_CLIENT)
+        experiments = await EXPERIMENT_CATALOG.get()
         context = {"request": request, "experiments": experiments}
         response = templates.TemplateResponse(template, context)
 
     return response
 
 
-@app.route("/search")
 @requires("authenticated", redirect="homepage")
 async def search(request: Request):
     template = "search.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
+    experiments = await EXPERIMENT_CATALOG.get()
 
     context = {"request": request, "experiments": experiments}
     return templates.TemplateResponse(template, context)
 
 
-@app.route("/sketch")
 @requires("authenticated", redirect="homepage")
 async def sketch(request: Request):
 
@@ -193,7 +293,7 @@ async def sketch(request: Request):
 
     template = "sketch.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
+    experiments = await EXPERIMENT_CATALOG.get()
 
     context = {
         "request": request,
@@ -206,26 +306,12 @@ async def sketch(request: Request):
 
 
 
-@app.route("/search")
-@requires("authenticated", redirect="homepage")
-async def search(request: Request):
-
-    template = "search.html"
-
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
-
-    context = {
-        "request": request,
-        "experiments": experiments
-    }
-    return templates.TemplateResponse(template, context)
+# (image urls, cropped face urls) by image_id, see get_image
+IMAGE_URLS: Optional[TTLCache] = None
 
 
-@app.route("/image")
-async def get_image(request: Request):
-    image_id = request.query_params["image_id"]
-
-    image_urls = [
+def image_urls_for(image_id: str) -> List[str]:
+    return [
         image_url
         for image_url in get_response_value(
             elasticsearch_client=ELASTICSEARCH_CLIENT,
@@ -247,15 +333,17 @@ async def get_image(request: Request):
             },
             value_keys=["aggregations", "image_url", "buckets", "*", "key"],
             size=0,
-            #debug=True,
         )
     ]
 
-    s3_region_name = S3_CLIENT.meta._client_config.__dict__["region_name"]
-    s3_bucket = "compsyn"
+
+def cropped_face_urls_for(image_id: str) -> List[Dict[str, str]]:
     try:
-        cropped_face_urls = [
-            f"https://{s3_bucket}.s3.{s3_region_name}.amazonaws.com/{key['experiment_name']}/faces/{key['face_id']}.jpg"
+        return [
+            {
+                "url": f"{S3_URL_PREFIX}/{key['experiment_name']}/faces/{key['face_id']}.jpg",
+                "thumbnail_url": thumbnail_url(f"faces/{key['experiment_name']}/{key['face_id']}"),
+            }
             for key in get_response_value(
                 elasticsearch_client=ELASTICSEARCH_CLIENT,
                 index="cropped-face*",
@@ -279,22 +367,202 @@ async def get_image(request: Request):
                 },
                 value_keys=["aggregations", "face_image", "buckets", "*", "key"],
                 size=0,
-                #debug=True,
                 composite_aggregation_name="face_image"
             )
         ]
     except KeyError:
-        cropped_face_urls = list()
+        return list()
+
+
+async def get_image(request: Request):
+    image_id = request.query_params["image_id"]
+
+    urls = IMAGE_URLS.get(image_id)
+    if urls is None:
+        urls = await asyncio.gather(
+            ELASTICSEARCH.run(image_urls_for, image_id),
+            ELASTICSEARCH.run(cropped_face_urls_for, image_id),
+        )
+        IMAGE_URLS.set(image_id, urls)
+    image_urls, cropped_face_urls = urls
 
     template = "image.html"
     context = {
         "request": request,
         "image_urls": image_urls,
+        "image_thumbnail_url": thumbnail_url(f"raw-images/{image_id}", width=1024),
         "cropped_face_urls": cropped_face_urls,
     }
     return templates.TemplateResponse(template, context)
 
 
+def drop_stale_similarity_experiments(experiments: Dict[str, Any]) -> None:
+    """ forget experiments that left the catalog or whose colorgrams changed, their index is rebuilt on next use """
+    for name in SIMILARITY_EXPERIMENTS.keys():
+        cached = SIMILARITY_EXPERIMENTS.get(name)
+        if cached is not None and experiments.get(name) != cached[0]:
+            SIMILARITY_EXPERIMENTS.pop(name)
+
+
+async def similar(request: Dict[str, Any]) -> Dict[str, Any]:
+    """ the response to a similar request, for experiments in the catalog """
+    try:
+        k = 0 if isinstance(request.get("k"), bool) else int(request.get("k", 10))
+    except (TypeError, ValueError):
+        k = 0
+    if k < 1:
+        return {"status": 400, "message": f"k must be a positive integer, not {request.get('k')}"}
+    experiments = await EXPERIMENT_CATALOG.get()
+    if request["experiment"] not in experiments:
+        return {"status": 404, "message": f"no experiment {request['experiment']}", "experiment": request["experiment"]}
+
+    cached = SIMILARITY_EXPERIMENTS.get(request["experiment"])
+    if cached is None:
+        # keep the experiment around, so its colorgram index is only loaded once
+        cached = (
+            experiments[request["experiment"]],
+            Experiment(
+                bucket_name=S3_BUCKET,
+                elasticsearch_client=ELASTICSEARCH_CLIENT,
+                local_data_store=Path("static/data"),
+                name=request["experiment"],
+                s3_client=S3_CLIENT,
+                debug=DEBUG,
+            ),
+        )
+        SIMILARITY_EXPERIMENTS.set(request["experiment"], cached)
+    return await ELASTICSEARCH.run(similar_response, cached[1], request, k)
+
+
+def similar_response(experiment: Experiment, request: Dict[str, Any], k: int) -> Dict[str, Any]:
+    try:
+        found = experiment.similar(
+            request["similar"],
+            k=k,
+            dist_field=request.get("dist_field", "jzazbz_dist"),
+        )
+        resp = {
+            "status": 200,
+            "similar": [
+                {"distance": distance, "doc": source}
+                for distance, source in found
+            ],
+        }
+    except (FileNotFoundError, NoImagesInElasticsearchError) as e:
+        log.info(f"no match for similar request '{e}'")
+        resp = {
+            "status": 404,
+            "message": "no colorgram for search term",
+            "query": request["similar"],
+            "experiment": request["experiment"],
+        }
+    except ValueError as e:
+        resp = {"status": 400, "message": str(e)}
+    return resp
+
+
+# image urls are listed a page at a time, each page is sent as soon as it is read
+IMAGE_URLS_PAGE_SIZE = 100
+IMAGE_URLS_MAX_PAGE_SIZE = 1000
+
+
+def image_urls_page(
+    request_filter: List[Dict[str, Any]], page_size: int, after: Optional[Dict[str, Any]] = None
+) -> Tuple[List[str], Optional[Dict[str, Any]]]:
+    """ one page of the image urls matching request_filter, and the cursor to the next page (None after the last) """
+    composite = {"size": page_size, "sources": [{"image_url": {"terms": {"field": "image_url"}}}]}
+    if after is not None:
+        composite.update(after=after)
+    resp = ELASTICSEARCH_CLIENT.search(
+        index="raw-images",
+        body={
+            "query": {"bool": {"filter": request_filter}},
+            "aggregations": {"image_url": {"composite": composite}},
+        },
+        size=0,
+    )
+    aggregation = resp["aggregations"]["image_url"]
+    image_urls = [bucket["key"]["image_url"] for bucket in aggregation["buckets"]]
+    # a short page is the last one, no need to ask for an empty page to find out
+    if len(image_urls) < page_size:
+        return image_urls, None
+    return image_urls, aggregation.get("after_key")
+
+
+async def image_url_pages(request: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """
+        Pages of a list_image_urls request, of "page_size" urls each, starting from the "after" cursor of an earlier page if given.
+        Every page carries the cursor to the next one as "after", and "done" on the last, which is also the last of "pages" if that is set.
+    """
+    page_size = request.get("page_size", IMAGE_URLS_PAGE_SIZE)
+    if not isinstance(page_size, int) or not 0 < page_size <= IMAGE_URLS_MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {IMAGE_URLS_MAX_PAGE_SIZE}, not {page_size}")
+    pages = request.get("pages")
+    if pages is not None and not (isinstance(pages, int) and pages > 0):
+        raise ValueError(f"pages must be at least 1, not {pages}")
+    after = request.get("after")
+    page = 0
+    image_urls = 0
+    while True:
+        page_urls, after = await ELASTICSEARCH.run(image_urls_page, request["filter"], page_size, after)
+        page += 1
+        image_urls += len(page_urls)
+        done = after is None or (pages is not None and page >= pages)
+        yield {"status": 200, "image_urls": page_urls, "page": page, "after": after, "done": done}
+        if done:
+            log.info(f"listed {image_urls} image urls in {page} pages")
+            return
+
+
+def colorgram_docs_for(request: Dict[str, Any], experiment_names: List[str]) -> List[Dict[str, Any]]:
+    """ colorgram documents for a get request, from experiment_names if its experiment is null """
+    return search_colorgrams(
+        elasticsearch_client=ELASTICSEARCH_CLIENT,
+        word=request["get"],
+        experiment_names=experiment_names if request["experiment"] is None else [request["experiment"]],
+        debug=DEBUG,
+    )
+
+
+async def sync_colorgram(doc: Dict[str, Any]) -> Path:
+    """ local path of a colorgram document's image, synced from S3 in an S3 slot """
+    s3_path = ColorgramDocument(doc).path
+    return await S3.run(
+        sync_s3_path,
+        s3_client=S3_CLIENT,
+        bucket_name=S3_BUCKET,
+        s3_path=s3_path,
+        local_path=Path("static/data").joinpath(s3_path),
+    )
+
+
+def colorgram_path(doc: Dict[str, Any]) -> str:
+    return f"{doc['_source']['experiment_name']}/{doc['_source']['s3_key']}"
+
+
+async def found_colorgrams(request: Dict[str, Any], experiment_names: List[str]) -> List[Dict[str, Any]]:
+    """ colorgrams for a get request, with their bytes base64 encoded unless the request sets "image_bytes": false """
+    try:
+        docs = await ELASTICSEARCH.run(colorgram_docs_for, request, experiment_names)
+    except FileNotFoundError as e:
+        log.info(f"no match for get request '{e}'")
+        return list()
+    # each sync takes its own S3 slot, so S3.concurrency bounds them across every request
+    img_paths = await asyncio.gather(*[sync_colorgram(doc) for doc in docs])
+    found = list()
+    for doc, img_path in zip(docs, img_paths):
+        colorgram = {
+            "doc": doc,
+            "url": f"/colorgrams/{colorgram_path(doc)}",
+            "thumbnail_url": thumbnail_url(f"colorgrams/{colorgram_path(doc)}"),
+        }
+        if request.get("image_bytes", True):
+            image_bytes = await DISK.run(img_path.read_bytes)
+            colorgram.update(image_bytes=base64.b64encode(image_bytes).decode("utf-8"))
+        found.append(colorgram)
+    return found
+
+
 async def valid_webhook_request(
     websocket: WebSocket, request: Dict[str, Any], required_keys: List[str]
 ) -> bool:
@@ -306,15 +574,15 @@ async def valid_webhook_request(
             missing.append(required_key)
 
     if not valid:
-        await websocket.send_json(
-            {"status": 400, "message": "missing required keys", "missing": missing}
+        await send_json(
+            websocket,
+            {"status": 400, "message": "missing required keys", "missing": missing},
         )
     return valid
 
 
-@app.websocket_route("/data")
 async def experiments_listener(websocket: WebSocket):
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
+    experiments = await EXPERIMENT_CATALOG.get()
 
     await websocket.accept()
     request = await websocket.receive_json()
@@ -328,53 +596,7 @@ async def experiments_listener(websocket: WebSocket):
             if await valid_webhook_request(
                 websocket, request, required_keys=["experiment", "get"]
             ):
-                if request["experiment"] is None:
-                    found = list()
-                    for experiment_name in experiments.keys():
-                        experiment = Experiment(
-                            bucket_name=S3_BUCKET,
-                            elasticsearch_client=ELASTICSEARCH_CLIENT,
-                            local_data_store=Path("static/data"),
-                            name=experiment_name,
-                            s3_client=S3_CLIENT,
-                            debug=DEBUG,
-                        )
-                        try:
-                            found.extend(
-                                [
-                                    {
-                                        "doc": doc,
-                                        "image_bytes": base64.b64encode(
-                                            img_path.read_bytes()
-                                        ).decode("utf-8"),
-                                    }
-                                    for doc, img_path in experiment.get(request["get"])
-                                ]
-                            )
-                        except FileNotFoundError as e:
-                            log.info(f"no match for get request '{e}'")
-                else:
-                    experiment = Experiment(
-                        bucket_name=S3_BUCKET,
-                        elasticsearch_client=ELASTICSEARCH_CLIENT,
-                        local_data_store=Path("static/data"),
-                        name=request["experiment"],
-                        s3_client=S3_CLIENT,
-                        debug=DEBUG,
-                    )
-                    try:
-                        found = [
-                            {
-                                "doc": doc,
-                                "image_bytes": base64.b64encode(
-                                    img_path.read_bytes()
-                                ).decode("utf-8"),
-                            }
-                            for doc, img_path in experiment.get(request["get"])
-                        ]
-                    except FileNotFoundError as e:
-                        log.info(f"no match for get request '{e}'")
-                        found = list()
+                found = await found_colorgrams(request, list(experiments.keys()))
 
                 if len(found) > 0:
                     resp = {
@@ -389,64 +611,346 @@ async def experiments_listener(websocket: WebSocket):
                         "experiment": request["experiment"],
                     }
                 log.info(f"sending JSON response through websocket with keys: {resp.keys()}")
-                await websocket.send_json(resp)
+                await send_json(websocket, resp)
+
+        elif request["action"] == "similar":
+            if await valid_webhook_request(
+                websocket, request, required_keys=["experiment", "similar"]
+            ):
+                await send_json(websocket, await similar(request))
 
         elif request["action"] == "list_experiments":
-            await websocket.send_json(
-                {"status": 200, "experiments": list(experiments.keys())}
+            await send_json(
+                websocket,
+                {"status": 200, "experiments": list(experiments.keys())},
             )
         elif request["action"] == "list_image_urls":
-            image_urls = [
-                image_url
-                for image_url in get_response_value(
-                    elasticsearch_client=ELASTICSEARCH_CLIENT,
-                    index="raw-images",
-                    query={
-                        "query": {
-                            "bool": {
-                                "filter": request["filter"]
-                            }
-                        },
-                        "aggregations": {
-                            "image_url": {
-                                "terms": {
-                                    "field": "image_url",
-                                    "size": 1000,
-                                }
-                            }
-                        }
-                    },
-                    value_keys=["aggregations", "image_url", "buckets", "*", "key"],
-                    size=0,
-                    debug=True,
-                )
-            ]
-            log.info(image_urls)
-            await websocket.send_json(
-                {"status": 200, "image_urls": image_urls}
+            if await valid_webhook_request(websocket, request, required_keys=["filter"]):
+                try:
+                    async for page in image_url_pages(request):
+                        await send_json(websocket, page)
+                except ValueError as e:
+                    await send_json(websocket, {"status": 400, "message": str(e), "done": True})
+        else:
+            await send_json(
+                websocket,
+                {"status": 404, "message": f"no action found for {request['action']}"},
             )
 
 
+# binary frames of the /data/stream protocol are a 4 byte big-endian header length, a JSON header, then the image bytes
+STREAM_HEADER_LENGTH = struct.Struct(">I")
+# requests one /data/stream connection may have running at once, further requests wait to be read
+STREAM_MAX_IN_FLIGHT = 8
+STREAM_REQUIRED_KEYS = {
+    "get": ["experiment", "get"],
+    "similar": ["experiment", "similar"],
+    "list_experiments": [],
+    "list_image_urls": ["filter"],
+}
 
-        else:
-            await websocket.send_json(
-                {"status": 404, "message": f"no action found for {request['action']}"}
+
+def stream_frame(header: Dict[str, Any], payload: bytes) -> bytes:
+    encoded = dumps(header).encode("utf-8")
+    return STREAM_HEADER_LENGTH.pack(len(encoded)) + encoded + payload
+
+
+async def stream_colorgrams(websocket: WebSocket, request: Dict[str, Any]) -> Dict[str, Any]:
+    """ send each colorgram for a get request as its own binary frame as soon as it has been synced from S3 """
+    sent = 0
+    try:
+        docs = await ELASTICSEARCH.run(
+            colorgram_docs_for, request, list((await EXPERIMENT_CATALOG.get()).keys())
+        )
+    except FileNotFoundError as e:
+        log.info(f"no match for get request '{e}'")
+        docs = list()
+    if request["single_value"]:
+        docs = docs[:1]
+
+    # synced concurrently (within the S3 limit), sent in search order
+    syncs = [asyncio.ensure_future(sync_colorgram(doc)) for doc in docs]
+    try:
+        for doc, sync in zip(docs, syncs):
+            img_path = await sync
+            image_bytes = await DISK.run(img_path.read_bytes)
+            header = {
+                "request_id": request.get("request_id"),
+                "doc": doc,
+                # the same image, cacheable by the browser, see colorgram_image
+                "url": f"/colorgrams/{colorgram_path(doc)}",
+                "thumbnail_url": thumbnail_url(f"colorgrams/{colorgram_path(doc)}"),
+            }
+            await websocket.send_bytes(stream_frame(header, image_bytes))
+            sent += 1
+    finally:
+        # a closed socket or cancelled request does not keep syncing the rest
+        for sync in syncs:
+            sync.cancel()
+
+    if sent > 0:
+        return {"status": 200, "sent": sent}
+    return {
+        "status": 404,
+        "message": "no colorgram for search term",
+        "query": request["get"],
+        "experiment": request["experiment"],
+    }
+
+
+async def stream_response(websocket: WebSocket, request: Dict[str, Any]) -> None:
+    """ handle one /data/stream request, always finishing with a JSON text frame carrying its request_id and "done" """
+    action = request.get("action")
+    try:
+        if action not in STREAM_REQUIRED_KEYS:
+            resp = {"status": 404, "message": f"no action found for {action}"}
+        elif any(key not in request for key in STREAM_REQUIRED_KEYS[action]):
+            resp = {
+                "status": 400,
+                "message": "missing required keys",
+                "missing": [key for key in STREAM_REQUIRED_KEYS[action] if key not in request],
+            }
+        elif action == "get":
+            resp = await stream_colorgrams(websocket, request)
+        elif action == "similar":
+            resp = await similar(request)
+        elif action == "list_experiments":
+            resp = {"status": 200, "experiments": list((await EXPERIMENT_CATALOG.get()).keys())}
+        elif action == "list_image_urls":
+            pages, after = 0, None
+            async for page in image_url_pages(request):
+                # only the final frame of a request is "done"
+                page.update(request_id=request.get("request_id"), done=False)
+                await send_json(websocket, page)
+                pages, after = page["page"], page["after"]
+            resp = {"status": 200, "pages": pages, "after": after}
+    except WebSocketDisconnect:
+        raise
+    except ValueError as exc:
+        resp = {"status": 400, "message": str(exc)}
+    except DependencyTimeoutError as exc:
+        resp = {"status": 504, "message": str(exc)}
+    except Exception as exc:
+        log.error(f"{action} request {request.get('request_id')} failed: {exc}")
+        resp = {"status": 500, "message": str(exc)}
+    resp.update(request_id=request.get("request_id"), done=True)
+    await send_json(websocket, resp)
+
+
+async def experiments_stream(websocket: WebSocket):
+    """
+        Like /data, but the socket stays open for any number of requests, which are handled concurrently.
+        Each request may carry a "request_id", echoed on everything sent for it, so responses can be matched to pipelined requests.
+        Colorgrams found by "get" arrive one binary frame each (see stream_frame), as soon as each is ready, single_value defaults to false.
+        Image urls found by "list_image_urls" arrive one JSON frame per page (see image_url_pages).
+        Every request ends with a JSON text frame with "done": true and a status.
+    """
+    await websocket.accept()
+    in_flight = asyncio.Semaphore(STREAM_MAX_IN_FLIGHT)
+    tasks = set()
+
+    def finished(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        in_flight.release()
+
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                request = json.loads(message)
+            except ValueError as exc:
+                await send_json(websocket, {"status": 400, "message": f"invalid JSON: {exc}", "done": True})
+                continue
+            if not isinstance(request, dict):
+                await send_json(websocket, {"status": 400, "message": "request must be a JSON object", "done": True})
+                continue
+            request.setdefault("single_value", False)
+            await in_flight.acquire()
+            task = asyncio.ensure_future(stream_response(websocket, request))
+            tasks.add(task)
+            task.add_done_callback(finished)
+    except WebSocketDisconnect:
+        log.info(f"stream closed with {len(tasks)} requests in flight")
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
+# colorgram s3_keys are sha256 hex digests, and a colorgram is never rewritten under the same key
+COLORGRAM_KEY_LENGTH = 64
+COLORGRAM_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """ whether the request's If-None-Match matches etag, i.e. the client's copy is current """
+    if_none_match = request.headers.get("if-none-match")
+    return if_none_match is not None and (
+        if_none_match.strip() == "*"
+        or etag in [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]
+    )
+
+
+def is_colorgram_key(s3_key: str) -> bool:
+    return len(s3_key) == COLORGRAM_KEY_LENGTH and all(c in "0123456789abcdef" for c in s3_key)
+
+
+async def colorgram_image(request: Request) -> Response:
+    """
+        A colorgram PNG by experiment and s3_key, from the local copy of the S3 object (synced on first request).
+        The key is the ETag and responses may be cached forever, conditional GETs get a 304, single byte ranges a 206.
+    """
+    experiment_name = request.path_params["experiment"]
+    s3_key = request.path_params["s3_key"]
+    if not is_colorgram_key(s3_key):
+        return RapidJSONResponse({"message": f"{s3_key} is not a colorgram key"}, status_code=404)
+    if experiment_name not in await EXPERIMENT_CATALOG.get():
+        return RapidJSONResponse({"message": f"no experiment {experiment_name}"}, status_code=404)
+
+    etag = f'"{s3_key}"'
+    headers = {"ETag": etag, "Cache-Control": COLORGRAM_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    s3_path = Path(experiment_name).joinpath(s3_key)
+    try:
+        image_path = await S3.run(
+            sync_s3_path,
+            s3_client=S3_CLIENT,
+            bucket_name=S3_BUCKET,
+            s3_path=s3_path,
+            local_path=Path("static/data").joinpath(s3_path),
+        )
+    except S3_CLIENT.exceptions.NoSuchKey:
+        return RapidJSONResponse({"message": f"no colorgram {s3_key} in {experiment_name}"}, status_code=404)
+    image = await DISK.run(image_path.read_bytes)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is None or (if_range is not None and if_range.strip() != etag):
+        return Response(image, media_type="image/png", headers=headers)
+    try:
+        requested = byte_range(range_header, len(image))
+    except RangeNotSatisfiableError:
+        headers.update({"Content-Range": f"bytes */{len(image)}"})
+        return Response(status_code=416, headers=headers)
+    if requested is None:
+        return Response(image, media_type="image/png", headers=headers)
+    first, last = requested
+    headers.update({"Content-Range": f"bytes {first}-{last}/{len(image)}"})
+    return Response(image[first : last + 1], status_code=206, media_type="image/png", headers=headers)
+
+
+# colorgrams never change under the same key, raw images and face crops are only replaced if a trial is re-run
+THUMBNAIL_CACHE_CONTROL = {"colorgrams": COLORGRAM_CACHE_CONTROL, "originals": "public, max-age=86400"}
+THUMBNAIL_WIDTH = 256
+# resized variants by (object, width, format), see respond_with_thumbnail
+VARIANT_CACHE_PATH: Optional[Path] = None
+
+
+def thumbnail_url(path: str, width: int = THUMBNAIL_WIDTH) -> str:
+    return f"/thumbnails/{path}?width={width}"
+
+
+def raw_image_s3_path(image_id: str) -> Optional[Path]:
+    hits = ELASTICSEARCH_CLIENT.search(
+        index="raw-images",
+        body={"query": {"bool": {"filter": {"term": {"image_id": image_id}}}}},
+        size=1,
+    )["hits"]["hits"]
+    if len(hits) == 0:
+        return None
+    return RawImageDocument(hits[0]).path
+
+
+async def respond_with_thumbnail(request: Request, s3_path: Path, cache_control: str) -> Response:
+    """
+        The S3 object at s3_path scaled to the ?width= (snapped to one of VARIANT_WIDTHS), as ?format= or WebP for clients that accept it, JPEG otherwise.
+        The original is synced from S3 and the variant made on first request, both are kept on disk for later requests.
+    """
+    try:
+        width = variant_width(int(request.query_params.get("width", THUMBNAIL_WIDTH)))
+        format_name = variant_format(request.query_params.get("format"), request.headers.get("accept", ""))
+    except ValueError as exc:
+        return RapidJSONResponse({"message": str(exc)}, status_code=400)
+
+    key = variant_key(str(s3_path), width, format_name)
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if "format" not in request.query_params:
+        headers.update({"Vary": "Accept"})
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    destination = variant_path(VARIANT_CACHE_PATH, key, format_name)
+    if not await DISK.run(destination.is_file):
+        try:
+            original = await S3.run(
+                sync_s3_path,
+                s3_client=S3_CLIENT,
+                bucket_name=S3_BUCKET,
+                s3_path=s3_path,
+                local_path=Path("static/data").joinpath(s3_path),
             )
+        except S3_CLIENT.exceptions.NoSuchKey:
+            return RapidJSONResponse({"message": f"no image at {s3_path}"}, status_code=404)
+        await IMAGES.run(make_variant, original, destination, width, format_name)
+    return FileResponse(destination, media_type=VARIANT_FORMATS[format_name].media_type, headers=headers)
+
+
+async def colorgram_thumbnail(request: Request) -> Response:
+    experiment_name = request.path_params["experiment"]
+    s3_key = request.path_params["s3_key"]
+    if not is_colorgram_key(s3_key) or experiment_name in [".", ".."]:
+        return RapidJSONResponse({"message": f"{s3_key} is not a colorgram key"}, status_code=404)
+    return await respond_with_thumbnail(
+        request, Path(experiment_name).joinpath(s3_key), THUMBNAIL_CACHE_CONTROL["colorgrams"]
+    )
+
+
+async def face_thumbnail(request: Request) -> Response:
+    experiment_name = request.path_params["experiment"]
+    face_id = request.path_params["face_id"]
+    if experiment_name in [".", ".."] or face_id in [".", ".."]:
+        return RapidJSONResponse({"message": f"{face_id} is not a face id"}, status_code=404)
+    return await respond_with_thumbnail(
+        request, Path(experiment_name).joinpath("faces").joinpath(f"{face_id}.jpg"), THUMBNAIL_CACHE_CONTROL["originals"]
+    )
+
+
+async def raw_image_thumbnail(request: Request) -> Response:
+    image_id = request.path_params["image_id"]
+    s3_path = await ELASTICSEARCH.run(raw_image_s3_path, image_id)
+    if s3_path is None:
+        return RapidJSONResponse({"message": f"no raw image {image_id}"}, status_code=404)
+    return await respond_with_thumbnail(request, s3_path, THUMBNAIL_CACHE_CONTROL["originals"])
+
+
+@requires("authenticated")
+async def refresh_experiment_catalog(request: Request) -> RapidJSONResponse:
+    """ rebuild the experiment catalog now, e.g. after a trial has been indexed """
+    experiments = await EXPERIMENT_CATALOG.refresh(force=True)
+    return RapidJSONResponse(
+        {"experiments": len(experiments), "age_seconds": EXPERIMENT_CATALOG.age}
+    )
 
 
-@app.route("/experiments/{experiment_name}")
 @requires("authenticated", redirect="homepage")
-async def experiment_csv(request: Request) -> JSONResponse:
+async def experiment_csv(request: Request) -> Response:
+    """
+        The experiment's CSV as a trial config, with an ETag of its content so hosts can revalidate with If-None-Match
+    """
 
     experiment_name = request.path_params["experiment_name"]
 
     try:
-        response = await open_experiment_csv(
-            get_experiment_csv_path(
-                name=experiment_name, local_data_store=LOCAL_DATA_STORE,
-            )
+        config = await DISK.run(
+            load_experiment_config,
+            experiment_csv_path(name=experiment_name, local_data_store=LOCAL_DATA_STORE),
         )
-        status_code = 200
+        headers = {"ETag": config.etag, "Cache-Control": "no-cache"}
+        if etag_matches(request, config.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(config.body, media_type="application/json", headers=headers)
     except FileNotFoundError as e:
         log.error(f"{experiment_name}: {e}")
         status_code = 404
@@ -466,24 +970,153 @@ async def experiment_csv(request: Request) -> JSONResponse:
             "message": f"{experiment_name}.csv was found, but is missing a required column: {e}",
         }
 
-    return JSONResponse(response, status_code=status_code)
+    return RapidJSONResponse(response, status_code=status_code)
 
 
-if __name__ == "__main__":
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
 
     get_elasticsearch_args(parser)
     get_s3_args(parser)
 
     parser.add_argument("--debug", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="server processes, each with its own clients and thread pool, sharing the experiment catalog and image files on disk",
+    )
+    parser.add_argument(
+        "--gzip-minimum-size",
+        type=int,
+        default=GZIP_MINIMUM_SIZE,
+        help="responses of at least this many bytes are compressed (brotli if installed, otherwise gzip) for clients that accept it",
+    )
+    parser.add_argument(
+        "--image-cache-ttl",
+        type=float,
+        default=300,
+        help="seconds the urls of an image and its cropped faces are cached for on /image",
+    )
+    parser.add_argument(
+        "--catalog-refresh-interval",
+        type=float,
+        default=300,
+        help="seconds between background refreshes of the experiment catalog, POST /catalog/refresh to refresh it immediately",
+    )
+    parser.add_argument(
+        "--catalog-cache-path",
+        type=Path,
+        default=LOCAL_DATA_STORE.joinpath("imgserve/experiment-catalog.json"),
+        help="the experiment catalog is shared by all workers through this file",
+    )
+    parser.add_argument(
+        "--elasticsearch-concurrency",
+        type=int,
+        default=ELASTICSEARCH.concurrency,
+        help="elasticsearch queries running at once, further requests needing elasticsearch wait",
+    )
+    parser.add_argument(
+        "--s3-concurrency",
+        type=int,
+        default=S3.concurrency,
+        help="S3 downloads running at once, further requests needing S3 wait",
+    )
+    parser.add_argument(
+        "--disk-concurrency",
+        type=int,
+        default=DISK.concurrency,
+        help="local file reads running at once",
+    )
+    parser.add_argument(
+        "--image-concurrency",
+        type=int,
+        default=IMAGES.concurrency,
+        help="thumbnails being resized at once",
+    )
+    parser.add_argument(
+        "--variant-cache-path",
+        type=Path,
+        default=LOCAL_DATA_STORE.joinpath("imgserve/variants"),
+        help="resized variants served on /thumbnails are kept here",
+    )
+    parser.add_argument(
+        "--dependency-timeout",
+        type=float,
+        help=f"seconds a request waits on elasticsearch, S3, the disk or resizing before failing with 504, defaults to {ELASTICSEARCH.timeout}, {S3.timeout}, {DISK.timeout} and {IMAGES.timeout}",
+    )
+    return parser.parse_args(argv)
+
+
+def create_app(args: argparse.Namespace) -> Starlette:
+    """ the server, elasticsearch and S3 clients are created by each worker process as it starts """
+
+    async def startup() -> None:
+        await start_worker(args)
+
+    return Starlette(
+        routes=[
+            Route("/", home),
+            Route("/archive", archive),
+            Route("/search", search),
+            Route("/sketch", sketch),
+            Route("/image", get_image),
+            WebSocketRoute("/data", experiments_listener),
+            WebSocketRoute("/data/stream", experiments_stream),
+            Route("/colorgrams/{experiment}/{s3_key}", colorgram_image),
+            Route("/thumbnails/colorgrams/{experiment}/{s3_key}", colorgram_thumbnail),
+            Route("/thumbnails/faces/{experiment}/{face_id}", face_thumbnail),
+            Route("/thumbnails/raw-images/{image_id}", raw_image_thumbnail),
+            Route("/catalog/refresh", refresh_experiment_catalog, methods=["POST"]),
+            Route("/experiments/{experiment_name}", experiment_csv),
+            Mount("/static", StaticFiles(directory=STATIC), name="static"),
+        ],
+        middleware=[
+            # outermost, so error responses are compressed too
+            Middleware(SelectiveCompressionMiddleware, minimum_size=args.gzip_minimum_size),
+            Middleware(
+                CORSMiddleware,
+                allow_origins=[
+                    "comp-syn.ialcloud.xyz:443",
+                    "comp-syn.com:443",
+                    "localhost:8080",
+                ],
+                allow_headers=["*"],
+                allow_methods=["*"],
+            ),
+            Middleware(
+                AuthenticationMiddleware, backend=BasicAuthBackend(), on_error=on_auth_error
+            ),
+        ],
+        exception_handlers={DependencyTimeoutError: dependency_timeout},
+        on_startup=[startup],
+        on_shutdown=[stop_worker],
+    )
 
-    global ELASTICSEARCH_CLIENT
-    global S3_BUCKET
-    global S3_CLIENT
-    global DEBUG
-    ELASTICSEARCH_CLIENT, S3_CLIENT = get_clients(args)
-    S3_BUCKET = args.s3_bucket
-    DEBUG = args.debug
 
-    uvicorn.run(app, host="0.0.0.0", port=8080, proxy_headers=True)
+# worker processes build the app afresh (see app_from_environment), the server's arguments reach them through the environment
+SERVER_ARGS_ENV = "IMGSERVE_SERVER_ARGS"
+
+
+def app_from_environment() -> Starlette:
+    """
+        The server built from the arguments in IMGSERVE_SERVER_ARGS, for uvicorn --factory and other process managers, e.g.
+        IMGSERVE_SERVER_ARGS="--s3-bucket ..." gunicorn -k uvicorn.workers.UvicornWorker -w 4 'server:app_from_environment()'
+    """
+    if SERVER_ARGS_ENV not in os.environ:
+        raise MissingArgumentsError(f"set {SERVER_ARGS_ENV} to the server's command line arguments, e.g. \"--s3-bucket ... --elasticsearch-client-fqdn ...\"")
+    return create_app(parse_args(shlex.split(os.environ[SERVER_ARGS_ENV])))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.environ[SERVER_ARGS_ENV] = " ".join(shlex.quote(arg) for arg in sys.argv[1:])
+    uvicorn.run(
+        "server:app_from_environment",
+        factory=True,
+        host="0.0.0.0",
+        port=8080,
+        proxy_headers=True,
+        ws=DeflateWebSocketProtocol,
+        workers=args.workers,
+    )
@@ -44,6 +44,7 @@ function showImagesById(imageIds, itemId) {
 
         var request = new Object();
         request.action = "list_image_urls";
+        request.page_size = 200;
         request.filter = [
             {"terms": { "image_id": imageIds }}
         ]
@@ -63,51 +64,61 @@ function showImagesById(imageIds, itemId) {
             websocket.send(JSON.stringify(request));
         };
 
+        var gallery = null;
+        var column = null;
+        var i = 0;
+        var shown = new Set();
+
+        function appendResult(item, index) {
+            ++i
+            if (i > 20) {
+                i = 0;
+                column = document.createElement("div");
+                column.className = "column";
+                gallery.appendChild(column);
+                console.log("overflow column")
+            }
+            var rawImg = document.createElement("div");
+            rawImg.className = "raw-image";
+            var img = document.createElement("img");
+            img.loading = "lazy";
+            img.src = item;
+            rawImg.appendChild(img);
+            column.appendChild(rawImg);
+        }
+
+        // urls arrive a page per message, each page is drawn as soon as it arrives
         websocket.onmessage = function(mesg) {
             var data = JSON.parse(mesg.data);
-            console.log(`websocket responded with ${JSON.stringify(data)}`)
+            console.log(`websocket responded with page ${data.page} of ${data.image_urls ? data.image_urls.length : 0} urls`)
             document.getElementById("spinner").style.display = "none";
             switch (data.status) {
                 case 200:
-                    console.log("200 status");
-                    var gallery = document.createElement("div");
-                    gallery.className = "gallery";
-                    gallery.id = rawGalleryId;
-                    var column = document.createElement("div");
-                    column.className = "column";
-                    gallery.appendChild(column);
-                    var i = 0;
-                    var j = 0;
-                    document.getElementById("docs-query").appendChild(gallery);
-
-                    function appendResult(item, index) {
-                        ++i
-                        if (i > 20) {
-                            ++j;
-                            i = 0;
-                            column = document.createElement("div");
-                            column.className = "column";
-                            gallery.appendChild(column);
-                            console.log("overflow column")
-                        }
-                        var rawImg = document.createElement("div");
-                        rawImg.className = "raw-image";
-                        var img = document.createElement("img");
-                        img.src = item;
-                        rawImg.appendChild(img);
-                        column.appendChild(rawImg);
-                    }
-                    function onlyUnique(value, index, self) {
-
-                        return self.indexOf(value) === index;
+                    if (gallery === null) {
+                        gallery = document.createElement("div");
+                        gallery.className = "gallery";
+                        gallery.id = rawGalleryId;
+                        column = document.createElement("div");
+                        column.className = "column";
+                        gallery.appendChild(column);
+                        document.getElementById("docs-query").appendChild(gallery);
                     }
-                    data.image_urls.filter(onlyUnique).forEach(appendResult);
-                    document.getElementById("search-status").innerHTML = "200";
+                    data.image_urls.filter(function(url) {
+                        if (shown.has(url)) {
+                            return false;
+                        }
+                        shown.add(url);
+                        return true;
+                    }).forEach(appendResult);
+                    document.getElementById("search-status").innerHTML = data.done ? "200" : `200, ${shown.size} images so far`;
                     break;
                 default:
                     console.log(`non 200 status: ${data.status}`);
                     document.getElementById("search-status").innerHTML = JSON.stringify(data);
             }
+            if (data.done !== false) {
+                websocket.close();
+            }
         };
 
         websocket.onclose = function() {
@@ -130,6 +141,8 @@ function drawImageGridFromWebsocket(action, values_from, img_target) {
     var request = new Object();
     request.action = "get";
     request.single_value = false;
+    // the grid shows thumbnails, the full size colorgram is only loaded when one is opened
+    request.image_bytes = false;
     experiment_name = document.getElementById("experiment-query").value.trim();
     if (experiment_name == "*") {
       request.experiment = null;
@@ -180,7 +193,7 @@ function drawImageGridFromWebsocket(action, values_from, img_target) {
                     colorgram.className = "colorgram";
                     var img = document.createElement("img");
                     img.id = `colorgram-${itemId}`;
-                    img.src = "data:image/png;base64," + item.image_bytes;
+                    img.src = item.thumbnail_url;
                     colorgram.appendChild(img);
 
                     var doc = document.createElement("pre");
@@ -192,7 +205,8 @@ function drawImageGridFromWebsocket(action, values_from, img_target) {
                     docWrap.className = "doc-wrapper";
                     docWrap.id = `doc-wrapper-${itemId}`;
                     var bigimg = document.createElement("img");
-                    bigimg.src = "data:image/png;base64," + item.image_bytes;
+                    bigimg.loading = "lazy";
+                    bigimg.src = item.url;
 
                     var bigimgWrap = document.createElement("div");
                     bigimgWrap.className = "img-focus";
@@ -283,6 +297,7 @@ function getImageFromFormWebsocket(action, values_from, img_target, use_id) {
     }
 
     values_from.forEach(addToRequest);
+    request.image_bytes = false;
 
     var websocket = newWebSocket();
 
@@ -296,7 +311,7 @@ function getImageFromFormWebsocket(action, values_from, img_target, use_id) {
         var img = getTaggedElement(img_target, use_id);
         switch (data.status) {
             case 200:
-                img.src = "data:image/png;base64," + data.found.image_bytes;
+                img.src = data.found.thumbnail_url;
                 hideForm("selector", use_id)
                 break;
             default:
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import pytest
+
+from ranges import RangeNotSatisfiableError, byte_range
+
+
+@pytest.mark.parametrize(
+    "range_header,expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=900-1999", (900, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=999-999", (999, 999)),
+    ],
+)
+def test_byte_range(range_header: str, expected: Tuple[int, int]) -> None:
+    assert byte_range(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize(
+    "range_header",
+    [
+        "bytes=abc-def",
+        "bytes=10-abc",
+        "bytes=-",
+        "bytes=10",
+        "bytes=+1-5",
+        "bytes=99-10",
+        "bytes=0-9,20-29",
+        "items=0-9",
+        "nonsense",
+    ],
+)
+def test_byte_range_ignored(range_header: str) -> None:
+    """ malformed or unsupported ranges are ignored, so the full body is sent """
+    assert byte_range(range_header, 1000) is None
+
+
+@pytest.mark.parametrize("range_header,size", [("bytes=1000-", 1000), ("bytes=5000-6000", 1000), ("bytes=-0", 1000), ("bytes=-10", 0)])
+def test_byte_range_not_satisfiable(range_header: str, size: int) -> None:
+    with pytest.raises(RangeNotSatisfiableError):
+        byte_range(range_header, size)
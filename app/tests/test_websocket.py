@@ -39,3 +39,38 @@ test_requests = [
 async def test_websockets() -> None:
     for request in test_requests:
         await send_request(request)
+
+
+async def send_pipelined_requests(requests: List[Dict[str, Any]]) -> Dict[Any, Dict[str, Any]]:
+    uri = "ws://localhost:8080/data/stream"
+    async with websockets.connect(uri) as websocket:
+        for request in requests:
+            await websocket.send(json.dumps(request))
+            print(f"> {json.dumps(request)}")
+
+        results = {request["request_id"]: {"frames": 0} for request in requests}
+        while not all("status" in result for result in results.values()):
+            message = await websocket.recv()
+            if isinstance(message, bytes):
+                header_length = int.from_bytes(message[:4], "big")
+                header = json.loads(message[4 : 4 + header_length])
+                assert len(message) > 4 + header_length
+                results[header["request_id"]]["frames"] += 1
+            else:
+                response = json.loads(message)
+                print(f"< {response}")
+                assert response["done"]
+                results[response["request_id"]].update(response)
+        return results
+
+
+@pytest.mark.asyncio
+async def test_websocket_stream() -> None:
+    results = await send_pipelined_requests(
+        [
+            {"request_id": "colorgram", "action": "get", "experiment": "concreteness", "get": "utopia"},
+            {"request_id": "experiments", "action": "list_experiments"},
+        ]
+    )
+    assert results["colorgram"]["frames"] == results["colorgram"].get("sent", 0)
+    assert results["experiments"]["status"] == 200
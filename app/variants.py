@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import hashlib
+import io
+from dataclasses import dataclass
+from pathlib import Path
+
+from PIL import Image, features
+
+from imgserve.utils import atomic_write_bytes
+
+
+@dataclass
+class VariantFormat:
+    pil_format: str
+    media_type: str
+    suffix: str
+    save_kwargs: Dict[str, Any]
+
+
+VARIANT_FORMATS = {
+    "jpeg": VariantFormat("JPEG", "image/jpeg", ".jpg", {"quality": 85, "optimize": True, "progressive": True}),
+    "webp": VariantFormat("WEBP", "image/webp", ".webp", {"quality": 80, "method": 4}),
+}
+# variants are only made at these widths, so arbitrary widths can not fill the cache
+VARIANT_WIDTHS = (64, 128, 256, 512, 1024)
+
+
+def variant_width(width: int) -> int:
+    """ the smallest variant width at least as wide as width, or the widest """
+    for allowed in VARIANT_WIDTHS:
+        if allowed >= width:
+            return allowed
+    return VARIANT_WIDTHS[-1]
+
+
+def variant_format(requested: Optional[str], accept: str) -> str:
+    """ requested if given, otherwise webp for clients that accept it """
+    if requested is not None:
+        if requested not in VARIANT_FORMATS:
+            raise ValueError(f"format must be one of {list(VARIANT_FORMATS)}, not {requested}")
+        return requested
+    if "image/webp" in accept and features.check("webp"):
+        return "webp"
+    return "jpeg"
+
+
+def variant_key(source: str, width: int, format_name: str) -> str:
+    """ identifies the variant of a source object (e.g. its S3 path) at a width and format, also used as its ETag """
+    return hashlib.sha256(f"{source}|{width}|{format_name}".encode("utf-8")).hexdigest()
+
+
+def variant_path(cache_path: Path, key: str, format_name: str) -> Path:
+    return cache_path.joinpath(key[:2]).joinpath(key).with_suffix(VARIANT_FORMATS[format_name].suffix)
+
+
+def make_variant(source: Path, destination: Path, width: int, format_name: str) -> Path:
+    """ write source scaled down to width (never up) in format_name to destination, unless it is already there """
+    if destination.is_file():
+        return destination
+    variant = VARIANT_FORMATS[format_name]
+    with Image.open(source) as image:
+        height = max(1, round(image.height * width / image.width))
+        # JPEGs can be decoded at a fraction of their size, much cheaper than decoding in full to throw most of it away
+        image.draft("RGB", (width, height))
+        image.thumbnail((width, height), Image.LANCZOS)
+        if image.mode not in ("RGB", "RGBA") or (format_name == "jpeg" and image.mode == "RGBA"):
+            image = image.convert("RGBA" if format_name == "webp" and image.mode in ("RGBA", "LA", "P") else "RGB")
+        encoded = io.BytesIO()
+        image.save(encoded, format=variant.pil_format, **variant.save_kwargs)
+    # concurrent requests (in any worker) for the same variant never see it half written
+    atomic_write_bytes(destination, encoded.getvalue())
+    return destination
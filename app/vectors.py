@@ -5,72 +5,41 @@ import json
 
 from imgserve.args import get_elasticsearch_args, get_s3_args
 from imgserve.clients import get_clients
-from imgserve.elasticsearch import get_response_value, fields_in_hits, all_field_values
+from imgserve.elasticsearch import COLORGRAMS_INDEX_PATTERN, RAW_IMAGES_INDEX_PATTERN, fields_in_hits
 
 
-def get_experiment_metadata(
-    elasticsearch_client: Elasticsearch, experiment_name: str, debug: bool = False
-) -> Dict[str, Any]:
+def experiments_query(page_size: int = 500) -> Dict[str, Any]:
+    """
+        Metadata of every experiment, from one aggregation over the raw-images and colorgrams indices:
+        document counts of each index, the days images were collected on, and a sample of raw images to take dimensions from
+    """
     return {
-        "colorgrams": next(
-            get_response_value(
-                elasticsearch_client=elasticsearch_client,
-                index="colorgrams",
-                query={
-                    "query": {
-                        "bool": {"must": {"term": {"experiment_name": experiment_name}}}
-                    },
-                    "aggs": {"count": {"value_count": {"field": "query.keyword"}}},
+        "aggs": {
+            "experiments": {
+                "composite": {
+                    "size": page_size,
+                    "sources": [{"experiment_name": {"terms": {"field": "experiment_name"}}}],
                 },
-                value_keys=["aggregations", "count", "value"],
-                debug=debug,
-            )
-        ),
-        "raw-images": next(
-            get_response_value(
-                elasticsearch_client=elasticsearch_client,
-                index="raw-images",
-                query={
-                    "query": {
-                        "bool": {"must": {"term": {"experiment_name": experiment_name}}}
+                "aggs": {
+                    "colorgrams": {"filter": {"term": {"_index": COLORGRAMS_INDEX_PATTERN}}},
+                    "raw_images": {
+                        "filter": {"term": {"_index": RAW_IMAGES_INDEX_PATTERN}},
+                        "aggs": {
+                            "timestamps": {
+                                "date_histogram": {
+                                    "field": "trial_timestamp",
+                                    "calendar_interval": "day",
+                                    "format": "yyyy-MM-dd",
+                                    "min_doc_count": 1,
+                                }
+                            },
+                            # dimensions are the fields present in a few of the experiment's raw images
+                            "sample": {"top_hits": {"size": 10}},
+                        },
                     },
-                    "aggs": {"count": {"value_count": {"field": "query"}}},
                 },
-                value_keys=["aggregations", "count", "value"],
-                debug=debug,
-            )
-        ),
-        "dimensions": fields_in_hits(
-            next(
-                get_response_value(
-                    elasticsearch_client=elasticsearch_client,
-                    index="raw-images",
-                    query={
-                        "query": {
-                            "bool": {"must": {"term": {"experiment_name": experiment_name}}}
-                        }
-                    },
-                    value_keys=["hits", "hits"],
-                    size=10,
-                    debug=debug,
-                )
-            )
-        ),
-        "timestamps": set(
-            ts[:10]
-            for ts in get_response_value(
-                elasticsearch_client=elasticsearch_client,
-                index="raw-images",
-                query={
-                    "query": {
-                        "bool": {"must": {"term": {"experiment_name": experiment_name}}}
-                    },
-                    "aggs": {"dates": {"terms": {"field": "trial_timestamp"}}},
-                },
-                value_keys=["aggregations", "dates", "buckets", "*", "key_as_string"],
-                debug=debug,
-            )
-        ),
+            }
+        }
     }
 
 
@@ -78,24 +47,33 @@ def get_experiments(
     elasticsearch_client: Elasticsearch, debug: bool = False
 ) -> Dict[str, Any]:
     """
-        Get list of all experiments from colorgrams index, associate metadata with each one to include in informational tooltip
+        Get all experiments with raw images or colorgrams, associate metadata with each one to include in informational tooltip.
+        Costs one search per 500 experiments, however many experiments there are.
     """
-    experiment_names = all_field_values(
-        elasticsearch_client,
-        field="experiment_name",
-        query={"query": {"match_all": {}}},
-    )
+    query = experiments_query()
+    index = ",".join([RAW_IMAGES_INDEX_PATTERN, COLORGRAMS_INDEX_PATTERN])
     experiments = dict()
-    for experiment_name in experiment_names:
-        experiments.update(
-            {
-                experiment_name: get_experiment_metadata(
-                    elasticsearch_client=elasticsearch_client,
-                    experiment_name=experiment_name,
-                    debug=debug,
-                )
-            }
+    while True:
+        if debug:
+            print(f"GET /{index}/_search?size=0\n{json.dumps(query, indent=2)}")
+        resp = elasticsearch_client.search(
+            index=index, body=query, size=0, ignore_unavailable=True
         )
+        buckets = resp["aggregations"]["experiments"]["buckets"]
+        for bucket in buckets:
+            raw_images = bucket["raw_images"]
+            experiments[bucket["key"]["experiment_name"]] = {
+                "colorgrams": bucket["colorgrams"]["doc_count"],
+                "raw-images": raw_images["doc_count"],
+                "dimensions": fields_in_hits(raw_images["sample"]["hits"]["hits"]),
+                "timestamps": [
+                    timestamp["key_as_string"]
+                    for timestamp in raw_images["timestamps"]["buckets"]
+                ],
+            }
+        if len(buckets) == 0 or "after_key" not in resp["aggregations"]["experiments"]:
+            break
+        query["aggs"]["experiments"]["composite"]["after"] = resp["aggregations"]["experiments"]["after_key"]
     return experiments
 
 
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from imgserve.logger import simple_logger
+from imgserve.vectors import COMPRESS_DIMS, decode_image, load_vector
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compare colour distributions from draft mode / reduced resolution decoding against a full decode at colorgram resolution"
+    )
+
+    parser.add_argument(
+        "--images-path",
+        type=Path,
+        default=Path(__file__).parents[1].joinpath("tests/similar"),
+        help="folder of images to benchmark with",
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=int,
+        nargs="+",
+        default=[300, 150, 100, 75],
+        help="(square) analysis resolutions to compare",
+    )
+    parser.add_argument(
+        "--json-report", type=Path, help="also write the results to this file as JSON"
+    )
+
+    return parser.parse_args()
+
+
+def js_divergence(p: np.ndarray, q: np.ndarray) -> float:
+    p = np.nan_to_num(np.asarray(p, dtype=np.float64))
+    q = np.nan_to_num(np.asarray(q, dtype=np.float64))
+    p = p / p.sum()
+    q = q / q.sum()
+    m = 0.5 * (p + q)
+
+    def kl(a: np.ndarray, b: np.ndarray) -> float:
+        mask = a > 0
+        return float(np.sum(a[mask] * np.log2(a[mask] / b[mask])))
+
+    return 0.5 * kl(p, m) + 0.5 * kl(q, m)
+
+
+def decode_all(
+    images: List[Path], dims: Tuple[int, int], draft: bool
+) -> Tuple[List[np.ndarray], float]:
+    start = time.perf_counter()
+    arrays = [decode_image(image.read_bytes(), dims=dims, draft=draft) for image in images]
+    return arrays, time.perf_counter() - start
+
+
+def main(args: argparse.Namespace) -> None:
+
+    log = simple_logger("imgserve.benchmark-decode")
+
+    images = sorted(path for path in args.images_path.iterdir() if path.is_file())
+    log.info(f"benchmarking {len(images)} images from {args.images_path}")
+
+    reference_arrays, reference_seconds = decode_all(
+        images, dims=COMPRESS_DIMS, draft=False
+    )
+    reference = [load_vector(image.stem, [array]) for image, array in zip(images, reference_arrays)]
+    reference_group = load_vector("group", reference_arrays)
+
+    results = list()
+    for resolution in args.resolutions:
+        for draft in [False, True]:
+            arrays, decode_seconds = decode_all(
+                images, dims=(resolution, resolution), draft=draft
+            )
+            start = time.perf_counter()
+            vectors = [load_vector(image.stem, [array]) for image, array in zip(images, arrays)]
+            analysis_seconds = time.perf_counter() - start
+            group = load_vector("group", arrays)
+
+            result = {
+                "resolution": resolution,
+                "draft": draft,
+                "decode_ms_per_image": 1000 * decode_seconds / len(images),
+                "analysis_ms_per_image": 1000 * analysis_seconds / len(images),
+            }
+            for dist in ["rgb_dist", "jzazbz_dist"]:
+                per_image = [
+                    js_divergence(getattr(ref, dist), getattr(vec, dist))
+                    for ref, vec in zip(reference, vectors)
+                ]
+                result.update(
+                    {
+                        f"{dist}_js_mean": float(np.mean(per_image)),
+                        f"{dist}_js_max": float(np.max(per_image)),
+                        f"{dist}_js_group": js_divergence(
+                            getattr(reference_group, dist), getattr(group, dist)
+                        ),
+                    }
+                )
+            results.append(result)
+
+    print(
+        f"full decode at {COMPRESS_DIMS}: {1000 * reference_seconds / len(images):.2f} ms/image"
+    )
+    for result in results:
+        print(
+            ", ".join(
+                f"{key}={value:.5f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in result.items()
+            )
+        )
+
+    if args.json_report is not None:
+        args.json_report.write_text(json.dumps(results, indent=2))
+        log.info(f"wrote report to {args.json_report}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from imgserve.faces import FACE_DETECTORS, CascadeDetector, extract_faces, extract_faces_many, get_face_detector
+from imgserve.logger import simple_logger
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measure face detection throughput, per-image latency and memory over a folder of images, for several detectors, detector settings and worker counts. Boxes found by each configuration are compared to those of the first one."
+    )
+
+    parser.add_argument(
+        "--images-path",
+        type=Path,
+        default=Path(__file__).parents[1].joinpath("tests/faces"),
+        help="folder of images to benchmark with, images named <n>-... or <min>to<max>-... are also checked for the expected number of faces",
+    )
+    parser.add_argument(
+        "--detectors",
+        nargs="+",
+        default=["haar"],
+        help="detectors to compare, as backend[:model[:config]], e.g. haar lbp:./lbpcascade_frontalface_improved.xml dnn:./res10_300x300_ssd_iter_140000.caffemodel:./deploy.prototxt",
+    )
+    parser.add_argument(
+        "--dnn-confidence", type=float, default=0.5, help="minimum confidence of dnn detections"
+    )
+    parser.add_argument(
+        "--detection-heights",
+        type=int,
+        nargs="+",
+        default=[0, 1024, 720, 480],
+        help="fast mode detection heights to compare for cascade detectors, 0 is a full resolution (not fast) detection",
+    )
+    parser.add_argument(
+        "--equalize-hist",
+        action="store_true",
+        help="also benchmark each fast mode setting with histogram equalization",
+    )
+    parser.add_argument(
+        "--min-neighbors", type=int, default=5, help="minNeighbors for every cascade setting"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, os.cpu_count() or 1}),
+        help="worker counts to measure throughput with",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="pass over the images this many times per measurement",
+    )
+    parser.add_argument(
+        "--json-report", type=Path, help="also write the results to this file as JSON"
+    )
+    # each measurement runs in a fresh process (re-invoking this script), so peak memory is per measurement
+    parser.add_argument("--run-measurement", type=str, help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def expected_faces(image: Path) -> Optional[Tuple[int, int]]:
+    try:
+        bounds = [int(el) for el in image.name.split("-")[0].split("to")]
+    except ValueError:
+        return None
+    return bounds[0], bounds[-1]
+
+
+def peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def parse_detector(spec: str) -> Dict[str, Optional[str]]:
+    backend, model, config = (spec.split(":", 2) + [None, None])[:3]
+    return {"backend": backend, "model": model, "config": config}
+
+
+def make_detector(spec: str, settings: Dict[str, Any], dnn_confidence: float) -> FaceDetector:
+    detector = parse_detector(spec)
+    return get_face_detector(
+        backend=detector["backend"],
+        model=None if detector["model"] is None else Path(detector["model"]),
+        config=None if detector["config"] is None else Path(detector["config"]),
+        dnn_confidence=dnn_confidence,
+        **settings,
+    )
+
+
+def box_agreement(reference: List[List[int]], boxes: List[List[int]], min_iou: float = 0.5) -> Tuple[int, List[float]]:
+    """ greedily match boxes to reference boxes by intersection over union, returns (matches, IoU of each match) """
+    pairs = list()
+    for i, (rx, ry, rw, rh) in enumerate(reference):
+        for j, (x, y, w, h) in enumerate(boxes):
+            overlap_w = min(rx + rw, x + w) - max(rx, x)
+            overlap_h = min(ry + rh, y + h) - max(ry, y)
+            if overlap_w <= 0 or overlap_h <= 0:
+                continue
+            intersection = overlap_w * overlap_h
+            iou = intersection / (rw * rh + w * h - intersection)
+            if iou >= min_iou:
+                pairs.append((iou, i, j))
+    matched_reference, matched_boxes, ious = set(), set(), list()
+    for iou, i, j in sorted(pairs, reverse=True):
+        if i in matched_reference or j in matched_boxes:
+            continue
+        matched_reference.add(i)
+        matched_boxes.add(j)
+        ious.append(iou)
+    return len(ious), ious
+
+
+def measure(images: List[Path], detector: FaceDetector, workers: int, repeat: int) -> Dict[str, Any]:
+    jobs = images * repeat
+    face_boxes = dict()
+    latencies = list()
+    if workers == 1:
+        detector.model  # load before timing, as each worker does before its first image
+        start = time.perf_counter()
+        for image in jobs:
+            image_start = time.perf_counter()
+            faces = extract_faces(image, detector=detector)
+            latencies.append(time.perf_counter() - image_start)
+            face_boxes[image] = [list(face.box) for face in faces]
+    else:
+        start = time.perf_counter()
+        for image, faces in extract_faces_many(jobs, detector=detector, workers=workers):
+            face_boxes[image] = [list(face.box) for face in faces]
+    seconds = time.perf_counter() - start
+
+    result = {
+        "workers": workers,
+        "images": len(jobs),
+        "seconds": seconds,
+        "images_per_second": len(jobs) / seconds,
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_worker_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+    if len(latencies) > 0:
+        result.update(
+            {
+                f"latency_ms_p{percentile}": float(1000 * np.percentile(latencies, percentile))
+                for percentile in [50, 90, 99]
+            }
+        )
+        result.update(latency_ms_max=1000 * max(latencies))
+
+    expected = {image: expected_faces(image) for image in images}
+    checked = [image for image in images if expected[image] is not None]
+    result.update(
+        faces=sum(len(face_boxes[image]) for image in images),
+        expected_face_count_images=len(checked),
+        expected_face_count_matches=sum(
+            expected[image][0] <= len(face_boxes[image]) <= expected[image][1] for image in checked
+        ),
+        boxes={image.name: face_boxes[image] for image in images},
+    )
+    return result
+
+
+def agreement(reference: Dict[str, List[List[int]]], boxes: Dict[str, List[List[int]]]) -> Dict[str, float]:
+    """ how closely the boxes found over all images agree with the reference configuration's """
+    matches, ious, reference_faces, faces = 0, list(), 0, 0
+    for image, reference_boxes in reference.items():
+        image_matches, image_ious = box_agreement(reference_boxes, boxes[image])
+        matches += image_matches
+        ious.extend(image_ious)
+        reference_faces += len(reference_boxes)
+        faces += len(boxes[image])
+    return {
+        "agreement_f1": 1.0 if reference_faces + faces == 0 else 2 * matches / (reference_faces + faces),
+        "agreement_mean_iou": float(np.mean(ious)) if len(ious) > 0 else 0.0,
+    }
+
+
+def run_measurement(
+    images_path: Path,
+    detector: str,
+    settings: Dict[str, Any],
+    workers: int,
+    repeat: int,
+    dnn_confidence: float,
+) -> Dict[str, Any]:
+    proc = subprocess.run(
+        [
+            sys.executable,
+            __file__,
+            "--images-path",
+            str(images_path),
+            "--repeat",
+            str(repeat),
+            "--dnn-confidence",
+            str(dnn_confidence),
+            "--run-measurement",
+            json.dumps({"detector": detector, "settings": settings, "workers": workers}),
+        ],
+        capture_output=True,
+        check=True,
+    )
+    return json.loads(proc.stdout.decode("utf-8").strip().splitlines()[-1])
+
+
+def main(args: argparse.Namespace) -> None:
+
+    log = simple_logger("imgserve.benchmark-faces")
+
+    images = sorted(
+        path
+        for path in args.images_path.iterdir()
+        if path.is_file() and path.suffix.lower() in [".jpg", ".jpeg", ".png"]
+    )
+
+    if args.run_measurement is not None:
+        measurement = json.loads(args.run_measurement)
+        detector = make_detector(measurement["detector"], measurement["settings"], args.dnn_confidence)
+        print(json.dumps(measure(images, detector, measurement["workers"], args.repeat)))
+        return
+
+    cascade_settings = list()
+    for height in args.detection_heights:
+        settings = {"cv2_cascade_min_neighbors": args.min_neighbors, "fast": height > 0}
+        if height > 0:
+            settings.update(detection_height=height)
+        cascade_settings.append(settings)
+        if height > 0 and args.equalize_hist:
+            cascade_settings.append(dict(settings, equalize_hist=True))
+
+    configurations = list()
+    for detector in args.detectors:
+        # detection height and histogram equalization only apply to cascades, the dnn detector has a fixed input size
+        is_cascade = issubclass(FACE_DETECTORS[parse_detector(detector)["backend"]], CascadeDetector)
+        for settings in cascade_settings if is_cascade else [dict()]:
+            configurations.append((detector, settings))
+
+    log.info(f"benchmarking {len(configurations)} configurations with {args.workers} workers over {len(images)} images from {args.images_path}")
+    results = list()
+    reference_boxes = None
+    for detector, settings in configurations:
+        for workers in args.workers:
+            result = {"detector": detector, "settings": settings}
+            result.update(run_measurement(args.images_path, detector, settings, workers, args.repeat, args.dnn_confidence))
+            boxes = result.pop("boxes")
+            if reference_boxes is None:
+                # the first configuration is the reference the others are compared to
+                reference_boxes = boxes
+            result.update(agreement(reference_boxes, boxes))
+            results.append(result)
+            print(
+                ", ".join(
+                    f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+                    for key, value in result.items()
+                )
+            )
+
+    if args.json_report is not None:
+        args.json_report.write_text(
+            json.dumps(
+                {
+                    "images_path": str(args.images_path),
+                    "images": len(images),
+                    "repeat": args.repeat,
+                    "cpu_count": os.cpu_count(),
+                    "opencv_version": cv2.__version__,
+                    "reference": {"detector": configurations[0][0], "settings": configurations[0][1]},
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+        log.info(f"wrote report to {args.json_report}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -13,7 +13,7 @@ from PIL import Image
 
 from imgserve import get_experiment_colorgrams_path, get_experiment_csv_path, STATIC
 from imgserve.api import ImgServe, Experiment
-from imgserve.assemble import assemble_downloads
+from imgserve.assemble import assemble_downloads, gather_image_paths, stream_images
 from imgserve.args import (
     get_elasticsearch_args,
     get_experiment_args,
@@ -27,10 +27,12 @@ from imgserve.elasticsearch import (
     index_to_elasticsearch,
     COLORGRAMS_INDEX_PATTERN,
 )
+from imgserve.export import export_colorgrams
+from imgserve.faces import face_detector_from_args
 from imgserve.logger import simple_logger
 from imgserve.s3 import s3_put_image
 from imgserve.trial import run_trial
-from imgserve.vectors import get_vectors
+from imgserve.vectors import get_vectors, get_vectors_from_images
 from imgserve.utils import download_image
 
 
@@ -94,6 +96,7 @@ def main(args: argparse.Namespace) -> None:
         remote_url=args.remote_url,
         username=args.remote_username,
         password=args.remote_password,
+        cache_path=args.local_data_store.joinpath("imgserve/experiment-configs"),
     )
 
     if args.share_ip_address:
@@ -209,6 +212,12 @@ def main(args: argparse.Namespace) -> None:
             query_timeout=300,
             no_compress=args.no_compress,
             cv2_cascade_min_neighbors=args.cv2_cascade_min_neighbors,
+            analysis_resolution=args.analysis_resolution,
+            draft_decode=args.draft_decode,
+            face_detection_workers=args.face_detection_workers,
+            face_detector=None if args.skip_face_detection else face_detector_from_args(args),
+            face_dedup_hamming_radius=args.face_dedup_hamming_radius if args.face_dedup else None,
+            face_detection_cache=args.face_detection_cache,
         )
 
         log.info(f"image gathering completed")
@@ -221,35 +230,67 @@ def main(args: argparse.Namespace) -> None:
         # Check if trial_id in args.dimensions, warn results will mix if not
 
     if args.dimensions is not None:
-        log.info(
-            f"assembling 'downloads' folder from data, splitting images by {args.dimensions}..."
-        )
-        downloads: Path = assemble_downloads(
+        image_directories, sampling = gather_image_paths(
             elasticsearch_client=elasticsearch_client,
-            s3_client=s3_client,
-            bucket_name=args.s3_bucket,
             trial_ids=args.trial_ids,
-            experiment_name=args.experiment_name,
             dimensions=args.dimensions,
-            local_data_store=args.local_data_store,
-            dry_run=args.dry_run,
-            force_remote_pull=args.force_remote_pull,
-            prompt=args.prompt,
+            max_images_per_group=args.max_images_per_group,
         )
+        if args.stream_images and not args.dry_run:
+            # create compsyn.vectors.Vector objects out of each group of images as they are read, and also store metadata for Elasticsearch
+            log.info(
+                f"streaming images into vectors, splitting images by {args.dimensions}..."
+            )
+            vectors = get_vectors_from_images(
+                stream_images(
+                    s3_client=s3_client,
+                    bucket_name=args.s3_bucket,
+                    image_directories=image_directories,
+                    local_data_store=args.local_data_store,
+                    force_remote_pull=args.force_remote_pull,
+                ),
+                analysis_dims=(args.analysis_resolution, args.analysis_resolution),
+                draft=args.draft_decode,
+                group_metadata=sampling,
+            )
+        else:
+            log.info(
+                f"assembling 'downloads' folder from data, splitting images by {args.dimensions}..."
+            )
+            downloads: Path = assemble_downloads(
+                elasticsearch_client=elasticsearch_client,
+                s3_client=s3_client,
+                bucket_name=args.s3_bucket,
+                trial_ids=args.trial_ids,
+                experiment_name=args.experiment_name,
+                dimensions=args.dimensions,
+                local_data_store=args.local_data_store,
+                dry_run=args.dry_run,
+                force_remote_pull=args.force_remote_pull,
+                prompt=args.prompt,
+                image_directories=image_directories,
+            )
 
-        if args.dry_run:
-            log.info("--dry-run passed, cannot continue past here")
-            return
+            if args.dry_run:
+                log.info("--dry-run passed, cannot continue past here")
+                return
+
+            # create compsyn.vectors.Vector objects out of each folder, and also store metadata for Elasticsearch
+            log.info(f"generating vectors from {downloads}...")
+            vectors = get_vectors(
+                downloads,
+                analysis_dims=(args.analysis_resolution, args.analysis_resolution),
+                draft=args.draft_decode,
+                group_metadata=sampling,
+            )
 
-        # create compsyn.vectors.Vector objects out of each folder, and also store metadata for Elasticsearch
-        log.info(f"generating vectors from {downloads}...")
         colorgram_documents = list()
         colorgrams_path = get_experiment_colorgrams_path(
             local_data_store=args.local_data_store,
             app_static_path=STATIC,
             name=args.experiment_name,
         )
-        for vector, metadata in get_vectors(downloads):
+        for vector, metadata in vectors:
             # store colorgram images in S3
             s3_put_image(
                 s3_client=s3_client,
@@ -344,6 +385,12 @@ def main(args: argparse.Namespace) -> None:
             input("continue...")
             image.close()
 
+    if args.similar is not None:
+        for distance, source in experiment.similar(
+            args.similar, k=args.top_k, dist_field=args.similarity_dist
+        ):
+            print(f"{distance:.4f}  {json.dumps(source)}")
+
     if args.label:
         if args.unlabeled_data_path is None or args.label_write_path is None:
             raise MissingRequiredArgError(
@@ -359,11 +406,18 @@ def main(args: argparse.Namespace) -> None:
 
     if args.export_vectors_to is not None:
         args.export_vectors_to.parent.mkdir(exist_ok=True, parents=True)
-        vectors = list()
-        for colorgram_document in experiment.colorgrams:
-            del colorgram_document.source["downloads"]
-            vectors.append(colorgram_document.source)
-        args.export_vectors_to.write_text(json.dumps(vectors, indent=2))
+        if args.export_vectors_to.suffix == ".json":
+            vectors = list()
+            for colorgram_document in experiment.colorgrams:
+                del colorgram_document.source["downloads"]
+                vectors.append(colorgram_document.source)
+            args.export_vectors_to.write_text(json.dumps(vectors, indent=2))
+        else:
+            export_colorgrams(
+                (colorgram_document.source for colorgram_document in experiment.colorgrams),
+                path=args.export_vectors_to,
+                expected_rows=experiment.total_colorgrams,
+            )
 
     if args.get_unique_images:
         located_images = 0
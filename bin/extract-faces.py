@@ -1,20 +1,269 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from imgserve.faces import facechop, NotAnImageError
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from tqdm import tqdm
 
-downloads_path = Path("/Volumes/LACIE/compsyn/data/unrest/original")
+from imgserve import LOCAL_DATA_STORE
+from imgserve.api import Experiment
+from imgserve.args import get_elasticsearch_args, get_face_detection_args, get_s3_args
+from imgserve.assemble import get_image_bytes
+from imgserve.clients import get_clients
+from imgserve.dedup import load_face_hash_index, store_cropped_face
+from imgserve.elasticsearch import CROPPED_FACE_INDEX_PATTERN, index_to_elasticsearch
+from imgserve.faces import FaceDetectionPool, extract_faces_many, face_detector_from_args
+from imgserve.logger import simple_logger
 
-extracted_faces = 0
-for query_dir in downloads_path.iterdir():
-    query = query_dir.name
-    for image_path in query_dir.iterdir():
-        try:
-            for face_image in facechop(
-                image_path, downloads_path.parent.joinpath("faces").joinpath(query)
-            ):
-                extracted_faces += 1
-        except NotAnImageError as exc:
-            print(exc)
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png"]
 
-print(f"extracted {extracted_faces} faces")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Extract cropped faces from a folder of images, or from the raw images of an experiment. Interrupted runs resume from a checkpoint file."
+    )
+    sources = parser.add_subparsers(dest="source", required=True)
+
+    local = sources.add_parser(
+        "local", help="crop faces from images under a local folder, to a local folder"
+    )
+    local.add_argument(
+        "--images-path",
+        type=Path,
+        required=True,
+        help="folder to search for images, the folder each image is in is used as its query",
+    )
+    local.add_argument(
+        "--output-path",
+        type=Path,
+        required=True,
+        help="cropped faces are written here, under the same relative folders as their images",
+    )
+
+    experiment = sources.add_parser(
+        "experiment",
+        help="crop faces from the raw images of an experiment, upload them to S3 and index them to cropped-face",
+    )
+    experiment.add_argument("--experiment-name", required=True)
+    experiment.add_argument(
+        "--local-data-store",
+        type=Path,
+        default=LOCAL_DATA_STORE,
+        help="raw images already archived here are not pulled from S3 again",
+    )
+    get_elasticsearch_args(experiment)
+    get_s3_args(experiment)
+
+    for source_parser in [local, experiment]:
+        source_parser.add_argument(
+            "--checkpoint",
+            type=Path,
+            help="file recording processed images, defaults to .extract-faces-checkpoint in --output-path or the experiment's folder of --local-data-store",
+        )
+        source_parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=256,
+            help="images to detect faces in between checkpoints",
+        )
+        source_parser.add_argument(
+            "--download-threads",
+            type=int,
+            default=8,
+            help="threads reading image bytes from S3",
+        )
+        source_parser.add_argument("--dry-run", action="store_true")
+        get_face_detection_args(source_parser)
+
+    return parser.parse_args()
+
+
+def read_checkpoint(checkpoint: Path) -> Set[str]:
+    if not checkpoint.is_file():
+        return set()
+    return set(line for line in checkpoint.read_text().splitlines() if line != "")
+
+
+def write_checkpoint(checkpoint: Path, done: List[str]) -> None:
+    """ record a finished batch, only after its faces have been written or indexed """
+    checkpoint.parent.mkdir(exist_ok=True, parents=True)
+    with open(checkpoint, "a") as f:
+        f.write("".join(f"{key}\n" for key in done))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def batches(items: Iterable[Any], n: int) -> Generator[List[Any], None, None]:
+    batch = list()
+    for item in items:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = list()
+    if len(batch) > 0:
+        yield batch
+
+
+def already_cropped_image_ids(elasticsearch_client: Elasticsearch, experiment_name: str) -> Set[str]:
+    try:
+        return set(
+            hit["_source"]["image_id"]
+            for hit in helpers.scan(
+                elasticsearch_client,
+                index=CROPPED_FACE_INDEX_PATTERN,
+                query={
+                    "query": {"bool": {"filter": [{"term": {"experiment_name": experiment_name}}]}},
+                    "_source": ["image_id"],
+                },
+            )
+        )
+    except NotFoundError:
+        return set()
+
+
+def face_detection_pool(args: argparse.Namespace) -> FaceDetectionPool:
+    """ one pool for the whole run, so its workers load the detector once rather than once per batch """
+    return FaceDetectionPool(
+        face_detector_from_args(args),
+        workers=args.face_detection_workers,
+        detection_cache_path=args.face_detection_cache,
+    )
+
+
+def extract_local(args: argparse.Namespace, log: logging.Logger) -> int:
+    checkpoint = args.checkpoint or args.output_path.joinpath(".extract-faces-checkpoint")
+    done = read_checkpoint(checkpoint)
+    images = sorted(
+        path
+        for path in args.images_path.rglob("*")
+        if path.suffix.lower() in IMAGE_SUFFIXES
+        and str(path.relative_to(args.images_path)) not in done
+    )
+    log.info(f"{len(images)} images to process, {len(done)} already done according to {checkpoint}")
+    if args.dry_run:
+        return 0
+
+    extracted_faces = 0
+    with tqdm(total=len(images), desc="Extracting faces") as pbar, face_detection_pool(args) as pool:
+        for batch in batches(images, args.batch_size):
+            for image, faces in extract_faces_many(batch, skip_errors=True, pool=pool):
+                relative = image.relative_to(args.images_path)
+                output_dir = args.output_path.joinpath(relative.parent)
+                for count, face in enumerate(faces):
+                    output_dir.mkdir(exist_ok=True, parents=True)
+                    output_dir.joinpath(f"{image.stem}-{count}.jpg").write_bytes(face.image)
+                extracted_faces += len(faces)
+                pbar.update(1)
+            write_checkpoint(checkpoint, [str(image.relative_to(args.images_path)) for image in batch])
+    return extracted_faces
+
+
+def extract_experiment(args: argparse.Namespace, log: logging.Logger) -> int:
+    elasticsearch_client, s3_client = get_clients(args)
+    experiment = Experiment(
+        bucket_name=args.s3_bucket,
+        elasticsearch_client=elasticsearch_client,
+        local_data_store=args.local_data_store,
+        name=args.experiment_name,
+        s3_client=s3_client,
+        dry_run=args.dry_run,
+    )
+    checkpoint = args.checkpoint or args.local_data_store.joinpath(args.experiment_name).joinpath(".extract-faces-checkpoint")
+    done = read_checkpoint(checkpoint)
+    # images with faces already indexed were extracted by an earlier run or trial, images without faces only show up in the checkpoint
+    done.update(already_cropped_image_ids(elasticsearch_client, args.experiment_name))
+    log.info(f"{len(done)} images of {args.experiment_name} already processed")
+
+    face_hash_index = None
+    if args.face_dedup:
+        face_hash_index = load_face_hash_index(
+            elasticsearch_client=elasticsearch_client,
+            experiment_name=args.experiment_name,
+            radius=args.face_dedup_hamming_radius,
+        )
+
+    def read_image(raw_image: RawImageDocument) -> Optional[bytes]:
+        return get_image_bytes(
+            s3_client=s3_client,
+            bucket_name=args.s3_bucket,
+            image_path=raw_image.path,
+            local_data_store=args.local_data_store,
+        )
+
+    todo = (
+        raw_image
+        for raw_image in experiment.raw_images
+        if raw_image.source["image_id"] not in done
+    )
+    extracted_faces = 0
+    with tqdm(total=max(0, experiment.total_raw_images - len(done)), desc="Extracting faces") as pbar, ThreadPoolExecutor(
+        max_workers=args.download_threads
+    ) as downloads, face_detection_pool(args) as pool:
+        for batch in batches(todo, args.batch_size):
+            if args.dry_run:
+                pbar.update(len(batch))
+                continue
+            readable = [
+                (raw_image, image_bytes)
+                for raw_image, image_bytes in zip(batch, downloads.map(read_image, batch))
+                if image_bytes is not None
+            ]
+            face_documents = list()
+            detected = extract_faces_many(
+                [image_bytes for raw_image, image_bytes in readable], skip_errors=True, pool=pool
+            )
+            for (raw_image, _), (_, faces) in zip(readable, detected):
+                for count, face in enumerate(faces):
+                    face_doc = {
+                        key: value
+                        for key, value in raw_image.source.items()
+                        if key != "number_of_faces"
+                    }
+                    face_doc.update(
+                        experiment_name=args.experiment_name,
+                        face_id=f"{raw_image.source['image_id']}-{count}",
+                    )
+                    store_cropped_face(
+                        s3_client=s3_client,
+                        bucket_name=args.s3_bucket,
+                        experiment_name=args.experiment_name,
+                        face=face,
+                        face_doc=face_doc,
+                        face_hash_index=face_hash_index,
+                    )
+                    face_documents.append(face_doc)
+                pbar.update(1)
+            pbar.update(len(batch) - len(readable))
+
+            index_to_elasticsearch(
+                elasticsearch_client=elasticsearch_client,
+                index=CROPPED_FACE_INDEX_PATTERN,
+                docs=face_documents,
+                identity_fields=["face_id", "query"],
+                overwrite=False,
+                quiet=True,
+            )
+            extracted_faces += len(face_documents)
+            # unreadable images are checkpointed too, get_image_bytes has already logged them
+            write_checkpoint(checkpoint, [raw_image.source["image_id"] for raw_image in batch])
+    return extracted_faces
+
+
+def main(args: argparse.Namespace) -> None:
+
+    log = simple_logger("imgserve.extract-faces" + (".DRY_RUN" if args.dry_run else ""))
+
+    if args.source == "local":
+        extracted_faces = extract_local(args, log)
+    else:
+        extracted_faces = extract_experiment(args, log)
+
+    log.info(f"extracted {extracted_faces} faces")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -14,6 +14,23 @@ assert (
 ), f"{STATIC} is not a directory, can not use it as source of static assets"
 
 
+def link_static_directory(target: Path, link: Path) -> None:
+    """
+        point the symlink link at the directory target, left alone if it already does
+    """
+    link.parent.mkdir(exist_ok=True, parents=True)
+    if link.is_symlink() and Path(os.readlink(link)) == target:
+        return
+    # made aside and renamed over link, so processes doing this at the same time do not trip over each other
+    tmp_link = link.with_name(f".{link.name}.{os.getpid()}")
+    try:
+        tmp_link.unlink()
+    except FileNotFoundError:
+        pass
+    tmp_link.symlink_to(target, target_is_directory=True)
+    os.replace(tmp_link, link)
+
+
 def get_experiment_colorgrams_path(
     name: str, local_data_store: Path = LOCAL_DATA_STORE, app_static_path: Path = STATIC
 ) -> Path:
@@ -23,38 +40,40 @@ def get_experiment_colorgrams_path(
     experiment_path = local_data_store.joinpath("imgserve/colorgrams").joinpath(name)
     experiment_path.mkdir(exist_ok=True, parents=True)
 
-    app_symlink = app_static_path.joinpath("img/colorgrams")
-    app_symlink.parent.mkdir(exist_ok=True, parents=True)
-    try:
-        app_symlink.unlink()
-    except FileNotFoundError:
-        pass
-
-    app_symlink.symlink_to(experiment_path.parent, target_is_directory=True)
+    link_static_directory(experiment_path.parent, app_static_path.joinpath("img/colorgrams"))
 
     return experiment_path
 
 
+def experiment_csv_path(name: str, local_data_store: Path = LOCAL_DATA_STORE) -> Path:
+    return (
+        local_data_store.joinpath("imgserve/experiments")
+        .joinpath(name)
+        .with_suffix(".csv")
+    )
+
+
+def link_experiment_csvs(
+    local_data_store: Path = LOCAL_DATA_STORE, app_static_path: Path = STATIC
+) -> None:
+    """
+        serve the experiment CSVs in LOCAL_DATA_STORE as static files
+    """
+    link_static_directory(
+        local_data_store.joinpath("imgserve/experiments"),
+        app_static_path.joinpath("csv/experiments"),
+    )
+
+
 def get_experiment_csv_path(
     name: str, local_data_store: Path = LOCAL_DATA_STORE, app_static_path: Path = STATIC
 ) -> Path:
     """
         get path, Try to fetch from master server if missing. manage symlink to LOCAL_DATA_STORE.
     """
-    csv_path = (
-        local_data_store.joinpath("imgserve/experiments")
-        .joinpath(name)
-        .with_suffix(".csv")
-    )
-
-    app_symlink = app_static_path.joinpath("csv/experiments")
-    app_symlink.parent.mkdir(exist_ok=True, parents=True)
-    try:
-        app_symlink.unlink()
-    except FileNotFoundError:
-        pass
+    csv_path = experiment_csv_path(name, local_data_store=local_data_store)
 
-    app_symlink.symlink_to(csv_path.parent, target_is_directory=True)
+    link_experiment_csvs(local_data_store=local_data_store, app_static_path=app_static_path)
 
     if not csv_path.is_file():
         raise FileNotFoundError(csv_path)
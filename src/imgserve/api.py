@@ -4,6 +4,7 @@ import json
 import requests
 import time
 from collections import UserDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from tqdm import tqdm
@@ -24,6 +25,8 @@ from .errors import (
 )
 from .logger import simple_logger
 from .s3 import get_s3_bytes
+from .similarity import ColorgramIndex
+from .utils import atomic_write_bytes
 
 
 class RawImageDocument(UserDict):
@@ -62,6 +65,106 @@ class MturkHitDocument(UserDict):
         self.source = self.doc["_source"]
 
 
+def sync_s3_path(
+    s3_client: botocore.client.s3, bucket_name: str, s3_path: Path, local_path: Path
+) -> Path:
+    """ local_path, downloaded from s3_path first if it is not there yet """
+    if not local_path.is_file():
+        # other threads (and server workers) may be syncing the same path, and serve it as soon as it exists
+        atomic_write_bytes(
+            local_path, get_s3_bytes(s3_client=s3_client, bucket_name=bucket_name, s3_path=s3_path)
+        )
+    return local_path
+
+
+def search_colorgrams(
+    elasticsearch_client: Elasticsearch,
+    word: str,
+    experiment_names: Optional[List[str]] = None,
+    size: int = 1000,
+    debug: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+        The colorgram documents for word across all experiments (or only experiment_names), ordered by experiment_name.
+        Searched size documents at a time, each page continuing after the sort values of the last hit of the one before.
+    """
+    log = simple_logger("imgserve.search_colorgrams")
+    filters = [{"term": {"query.keyword": word}}]
+    if experiment_names is not None:
+        filters.append({"terms": {"experiment_name": list(experiment_names)}})
+    query = {
+        "query": {"bool": {"filter": filters}},
+        # s3_key breaks ties, so no colorgram is skipped or repeated between pages
+        "sort": [{"experiment_name": "asc"}, {"s3_key": "asc"}],
+    }
+    docs = list()
+    while True:
+        page = next(
+            get_response_value(
+                elasticsearch_client=elasticsearch_client,
+                index=COLORGRAMS_INDEX_PATTERN,
+                query=query,
+                value_keys=["hits", "hits"],
+                size=size,
+                debug=debug,
+            ),
+            list(),
+        )
+        docs.extend(page)
+        # a short page is the last one
+        if len(page) < size:
+            break
+        query = dict(query, search_after=page[-1]["sort"])
+    if len(docs) == 0:
+        raise FileNotFoundError(f"\"{word}\" not found in any experiment!")
+    log.info(f"{len(docs)} colorgrams for {word} in {len(set(doc['_source']['experiment_name'] for doc in docs))} experiments")
+    return docs
+
+
+def find_colorgrams(
+    elasticsearch_client: Elasticsearch,
+    s3_client: botocore.client.s3,
+    bucket_name: str,
+    local_data_store: Path,
+    word: str,
+    experiment_names: Optional[List[str]] = None,
+    size: int = 1000,
+    sync_threads: int = 8,
+    debug: bool = False,
+) -> Generator[Tuple[Dict[str, Any], Path], None, None]:
+    """
+        Get the colorgrams for word across all experiments (or only experiment_names), see search_colorgrams.
+        Colorgrams are synced from S3 sync_threads at a time, and yielded in order as (colorgram document, local path) as soon as each is ready.
+    """
+    docs = search_colorgrams(
+        elasticsearch_client=elasticsearch_client,
+        word=word,
+        experiment_names=experiment_names,
+        size=size,
+        debug=debug,
+    )
+
+    def sync(doc: Dict[str, Any]) -> Path:
+        path = ColorgramDocument(doc).path
+        return sync_s3_path(
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            s3_path=path,
+            local_path=local_data_store.joinpath(path),
+        )
+
+    executor = ThreadPoolExecutor(max_workers=sync_threads)
+    futures = [executor.submit(sync, doc) for doc in docs]
+    try:
+        for doc, future in zip(docs, futures):
+            yield doc, future.result()
+    finally:
+        # a caller that stops early does not wait for the remaining syncs
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
 @dataclass
 class Experiment:
     bucket_name: str
@@ -83,19 +186,18 @@ class Experiment:
         self.log = simple_logger(
             f"imgserve.{self.name}" + (f".DRY_RUN" if self.dry_run else "")
         )
+        self._colorgram_indices: Dict[str, ColorgramIndex] = dict()
         self.log.info(f"initialized")
 
     def _sync_s3_path(self, path: Path, local_path: Optional[Path] = None) -> Path:
         if local_path is None:
             local_path = self.local_data_store.joinpath(path)
-        if not local_path.is_file():
-            local_path.parent.mkdir(exist_ok=True, parents=True)
-            local_path.write_bytes(
-                get_s3_bytes(
-                    s3_client=self.s3_client, bucket_name=self.bucket_name, s3_path=path
-                )
-            )
-        return local_path
+        return sync_s3_path(
+            s3_client=self.s3_client,
+            bucket_name=self.bucket_name,
+            s3_path=path,
+            local_path=local_path,
+        )
 
     def _delete_s3_object(self, s3_path: Path) -> None:
         self.s3_client.delete_object(Bucket=self.bucket_name, Key=str(s3_path))
@@ -162,6 +264,27 @@ class Experiment:
 
         self.log.info(f"{count} colorgram for {word}")
 
+    def colorgram_index(self, dist_field: str = "jzazbz_dist") -> ColorgramIndex:
+        """
+            Similarity index over this experiment's colorgram distributions, loaded once per Experiment
+        """
+        if dist_field not in self._colorgram_indices:
+            self.log.info(f"loading {dist_field} of {self.total_colorgrams} colorgrams")
+            self._colorgram_indices[dist_field] = ColorgramIndex(
+                (colorgram_document.source for colorgram_document in self.colorgrams),
+                dist_field=dist_field,
+            )
+        return self._colorgram_indices[dist_field]
+
+    def similar(
+        self, word: str, k: int = 10, dist_field: str = "jzazbz_dist"
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+            The k other words of this experiment whose colour distributions are closest to the colorgram(s) for word, as (Jensen-Shannon divergence, closest colorgram document of that word) pairs
+        """
+        self.log.info(f"finding {k} colorgrams similar to '{word}' by {dist_field}")
+        return self.colorgram_index(dist_field).similar(word, k=k)
+
     def delete(self) -> None:
         self.log.info(f"deleting raw-images from S3...")
         deleted = 0
@@ -335,7 +458,13 @@ class Experiment:
 
 
 class ImgServe:
-    def __init__(self, remote_url: str, username: str = "", password: str = "") -> None:
+    def __init__(
+        self,
+        remote_url: str,
+        username: str = "",
+        password: str = "",
+        cache_path: Optional[Path] = None,
+    ) -> None:
 
         local = remote_url.startswith("http://localhost")
         if not local:
@@ -348,13 +477,25 @@ class ImgServe:
         self.auth = (
             requests.auth.HTTPBasicAuth(username, password) if not local else None
         )
+        # experiment configs are kept here with their ETag, and only downloaded again when they change on the server
+        self.cache_path = cache_path
         self.log = simple_logger("ImgServe" + " local" if local else " remote")
 
     def get_experiment(self, name: str) -> Dict[str, Any]:
+        cached = None
+        headers = dict()
+        if self.cache_path is not None:
+            cached_path = self.cache_path.joinpath(name).with_suffix(".json")
+            if cached_path.is_file():
+                cached = json.loads(cached_path.read_text())
+                headers.update({"If-None-Match": cached["etag"]})
         try:
             response = requests.get(
-                f"{self.remote_url}/experiments/{name}", auth=self.auth
+                f"{self.remote_url}/experiments/{name}", auth=self.auth, headers=headers
             )
+            if response.status_code == 304 and cached is not None:
+                self.log.debug(f"{name} unchanged since it was cached")
+                return cached["experiment"]
             if response.status_code != 200:
                 raise UnexpectedStatusCodeError(
                     f"{response.status_code} from {self.remote_url}: {response.text}"
@@ -365,4 +506,9 @@ class ImgServe:
                 f"connection to {self.remote_url} failed, is it running?"
             ) from e
 
+        if self.cache_path is not None and "ETag" in response.headers:
+            cached_path.parent.mkdir(exist_ok=True, parents=True)
+            cached_path.write_text(
+                json.dumps({"etag": response.headers["ETag"], "experiment": resp})
+            )
         return resp
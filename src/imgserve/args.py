@@ -5,6 +5,13 @@ import socket
 from pathlib import Path
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
 def get_elasticsearch_args(
     parser: Optional[argparse.ArgumentParser] = None,
 ) -> argparse.ArgumentParser:
@@ -217,6 +224,11 @@ def get_experiment_args(
         type=str,
         help="Get and display colorgram for the provided query term from this experiment name",
     )
+    mode.add_argument(
+        "--similar",
+        type=str,
+        help="Show queries from this experiment name with colour distributions closest to the provided query term",
+    )
     mode.add_argument(
         "--pull",
         action="store_true",
@@ -235,7 +247,7 @@ def get_experiment_args(
     mode.add_argument(
         "--export-vectors-to",
         type=Path,
-        help="export colorgram documents as a JSON list",
+        help="export colorgram documents, as a JSON list if the path ends in .json, or as columnar arrays if it ends in .npz (see imgserve.export.load_colorgrams)",
     )
     mode.add_argument(
         "--get-unique-images",
@@ -299,6 +311,27 @@ def get_experiment_args(
         action="store_true",
         help="Take no action, but show what would happen",
     )
+    experiment_parser.add_argument(
+        "--max-images-per-group",
+        type=positive_int,
+        help="With --dimensions, use a deterministic sample (seeded by the colorgram slug) of at most this many images for each combination of dimension values. sample_size and total_images are recorded on each colorgram document",
+    )
+    experiment_parser.add_argument(
+        "--stream-images",
+        action="store_true",
+        help="With --dimensions, compute vectors from image bytes as they are read from the local archive or S3, instead of assembling a 'downloads' folder first",
+    )
+    experiment_parser.add_argument(
+        "--analysis-resolution",
+        type=positive_int,
+        default=300,
+        help="Images are decoded to this (square) size before colour distributions are computed. Colorgrams are always rendered at 300x300",
+    )
+    experiment_parser.add_argument(
+        "--draft-decode",
+        action="store_true",
+        help="Downscale JPEGs in draft mode (DCT-domain) while decoding, faster than the default full decode but colour distributions differ slightly, see bin/benchmark-decode.py",
+    )
     experiment_parser.add_argument(
         "--force-remote-pull",
         default=False,
@@ -320,6 +353,18 @@ def get_experiment_args(
         action="store_true",
         help="provide additional output to help debug queries, etc",
     )
+    experiment_parser.add_argument(
+        "--top-k",
+        type=int,
+        default=10,
+        help="number of results to show for --similar",
+    )
+    experiment_parser.add_argument(
+        "--similarity-dist",
+        choices=["jzazbz_dist", "rgb_dist"],
+        default="jzazbz_dist",
+        help="colour distribution to compare for --similar",
+    )
     experiment_parser.add_argument(
         "--unlabeled-data-path",
         type=Path,
@@ -373,10 +418,95 @@ def get_imgserve_args(
         action="store_false",
         help="Extract faces from raw images and store in their own index in Elasticsearch",
     )
-    imgserve_parser.add_argument(
+    get_face_detection_args(parser)
+    return parser
+
+
+def get_face_detection_args(
+    parser: Optional[argparse.ArgumentParser] = None,
+) -> argparse.ArgumentParser:
+
+    if parser is None:
+        parser = argparse.ArgumentParser()
+
+    face_parser = parser.add_argument_group("face detection")
+
+    face_parser.add_argument(
+        "--face-detector",
+        choices=["haar", "lbp", "dnn"],
+        default="haar",
+        help="face detection backend: haar or lbp cascades (XML from IMGSERVE_FACE_CLASSIFIER_XML, IMGSERVE_LBP_CLASSIFIER_XML or --face-detector-model), or an OpenCV DNN single shot detector from --face-detector-model"
+    )
+    face_parser.add_argument(
+        "--face-detector-model",
+        type=Path,
+        help="cascade XML, or DNN model file (e.g. a .caffemodel, .onnx or .pb) for --face-detector dnn"
+    )
+    face_parser.add_argument(
+        "--face-detector-config",
+        type=Path,
+        help="DNN network config (e.g. deploy.prototxt), if the model format needs one"
+    )
+    face_parser.add_argument(
+        "--dnn-confidence",
+        type=float,
+        default=0.5,
+        help="minimum confidence of faces detected by --face-detector dnn"
+    )
+    face_parser.add_argument(
         "--cv2-cascade-min-neighbors",
         type=int,
         default=5,
         help="minNeighbors hyperparameter for cv2 haarcascade based face classification"
     )
+    face_parser.add_argument(
+        "--cv2-cascade-scale-factor",
+        type=float,
+        default=1.1,
+        help="scaleFactor hyperparameter for cv2 haarcascade based face classification"
+    )
+    face_parser.add_argument(
+        "--cv2-cascade-min-size",
+        type=int,
+        default=0,
+        help="minSize (square, in pixels of the original image) hyperparameter for cv2 haarcascade based face classification"
+    )
+    face_parser.add_argument(
+        "--fast-face-detection",
+        action="store_true",
+        help="detect faces on a downscaled grayscale copy of each image, much faster for large images but may miss small faces"
+    )
+    face_parser.add_argument(
+        "--face-detection-height",
+        type=positive_int,
+        default=720,
+        help="with --fast-face-detection, images taller than this are downscaled to it for detection. Lower is faster but misses more small faces, compare heights with bin/benchmark-faces.py"
+    )
+    face_parser.add_argument(
+        "--face-detection-equalize-hist",
+        action="store_true",
+        help="with --fast-face-detection, equalize the histogram of the grayscale image before detection"
+    )
+    face_parser.add_argument(
+        "--face-dedup",
+        action="store_true",
+        help="faces that are near-duplicates of a face already cropped for the experiment reuse its face_id instead of being uploaded again. Scans the experiment's cropped faces once at startup"
+    )
+    face_parser.add_argument(
+        "--face-dedup-hamming-radius",
+        type=int,
+        default=4,
+        help="with --face-dedup, faces whose 64 bit perceptual hash is within this many bits of an earlier face are near-duplicates of it"
+    )
+    face_parser.add_argument(
+        "--face-detection-cache",
+        type=Path,
+        default=os.getenv("IMGSERVE_FACE_DETECTION_CACHE", None),
+        help="sqlite file to cache detected face boxes in, keyed by image content, classifier and detection parameters, so re-runs only re-detect what changed"
+    )
+    face_parser.add_argument(
+        "--face-detection-workers",
+        type=int,
+        help="number of processes to run face detection in, defaults to the number of CPUs"
+    )
     return parser
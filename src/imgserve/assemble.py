@@ -7,11 +7,23 @@ from collections import defaultdict
 from pathlib import Path
 from tqdm import tqdm
 
+import botocore.exceptions
 from elasticsearch import Elasticsearch, helpers
+from retry import retry
 
 from .elasticsearch import RAW_IMAGES_INDEX_PATTERN, all_field_values
-from .errors import NoImagesInElasticsearchError, NoQueriesGatheredError
+from .errors import NoImagesInElasticsearchError, NoQueriesGatheredError, S3Error
 from .logger import simple_logger
+from .utils import reservoir_sample
+
+# ClientError codes that may succeed on another attempt, other client errors (NoSuchKey, AccessDenied, ...) are raised at once
+S3_TRANSIENT_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestTimeout", "RequestTimeTooSkewed"}
+# S3 errors worth another attempt before an image is skipped
+S3_RETRY_EXCEPTIONS = (
+    S3Error,
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.ReadTimeoutError,
+)
 
 """
   Assemble image data
@@ -58,33 +70,25 @@ def recursively_combine(
             yield (slug, query)
 
 
-def assemble_downloads(
+def image_path_id(image_path: Path) -> str:
+    return str(image_path.relative_to("data"))
+
+
+def gather_image_paths(
     elasticsearch_client: Elasticsearch,
-    s3_client: botocore.clients.S3,
-    bucket_name: str,
     trial_ids: List[str],
-    experiment_name: str,
     dimensions: List[str],
-    local_data_store: Path,
-    dry_run: bool = False,
-    force_remote_pull: bool = False,
-    prompt: bool = True,
-) -> Path:
+    max_images_per_group: Optional[int] = None,
+) -> Tuple[Dict[str, List[Path]], Dict[str, Dict[str, int]]]:
     """
-        Assemble a "downloads" folder for compsyn to run on.
-        Data may already exist locally, or can be gathered from S3.
-        In either case, Elasticsearch is used as the source of truth for gathering the required images.
+        Use Elasticsearch as the source of truth for the images required for each combination of dimension values.
+        Returns S3 paths of the images keyed by colorgram slug, and sampling metadata for each slug.
+        With max_images_per_group, larger groups are reservoir sampled (seeded by slug) while they are scanned,
+        the sampling metadata records "sample_size" and "total_images" for each group so they can be stored on its colorgram document.
     """
-    log = simple_logger(
-        "imgserve.assemble_downloads" + (f".DRY_RUN" if dry_run else "")
-    )
+    log = simple_logger("imgserve.gather_image_paths")
     log.info("enumerating images from elasticsearch")
 
-    downloads_path = local_data_store.joinpath(experiment_name).joinpath("downloads")
-
-    global ELASTICSEARCH_CLIENT
-    ELASTICSEARCH_CLIENT = elasticsearch_client
-
     # query elasticsearch to assemble a list of required images
     if len(trial_ids) >= 0:
         shared_filter = {"terms": {"trial_id": trial_ids}}
@@ -114,32 +118,46 @@ def assemble_downloads(
             f"no queries could be generated for field values {field_values}!"
         )
 
+    def scan_paths(query: Dict[str, Any]) -> Generator[Path, None, None]:
+        for image_doc in helpers.scan(
+            elasticsearch_client, index=RAW_IMAGES_INDEX_PATTERN, query=query
+        ):
+            source = image_doc["_source"]
+            try:
+                relative_image_path = (
+                    Path("data")
+                    .joinpath(source["trial_id"])
+                    .joinpath(source["hostname"])
+                    .joinpath(source["query"].replace(" ", "_"))
+                    .joinpath(source["trial_timestamp"])
+                    .joinpath("images")
+                    .joinpath(source["image_id"])
+                    .with_suffix(".jpg")
+                )
+                yield relative_image_path
+            except KeyError as e:
+                print(image_doc)
+                print(e)
+
     image_directories: Dict[str, List[Path]] = dict()
+    sampling: Dict[str, Dict[str, int]] = dict()
     with tqdm(total=len(queries), desc="(step 1/2) Query") as pbar:
         for slug, query in queries:
             if shared_filter is not None:
                 query["query"]["bool"]["filter"].append(shared_filter)
-            paths = list()
-            for image_doc in helpers.scan(
-                ELASTICSEARCH_CLIENT, index=RAW_IMAGES_INDEX_PATTERN, query=query
-            ):
-                source = image_doc["_source"]
-                try:
-                    relative_image_path = (
-                        Path("data")
-                        .joinpath(source["trial_id"])
-                        .joinpath(source["hostname"])
-                        .joinpath(source["query"].replace(" ", "_"))
-                        .joinpath(source["trial_timestamp"])
-                        .joinpath("images")
-                        .joinpath(source["image_id"])
-                        .with_suffix(".jpg")
-                    )
-                    paths.append(relative_image_path)
-                except KeyError as e:
-                    print(image_doc)
-                    print(e)
-            image_directories[slug] = paths
+            if max_images_per_group is None:
+                image_directories[slug] = list(scan_paths(query))
+            else:
+                paths, total = reservoir_sample(
+                    scan_paths(query),
+                    k=max_images_per_group,
+                    seed=slug,
+                    key=image_path_id,
+                )
+                if total > len(paths):
+                    log.debug(f"sampled {len(paths)} of {total} images for {slug}")
+                image_directories[slug] = paths
+                sampling[slug] = {"sample_size": len(paths), "total_images": total}
             pbar.update(1)
 
     total_images = sum([len(image_paths) for image_paths in image_directories.values()])
@@ -148,6 +166,113 @@ def assemble_downloads(
             f"{json.dumps(queries, indent=2)}\n  0 images available for assembly from 'raw-images' according to the above query. Has this trial been indexed?"
         )
 
+    return image_directories, sampling
+
+
+@retry(exceptions=S3_RETRY_EXCEPTIONS, tries=3, backoff=2, delay=1)
+def read_s3_object(s3_client: botocore.clients.S3, bucket_name: str, key: str) -> bytes:
+    try:
+        return s3_client.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+    except botocore.exceptions.ClientError as exc:
+        error = exc.response.get("Error", dict())
+        status = exc.response.get("ResponseMetadata", dict()).get("HTTPStatusCode", 0)
+        if error.get("Code") in S3_TRANSIENT_ERROR_CODES or status >= 500:
+            raise S3Error(f"transient S3 error reading {key}: {exc}") from exc
+        raise
+
+
+def get_image_bytes(
+    s3_client: botocore.clients.S3,
+    bucket_name: str,
+    image_path: Path,
+    local_data_store: Path,
+    force_remote_pull: bool = False,
+) -> Optional[bytes]:
+    """
+        Bytes of a raw image, from the local archive if we have it, otherwise from S3 (archiving a copy locally).
+    """
+    relative_path = image_path.relative_to("data")
+    archive_path = local_data_store.joinpath(relative_path.parts[0]).joinpath(
+        relative_path
+    )
+    if archive_path.is_file() and not force_remote_pull:
+        return archive_path.read_bytes()
+
+    try:
+        image_bytes = read_s3_object(
+            s3_client=s3_client, bucket_name=bucket_name, key=str(image_path)
+        )
+    except S3_RETRY_EXCEPTIONS as exc:
+        simple_logger("imgserve.get_image_bytes").error(
+            f"could not read {image_path} from S3, skipping. {exc}"
+        )
+        return None
+    archive_path.parent.mkdir(exist_ok=True, parents=True)
+    archive_path.write_bytes(image_bytes)
+    return image_bytes
+
+
+def stream_images(
+    s3_client: botocore.clients.S3,
+    bucket_name: str,
+    image_directories: Dict[str, List[Path]],
+    local_data_store: Path,
+    force_remote_pull: bool = False,
+) -> Generator[Tuple[str, str, bytes], None, None]:
+    """
+        Stream (slug, image_id, image bytes) for imgserve.vectors.get_vectors_from_images, without assembling a "downloads" folder.
+    """
+    total_images = sum([len(image_paths) for image_paths in image_directories.values()])
+    with tqdm(total=total_images, desc="(step 2/2) Stream") as pbar:
+        for slug, image_paths in image_directories.items():
+            for image_path in image_paths:
+                image_bytes = get_image_bytes(
+                    s3_client=s3_client,
+                    bucket_name=bucket_name,
+                    image_path=image_path,
+                    local_data_store=local_data_store,
+                    force_remote_pull=force_remote_pull,
+                )
+                pbar.update(1)
+                if image_bytes is not None:
+                    yield slug, image_path.stem, image_bytes
+
+
+def assemble_downloads(
+    elasticsearch_client: Elasticsearch,
+    s3_client: botocore.clients.S3,
+    bucket_name: str,
+    trial_ids: List[str],
+    experiment_name: str,
+    dimensions: List[str],
+    local_data_store: Path,
+    dry_run: bool = False,
+    force_remote_pull: bool = False,
+    prompt: bool = True,
+    image_directories: Optional[Dict[str, List[Path]]] = None,
+    max_images_per_group: Optional[int] = None,
+) -> Path:
+    """
+        Assemble a "downloads" folder for compsyn to run on.
+        Data may already exist locally, or can be gathered from S3.
+        In either case, Elasticsearch is used as the source of truth for gathering the required images.
+    """
+    log = simple_logger(
+        "imgserve.assemble_downloads" + (f".DRY_RUN" if dry_run else "")
+    )
+
+    downloads_path = local_data_store.joinpath(experiment_name).joinpath("downloads")
+
+    if image_directories is None:
+        # sampling metadata belongs on colorgram documents, callers that need it gather image paths themselves
+        image_directories, _ = gather_image_paths(
+            elasticsearch_client=elasticsearch_client,
+            trial_ids=trial_ids,
+            dimensions=dimensions,
+            max_images_per_group=max_images_per_group,
+        )
+    total_images = sum([len(image_paths) for image_paths in image_directories.values()])
+
     if not dry_run:
         log.info("downloading images from S3")
         if downloads_path.is_dir():
@@ -168,28 +293,19 @@ def assemble_downloads(
         with tqdm(total=total_images, desc="(step 2/2) Download") as pbar:
             for slug, image_paths in image_directories.items():
                 images_directory = downloads_path.joinpath(slug)
+                images_directory.mkdir(exist_ok=True, parents=True)
                 for image_path in image_paths:
-                    # if we already have the .zip archive at this path, don't retrieve from s3
-                    relative_path = image_path.relative_to("data")
-                    archive_path = local_data_store.joinpath(
-                        relative_path.parts[0]
-                    ).joinpath(relative_path)
-                    image_assembly_path = images_directory.joinpath(image_path.name)
-                    image_assembly_path.parent.mkdir(exist_ok=True, parents=True)
-                    if archive_path.is_file() and not force_remote_pull:
-                        image_assembly_path.write_bytes(archive_path.read_bytes())
-                    else:
-                        image_obj = s3_client.get_object(
-                            Bucket=bucket_name, Key=str(image_path)
-                        )
-                        archive_path.parent.mkdir(exist_ok=True, parents=True)
-                        try:
-                            archive_path.write_bytes(image_obj["Body"].read())
-                        except botocore.exceptions.ReadTimeoutError as exc:
-                            # TODO retry logic
-                            log.error(f"S3 read timeout, skipping. {exc}")
+                    # if we already have the image archived locally, don't retrieve from s3
+                    image_bytes = get_image_bytes(
+                        s3_client=s3_client,
+                        bucket_name=bucket_name,
+                        image_path=image_path,
+                        local_data_store=local_data_store,
+                        force_remote_pull=force_remote_pull,
+                    )
+                    if image_bytes is not None:
                         images_directory.joinpath(image_path.name).write_bytes(
-                            archive_path.read_bytes()
+                            image_bytes
                         )
                     pbar.update(1)
     log.info(f"{total_images} image paths gathered")
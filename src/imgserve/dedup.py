@@ -0,0 +1,131 @@
+from __future__ import annotations
+import io
+from pathlib import Path
+
+import imagehash
+import numpy as np
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from PIL import Image
+
+from .elasticsearch import CROPPED_FACE_INDEX_PATTERN
+from .logger import simple_logger
+from .s3 import s3_put_image
+
+
+def face_hash(image: bytes) -> str:
+    """ 64 bit perceptual hash of an encoded image, as 16 hex characters """
+    return str(imagehash.phash(Image.open(io.BytesIO(image))))
+
+
+def hamming_distances(hashes: np.ndarray, target: int) -> np.ndarray:
+    """ number of differing bits between each uint64 in hashes and target """
+    differing = np.bitwise_xor(hashes, np.uint64(target))
+    return np.unpackbits(differing.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class FaceHashIndex:
+    """
+        Near-duplicate lookup over the perceptual hashes of cropped faces.
+        Hashes are held as one growing uint64 array, a lookup is a single vectorized Hamming distance against every face.
+    """
+
+    def __init__(self, radius: int = 4) -> None:
+        self.radius = radius
+        self.hashes = np.zeros(64, dtype=np.uint64)
+        self.face_ids: List[str] = list()
+
+    def __len__(self) -> int:
+        return len(self.face_ids)
+
+    def add(self, hex_hash: str, face_id: str) -> None:
+        if len(self.face_ids) >= self.hashes.shape[0]:
+            self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+        self.hashes[len(self.face_ids)] = np.uint64(int(hex_hash, 16))
+        self.face_ids.append(face_id)
+
+    def lookup(self, hex_hash: str) -> Optional[Tuple[str, int]]:
+        """ (face_id, distance) of the closest known face within radius of hex_hash, if there is one """
+        if len(self.face_ids) == 0:
+            return None
+        distances = hamming_distances(self.hashes[: len(self.face_ids)], int(hex_hash, 16))
+        closest = int(np.argmin(distances))
+        if distances[closest] > self.radius:
+            return None
+        return self.face_ids[closest], int(distances[closest])
+
+    @classmethod
+    def from_documents(
+        cls, documents: Iterable[Dict[str, Any]], radius: int = 4
+    ) -> FaceHashIndex:
+        index = cls(radius=radius)
+        seen = set()
+        for document in documents:
+            if document.get("face_hash") is None or document["face_id"] in seen:
+                continue
+            seen.add(document["face_id"])
+            index.add(document["face_hash"], document["face_id"])
+        return index
+
+
+def load_face_hash_index(
+    elasticsearch_client: Elasticsearch, experiment_name: str, radius: int = 4
+) -> FaceHashIndex:
+    """
+        Index the hashes of every face already cropped for experiment_name, faces indexed before face_hash was recorded are not included
+    """
+    log = simple_logger("imgserve.load_face_hash_index")
+    try:
+        index = FaceHashIndex.from_documents(
+            (
+                hit["_source"]
+                for hit in helpers.scan(
+                    elasticsearch_client,
+                    index=CROPPED_FACE_INDEX_PATTERN,
+                    query={
+                        "query": {
+                            "bool": {"filter": [{"term": {"experiment_name": experiment_name}}]}
+                        },
+                        "_source": ["face_id", "face_hash"],
+                    },
+                )
+            ),
+            radius=radius,
+        )
+    except NotFoundError:
+        # no faces have been cropped yet
+        index = FaceHashIndex(radius=radius)
+    log.info(f"loaded hashes of {len(index)} cropped faces from {experiment_name}")
+    return index
+
+
+def store_cropped_face(
+    s3_client: botocore.clients.s3,
+    bucket_name: str,
+    experiment_name: str,
+    face: FaceCrop,
+    face_doc: Dict[str, Any],
+    face_hash_index: Optional[FaceHashIndex] = None,
+) -> None:
+    """
+        Upload a cropped face to <experiment_name>/faces/<face_id>.jpg and record its face_hash on face_doc.
+        A face within the radius of face_hash_index instead takes the face_id of the face already stored,
+        so no new S3 object (or mturk HIT, for a query that already returned it) is created.
+    """
+    face_doc.update(face_hash=face_hash(face.image))
+    duplicate = None
+    if face_hash_index is not None:
+        duplicate = face_hash_index.lookup(face_doc["face_hash"])
+    if duplicate is not None:
+        simple_logger("imgserve.store_cropped_face").debug(f"{face_doc['face_id']} is a duplicate of {duplicate[0]}")
+        face_doc.update(face_id=duplicate[0], face_hash_distance=duplicate[1])
+        return
+    s3_put_image(
+        s3_client=s3_client,
+        image=face.image,
+        bucket=bucket_name,
+        object_path=Path(experiment_name).joinpath("faces").joinpath(face_doc["face_id"]).with_suffix(".jpg"), # each unique face will have it's image bytes stored one time.
+        overwrite=False,
+    )
+    if face_hash_index is not None:
+        face_hash_index.add(face_doc["face_hash"], face_doc["face_id"])
@@ -60,3 +60,7 @@ class NoQueriesGatheredError(Exception):
 
 class S3Error(Exception):
     pass
+
+
+class DependencyTimeoutError(Exception):
+    pass
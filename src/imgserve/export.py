@@ -0,0 +1,124 @@
+from __future__ import annotations
+from pathlib import Path
+
+import numpy as np
+
+from .logger import simple_logger
+
+# per-bin fields of colorgram documents, exported as fixed-width float arrays
+ARRAY_FIELDS = ["rgb_dist", "jzazbz_dist", "rgb_dist_std", "jzazbz_dist_std"]
+ARRAY_PREFIX = "array."
+METADATA_PREFIX = "metadata."
+
+
+class ColumnarExport:
+    """
+        Accumulate colorgram documents into columns one document at a time.
+        Distribution fields are written straight into preallocated float32 matrices (one row per colorgram), other scalar fields are kept as a metadata table.
+    """
+
+    def __init__(self, expected_rows: int = 0) -> None:
+        self.rows = 0
+        self.capacity = max(expected_rows, 1)
+        self.arrays: Dict[str, np.ndarray] = dict()
+        self.metadata: List[Dict[str, Any]] = list()
+
+    def _grow(self) -> None:
+        self.capacity *= 2
+        for field, array in self.arrays.items():
+            grown = np.full((self.capacity, array.shape[1]), np.nan, dtype=np.float32)
+            grown[: array.shape[0]] = array
+            self.arrays[field] = grown
+
+    def append(self, document: Dict[str, Any]) -> None:
+        if self.rows >= self.capacity:
+            self._grow()
+        for field in ARRAY_FIELDS:
+            values = document.get(field)
+            if values is None:
+                continue
+            if field not in self.arrays:
+                self.arrays[field] = np.full(
+                    (self.capacity, len(values)), np.nan, dtype=np.float32
+                )
+            array = self.arrays[field]
+            if len(values) != array.shape[1]:
+                raise ValueError(
+                    f"{field} of {document.get('s3_key')} has {len(values)} bins, expected {array.shape[1]}"
+                )
+            array[self.rows] = [np.nan if value is None else value for value in values]
+        self.metadata.append(
+            {
+                key: value
+                for key, value in document.items()
+                if key not in ARRAY_FIELDS and not isinstance(value, (list, dict))
+            }
+        )
+        self.rows += 1
+
+    def metadata_columns(self) -> Dict[str, np.ndarray]:
+        keys = sorted(set(key for row in self.metadata for key in row.keys()))
+        columns = dict()
+        for key in keys:
+            values = [row.get(key) for row in self.metadata]
+            present = [value for value in values if value is not None]
+            if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+                if len(present) < len(values):
+                    # documents without a numeric field (e.g. unsampled groups) are NaN in its column
+                    columns[key] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+                else:
+                    columns[key] = np.array(values)
+            else:
+                columns[key] = np.array(["" if value is None else str(value) for value in values])
+        return columns
+
+    def save(self, path: Path) -> None:
+        columns = {
+            ARRAY_PREFIX + field: array[: self.rows] for field, array in self.arrays.items()
+        }
+        columns.update(
+            {
+                METADATA_PREFIX + key: column
+                for key, column in self.metadata_columns().items()
+            }
+        )
+        # uncompressed, so arrays load with a single read and no decoding
+        with open(path, "wb") as f:
+            np.savez(f, **columns)
+
+
+def export_colorgrams(
+    documents: Iterable[Dict[str, Any]], path: Path, expected_rows: int = 0
+) -> int:
+    """
+        Write colorgram document sources to path as an .npz file, see load_colorgrams
+    """
+    if path.suffix != ".npz":
+        raise ValueError(f"colorgrams are exported as .npz files, not {path.suffix or path.name}")
+    log = simple_logger("imgserve.export_colorgrams")
+    export = ColumnarExport(expected_rows=expected_rows)
+    for document in documents:
+        export.append(document)
+    export.save(path)
+    log.info(
+        f"exported {export.rows} colorgrams ({path.stat().st_size/1000000:.1f} MB) to {path}"
+    )
+    return export.rows
+
+
+def load_colorgrams(
+    path: Path,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """
+        Load an export written by export_colorgrams as (metadata, arrays).
+        metadata maps each scalar document field to a column, arrays maps each distribution field to an (n_colorgrams, n_bins) float32 matrix, missing bins are NaN.
+    """
+    metadata = dict()
+    arrays = dict()
+    with np.load(path, allow_pickle=False) as export:
+        for name in export.files:
+            if name.startswith(ARRAY_PREFIX):
+                arrays[name[len(ARRAY_PREFIX) :]] = export[name]
+            elif name.startswith(METADATA_PREFIX):
+                metadata[name[len(METADATA_PREFIX) :]] = export[name]
+    return metadata, arrays
@@ -1,17 +1,28 @@
 from __future__ import annotations
 
+import abc
+import hashlib
+import json
 import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 import cv2
+import numpy as np
 
+from .errors import MissingArgumentsError
 from .logger import simple_logger
 
 
 FACE_CLASSIFIER_XML = os.getenv("IMGSERVE_FACE_CLASSIFIER_XML", "haarcascade_frontalface_alt.xml")
-assert Path(FACE_CLASSIFIER_XML).is_file(), f"{FACE_CLASSIFIER_XML} is not a file!"
-
-FACE_CLASSIFIER = cv2.CascadeClassifier(FACE_CLASSIFIER_XML)
+LBP_CLASSIFIER_XML = os.getenv("IMGSERVE_LBP_CLASSIFIER_XML", "lbpcascade_frontalface_improved.xml")
+# fast mode detection height, from bin/benchmark-faces.py over tests/faces with haar: 720 is 3.3x faster than full resolution
+# and 1.5x faster than 1024 (which only downscales the largest images), keeping 18 of the 22 faces with 0.90 agreement F1.
+# Crowds of small faces lose the most (5to10-faces.jpg finds 3), 480 halves the time again but keeps only 15 faces.
+FAST_DETECTION_HEIGHT = 720
 
 
 class NotAnImageError(Exception):
@@ -25,34 +36,545 @@ def scale_image(img: cv2.Image, target_height: int = 500) -> cv2.Image:
     return cv2.resize(img, (int(height_ratio*width), int(height_ratio*height)), interpolation = cv2.INTER_CUBIC)
 
 
-def facechop(image: Path, output_dir: Path, face_classifier: cv2.CascadeClassifier = FACE_CLASSIFIER, cv2_cascade_min_neighbors: int = 5) -> Generator[Path, None, None]:
+def detect_faces(
+    img: np.ndarray,
+    face_classifier: cv2.CascadeClassifier,
+    cv2_cascade_min_neighbors: int = 5,
+    scale_factor: float = 1.1,
+    min_size: Tuple[int, int] = (0, 0),
+    fast: bool = False,
+    detection_height: int = FAST_DETECTION_HEIGHT,
+    equalize_hist: bool = False,
+) -> Tuple[np.ndarray, float]:
+    """
+        Detect faces in a BGR image, returns (boxes as (x, y, w, h) rows in img coordinates, detection seconds).
+        With fast, detection runs on a grayscale copy downscaled to at most detection_height (optionally histogram equalized),
+        min_size is in img coordinates either way.
+    """
+    start = time.perf_counter()
+    if not fast:
+        faces = face_classifier.detectMultiScale(
+            img, scaleFactor=scale_factor, minNeighbors=cv2_cascade_min_neighbors, minSize=min_size
+        )
+        return np.array(faces, dtype=int).reshape(-1, 4), time.perf_counter() - start
 
-    if not image.is_file():
-        raise FileNotFoundError(image)
+    height, width = img.shape[:2]
+    frame = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    scale = min(1.0, detection_height / height)
+    if scale < 1.0:
+        frame = cv2.resize(frame, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    if equalize_hist:
+        frame = cv2.equalizeHist(frame)
+    faces = face_classifier.detectMultiScale(
+        frame,
+        scaleFactor=scale_factor,
+        minNeighbors=cv2_cascade_min_neighbors,
+        minSize=tuple(int(v * scale) for v in min_size),
+    )
+    faces = np.array(faces, dtype=float).reshape(-1, 4) / scale
+    # map boxes back to full resolution, clipped to the image
+    faces = np.round(faces).astype(int)
+    faces[:, 0] = np.clip(faces[:, 0], 0, width - 1)
+    faces[:, 1] = np.clip(faces[:, 1], 0, height - 1)
+    faces[:, 2] = np.minimum(faces[:, 2], width - faces[:, 0])
+    faces[:, 3] = np.minimum(faces[:, 3], height - faces[:, 1])
+    return faces, time.perf_counter() - start
 
-    log = simple_logger("imgserve.facechop")
 
-    img = cv2.imread(str(image))
+class FaceDetector(abc.ABC):
+    """
+        A face detection backend. Detectors only hold model paths and parameters, so they pickle cheaply to worker processes,
+        the model itself is loaded on first use, once in each process.
+    """
+
+    name = "detector"
+
+    def __init__(self, model_files: List[Union[str, Path]]) -> None:
+        self.model_files = [Path(model_file) for model_file in model_files]
+        for model_file in self.model_files:
+            if not model_file.is_file():
+                raise FileNotFoundError(f"{model_file} is not a file!")
+        self._model = None
+        self._model_hash = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        state["_model"] = None
+        return state
+
+    @property
+    def model(self) -> Any:
+        if self._model is None:
+            self._model = self.load()
+        return self._model
+
+    @property
+    def model_hash(self) -> str:
+        """ identifies the backend and its model files, for DetectionCache keys """
+        if self._model_hash is None:
+            m = hashlib.sha256(self.name.encode("utf-8"))
+            for model_file in self.model_files:
+                m.update(model_file.read_bytes())
+            self._model_hash = m.hexdigest()
+        return self._model_hash
+
+    @property
+    def params_key(self) -> str:
+        """ canonical form of the parameters that change the boxes detected, for DetectionCache keys """
+        return json.dumps(self.params(), sort_keys=True)
+
+    @abc.abstractmethod
+    def load(self) -> Any:
+        """ the model, from model_files """
+
+    @abc.abstractmethod
+    def params(self) -> Dict[str, Any]:
+        """ the parameters that change the boxes detected """
+
+    @abc.abstractmethod
+    def boxes(self, img: np.ndarray) -> np.ndarray:
+        """ boxes as (x, y, w, h) rows in img coordinates, for a BGR image """
+
+    def detect(self, img: np.ndarray) -> Tuple[np.ndarray, float]:
+        """ (boxes as (x, y, w, h) rows in img coordinates, detection seconds) for a BGR image """
+        model = self.model  # loading is not part of detection time
+        start = time.perf_counter()
+        boxes = self.boxes(img)
+        return boxes, time.perf_counter() - start
+
+
+class CascadeDetector(FaceDetector):
+    """ OpenCV cascade classifier, see detect_faces for the parameters """
+
+    name = "haar"
+
+    def __init__(
+        self,
+        xml: Union[str, Path] = FACE_CLASSIFIER_XML,
+        cv2_cascade_min_neighbors: int = 5,
+        scale_factor: float = 1.1,
+        min_size: Tuple[int, int] = (0, 0),
+        fast: bool = False,
+        detection_height: int = FAST_DETECTION_HEIGHT,
+        equalize_hist: bool = False,
+    ) -> None:
+        super().__init__([xml])
+        self.cv2_cascade_min_neighbors = cv2_cascade_min_neighbors
+        self.scale_factor = scale_factor
+        self.min_size = tuple(min_size)
+        self.fast = fast
+        self.detection_height = detection_height
+        self.equalize_hist = equalize_hist
+
+    def load(self) -> cv2.CascadeClassifier:
+        face_classifier = cv2.CascadeClassifier(str(self.model_files[0]))
+        if face_classifier.empty():
+            raise ValueError(f"{self.model_files[0]} is not a cascade classifier")
+        return face_classifier
+
+    def params(self) -> Dict[str, Any]:
+        params = {
+            "min_neighbors": self.cv2_cascade_min_neighbors,
+            "scale_factor": self.scale_factor,
+            "min_size": list(self.min_size),
+            "fast": self.fast,
+        }
+        if self.fast:
+            params.update(detection_height=self.detection_height, equalize_hist=self.equalize_hist)
+        return params
+
+    def boxes(self, img: np.ndarray) -> np.ndarray:
+        faces, _ = detect_faces(
+            img,
+            self.model,
+            cv2_cascade_min_neighbors=self.cv2_cascade_min_neighbors,
+            scale_factor=self.scale_factor,
+            min_size=self.min_size,
+            fast=self.fast,
+            detection_height=self.detection_height,
+            equalize_hist=self.equalize_hist,
+        )
+        return faces
+
+
+class LBPCascadeDetector(CascadeDetector):
+    """ local binary pattern cascade, faster than haar features at some cost in recall, the XML is not shipped with opencv-python """
+
+    name = "lbp"
+
+    def __init__(self, xml: Union[str, Path] = LBP_CLASSIFIER_XML, **kwargs: Any) -> None:
+        super().__init__(xml, **kwargs)
+
+
+class DNNDetector(FaceDetector):
+    """
+        Single shot detector run with cv2.dnn, from a locally supplied model (e.g. res10_300x300_ssd_iter_140000.caffemodel with its deploy.prototxt).
+        The network must output (1, 1, N, 7) rows of (image, class, confidence, x1, y1, x2, y2) with coordinates relative to the image.
+    """
+
+    name = "dnn"
+
+    def __init__(
+        self,
+        model: Union[str, Path],
+        config: Optional[Union[str, Path]] = None,
+        confidence: float = 0.5,
+        input_size: int = 300,
+        mean: Tuple[float, float, float] = (104.0, 177.0, 123.0),
+    ) -> None:
+        super().__init__([model] if config is None else [model, config])
+        self.confidence = confidence
+        self.input_size = input_size
+        self.mean = tuple(mean)
+
+    def load(self) -> cv2.dnn.Net:
+        model = str(self.model_files[0])
+        config = str(self.model_files[1]) if len(self.model_files) > 1 else ""
+        return cv2.dnn.readNet(model, config)
+
+    def params(self) -> Dict[str, Any]:
+        return {"confidence": self.confidence, "input_size": self.input_size, "mean": list(self.mean)}
+
+    def boxes(self, img: np.ndarray) -> np.ndarray:
+        height, width = img.shape[:2]
+        self.model.setInput(
+            cv2.dnn.blobFromImage(img, 1.0, (self.input_size, self.input_size), self.mean)
+        )
+        detections = self.model.forward().reshape(-1, 7)
+        detections = detections[detections[:, 2] >= self.confidence]
+        corners = np.clip(detections[:, 3:7], 0, 1) * [width, height, width, height]
+        corners = np.round(corners).astype(int)
+        faces = np.column_stack([corners[:, :2], corners[:, 2:] - corners[:, :2]])
+        return faces[(faces[:, 2] > 0) & (faces[:, 3] > 0)].reshape(-1, 4)
+
+
+FACE_DETECTORS = {
+    CascadeDetector.name: CascadeDetector,
+    LBPCascadeDetector.name: LBPCascadeDetector,
+    DNNDetector.name: DNNDetector,
+}
+
+
+def get_face_detector(
+    backend: str = "haar",
+    model: Optional[Path] = None,
+    config: Optional[Path] = None,
+    dnn_confidence: float = 0.5,
+    **cascade_kwargs: Any,
+) -> FaceDetector:
+    """
+        FaceDetector for backend (one of FACE_DETECTORS), model is the cascade XML (defaults from the environment) or the DNN model file.
+        cascade_kwargs are CascadeDetector parameters, ignored by the DNN backend.
+    """
+    if backend not in FACE_DETECTORS:
+        raise ValueError(f"{backend} is not one of {list(FACE_DETECTORS)}")
+    if backend == DNNDetector.name:
+        if model is None:
+            raise MissingArgumentsError("a model file is required for the dnn face detector")
+        return DNNDetector(model, config=config, confidence=dnn_confidence)
+    if model is None:
+        return FACE_DETECTORS[backend](**cascade_kwargs)
+    return FACE_DETECTORS[backend](model, **cascade_kwargs)
+
 
+def face_detector_from_args(args: argparse.Namespace) -> FaceDetector:
+    """ FaceDetector configured by imgserve.args.get_face_detection_args """
+    return get_face_detector(
+        backend=args.face_detector,
+        model=args.face_detector_model,
+        config=args.face_detector_config,
+        dnn_confidence=args.dnn_confidence,
+        cv2_cascade_min_neighbors=args.cv2_cascade_min_neighbors,
+        scale_factor=args.cv2_cascade_scale_factor,
+        min_size=(args.cv2_cascade_min_size, args.cv2_cascade_min_size),
+        fast=args.fast_face_detection,
+        detection_height=args.face_detection_height,
+        equalize_hist=args.face_detection_equalize_hist,
+    )
+
+
+@dataclass
+class FaceCrop:
+    box: Tuple[int, int, int, int]  # (x, y, w, h) in the source image
+    image: bytes  # jpg encoded crop
+
+
+class DetectionCache:
+    """
+        Face boxes keyed by (image content sha256, detector model hash, detection parameters), in a local sqlite file.
+        Re-running extraction over the same images only re-crops, and changing a parameter only re-detects for the new parameters.
+        Safe to share between processes, each opens its own connection.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS detections (
+                image_hash TEXT NOT NULL,
+                classifier_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                boxes BLOB NOT NULL,
+                PRIMARY KEY (image_hash, classifier_hash, params)
+            ) WITHOUT ROWID
+            """
+        )
+
+    @staticmethod
+    def content_hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, image_hash: str, detector: FaceDetector) -> Optional[np.ndarray]:
+        row = self.connection.execute(
+            "SELECT boxes FROM detections WHERE image_hash = ? AND classifier_hash = ? AND params = ?",
+            (image_hash, detector.model_hash, detector.params_key),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=np.int32).reshape(-1, 4)
+
+    def put(self, image_hash: str, detector: FaceDetector, boxes: np.ndarray) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)",
+            (image_hash, detector.model_hash, detector.params_key, np.asarray(boxes, dtype=np.int32).tobytes()),
+        )
+
+
+def decode_bgr(image: Union[bytes, Path, np.ndarray]) -> np.ndarray:
+    """ BGR array of image bytes or an image file, the way cv2.imread loads it """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, Path):
+        if not image.is_file():
+            raise FileNotFoundError(image)
+        image = image.read_bytes()
+    img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
     if img is None:
         raise NotAnImageError(f"file exists, but is not an image.")
-    minisize = (img.shape[1], img.shape[0])
-    miniframe = cv2.resize(img, minisize)
+    return img
 
-    faces = face_classifier.detectMultiScale(miniframe, minNeighbors=cv2_cascade_min_neighbors)
 
-    count = 0
+def extract_faces(
+    image: Union[bytes, Path, np.ndarray],
+    detector: Optional[FaceDetector] = None,
+    detection_cache: Optional[DetectionCache] = None,
+    **cascade_kwargs: Any,
+) -> List[FaceCrop]:
+    """
+        Detect faces in image bytes, an image file or a BGR array and return each one as a jpg encoded crop with its box,
+        nothing is written to disk. Without a detector, a CascadeDetector is made from cascade_kwargs.
+        With detection_cache, boxes already detected for this content by this detector (and parameters) are reused.
+    """
+    log = simple_logger("imgserve.extract_faces")
+
+    if detector is None:
+        detector = CascadeDetector(**cascade_kwargs)
+    elif len(cascade_kwargs) > 0:
+        raise ValueError(f"detector parameters {list(cascade_kwargs)} given along with a detector")
+
+    if isinstance(image, Path):
+        if not image.is_file():
+            raise FileNotFoundError(image)
+        image = image.read_bytes()
+    img = decode_bgr(image)
+    if isinstance(image, np.ndarray):
+        img = img.copy()  # outlines are drawn on the frame below, leave the caller's array alone
+
+    faces = None
+    if detection_cache is not None:
+        image_hash = DetectionCache.content_hash(image if isinstance(image, bytes) else image.tobytes())
+        faces = detection_cache.get(image_hash, detector)
+    if faces is None:
+        faces, detection_seconds = detector.detect(img)
+        log.debug(f"{detector.name} detected {len(faces)} faces ({img.shape[1]}x{img.shape[0]}) in {1000 * detection_seconds:.1f} ms")
+        if detection_cache is not None:
+            detection_cache.put(image_hash, detector, faces)
+
+    crops = list()
     padding_pct = 0.2
     for f in faces:
-        x, y, w, h = [ v for v in f ]
+        x, y, w, h = [ int(v) for v in f ]
         padding = int(h * padding_pct)
         cv2.rectangle(img, (x,y), (x+w+padding,y+h+padding), (255,255,255))
         sub_face = img[y:y+h, x:x+w]
+        encoded, buffer = cv2.imencode(".jpg", scale_image(sub_face))
+        if not encoded:
+            log.error(f"could not encode face at {(x, y, w, h)}")
+            continue
+        crops.append(FaceCrop(box=(x, y, w, h), image=buffer.tobytes()))
+    return crops
+
 
+def facechop(image: Path, output_dir: Path, **extract_faces_kwargs: Any) -> Generator[Path, None, None]:
+    """
+        Write each face detected in image to output_dir as its own jpg, see extract_faces
+    """
+    log = simple_logger("imgserve.facechop")
+
+    if not image.is_file():
+        raise FileNotFoundError(image)
+
+    for count, face in enumerate(extract_faces(image, **extract_faces_kwargs)):
         output_dir.mkdir(exist_ok=True, parents=True)
         cropped_face_image: Path = output_dir.joinpath(image.stem + f"-{count}").with_suffix(".jpg")
         log.debug(f"writing {cropped_face_image}")
-        cv2.imwrite(str(cropped_face_image), scale_image(sub_face))
+        cropped_face_image.write_bytes(face.image)
 
         yield cropped_face_image
-        count += 1
+
+
+# each face detection worker process gets its own copy of the detector (loading its model on first use) and opens its own cache,
+# see init_face_detection_worker
+WORKER_DETECTOR: Optional[FaceDetector] = None
+WORKER_DETECTION_CACHE: Optional[DetectionCache] = None
+
+
+def init_face_detection_worker(
+    detector: FaceDetector,
+    detection_cache_path: Optional[Path] = None,
+) -> None:
+    """
+        Process pool initializer: pin OpenCV to a single thread,
+        parallelism comes from the pool, so OpenCV's own threads would only oversubscribe the cores.
+    """
+    global WORKER_DETECTOR, WORKER_DETECTION_CACHE
+    cv2.setNumThreads(1)
+    WORKER_DETECTOR = detector
+    if detection_cache_path is not None:
+        WORKER_DETECTION_CACHE = DetectionCache(detection_cache_path)
+
+
+def _extract_faces_job(
+    image: Union[bytes, Path],
+    detector: FaceDetector,
+    detection_cache: Optional[DetectionCache],
+    skip_errors: bool,
+) -> Tuple[List[FaceCrop], float]:
+    """ face crops of image and the seconds it took to extract them """
+    start = time.perf_counter()
+    try:
+        return extract_faces(image, detector=detector, detection_cache=detection_cache), time.perf_counter() - start
+    except (NotAnImageError, FileNotFoundError, cv2.error) as exc:
+        if not skip_errors:
+            raise
+        simple_logger("imgserve.extract_faces_many").error(
+            f"skipping {image if isinstance(image, Path) else 'image'}: {exc}"
+        )
+        return list(), time.perf_counter() - start
+
+
+def _extract_faces_worker_job(job: Tuple[Union[bytes, Path], bool]) -> Tuple[List[FaceCrop], float]:
+    image, skip_errors = job
+    return _extract_faces_job(image, WORKER_DETECTOR, WORKER_DETECTION_CACHE, skip_errors)
+
+
+class FaceDetectionPool:
+    """
+        Worker processes that each load the detector once (see init_face_detection_worker), shared by any number of extract_faces_many calls.
+        workers defaults to the number of CPUs, with workers=1 detection runs in this process.
+        Workers are started by the first extract, and stopped by close (or leaving the pool as a context manager).
+        images and detection_seconds add up every image extracted so far and the time spent on them (summed over workers),
+        close logs them at info level.
+    """
+
+    def __init__(
+        self,
+        detector: FaceDetector,
+        workers: Optional[int] = None,
+        detection_cache_path: Optional[Path] = None,
+    ) -> None:
+        self.detector = detector
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.detection_cache: Optional[DetectionCache] = None
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.images = 0
+        self.detection_seconds = 0.0
+        if self.workers <= 1:
+            if detection_cache_path is not None:
+                self.detection_cache = DetectionCache(detection_cache_path)
+        else:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=init_face_detection_worker,
+                initargs=(detector, detection_cache_path),
+            )
+        self.log = simple_logger("imgserve.FaceDetectionPool")
+
+    def extract(
+        self, images: List[Union[bytes, Path]], skip_errors: bool = False
+    ) -> Generator[Tuple[Union[bytes, Path], List[FaceCrop]], None, None]:
+        """ (image, face crops) for each of images, in order, see extract_faces_many """
+        if self.executor is None:
+            results = (_extract_faces_job(image, self.detector, self.detection_cache, skip_errors) for image in images)
+        else:
+            jobs = [(image, skip_errors) for image in images]
+            self.log.debug(f"detecting faces in {len(jobs)} images with {self.workers} {self.detector.name} workers")
+            # a few images per task amortizes inter-process overhead without starving workers
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+            results = self.executor.map(_extract_faces_worker_job, jobs, chunksize=chunksize)
+        for image, (faces, seconds) in zip(images, results):
+            self.images += 1
+            self.detection_seconds += seconds
+            yield image, faces
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.images > 0:
+            self.log.info(
+                f"{self.detector.name} extracted faces from {self.images} images in {self.detection_seconds:.1f} s,"
+                f" {1000 * self.detection_seconds / self.images:.1f} ms per image"
+            )
+        if self.detection_cache is not None:
+            self.log.debug(f"{self.detection_cache.hits} cached detections reused, {self.detection_cache.misses} images detected")
+
+    def __enter__(self) -> FaceDetectionPool:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def extract_faces_many(
+    images: List[Union[bytes, Path]],
+    detector: Optional[FaceDetector] = None,
+    workers: Optional[int] = None,
+    skip_errors: bool = False,
+    detection_cache_path: Optional[Path] = None,
+    pool: Optional[FaceDetectionPool] = None,
+    **cascade_kwargs: Any,
+) -> Generator[Tuple[Union[bytes, Path], List[FaceCrop]], None, None]:
+    """
+        Run extract_faces on each image in a pool of worker processes, paths are read by the workers.
+        Yields (image, face crops) in the order of images, as soon as each result is ready,
+        so the caller can upload crops while later images are still being processed.
+        workers defaults to the number of CPUs, with workers=1 detection runs in this process.
+        With skip_errors, images that can not be read or decoded are logged and yield no faces.
+        With detection_cache_path, boxes are cached in a DetectionCache there, shared by the workers.
+        Without a detector, a CascadeDetector is made from cascade_kwargs.
+        Callers detecting faces in many batches pass a FaceDetectionPool as pool (instead of detector, workers and detection_cache_path),
+        otherwise a pool is started and its workers load the detector for this call alone.
+    """
+    if pool is not None:
+        if detector is not None or workers is not None or detection_cache_path is not None or len(cascade_kwargs) > 0:
+            raise ValueError("detector, workers and detection_cache_path are set by the pool")
+        yield from pool.extract(images, skip_errors=skip_errors)
+        return
+    if detector is None:
+        detector = CascadeDetector(**cascade_kwargs)
+    elif len(cascade_kwargs) > 0:
+        raise ValueError(f"detector parameters {list(cascade_kwargs)} given along with a detector")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with FaceDetectionPool(
+        detector, workers=min(workers, len(images)), detection_cache_path=detection_cache_path
+    ) as pool:
+        yield from pool.extract(images, skip_errors=skip_errors)
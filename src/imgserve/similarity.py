@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import numpy as np
+
+from .errors import NoImagesInElasticsearchError
+
+DISTRIBUTION_FIELDS = ["jzazbz_dist", "rgb_dist"]
+
+
+def normalize_distributions(distributions: np.ndarray) -> np.ndarray:
+    """ colorgram documents store NaN bins as null, treat them as empty and rescale each row to sum to 1 """
+    distributions = np.nan_to_num(np.asarray(distributions, dtype=np.float64))
+    sums = distributions.sum(axis=-1, keepdims=True)
+    sums[sums == 0] = 1
+    return distributions / sums
+
+
+def js_distances(distributions: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """ Jensen-Shannon divergence (base 2) between each row of distributions and target """
+    m = 0.5 * (distributions + target)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left = np.where(distributions > 0, distributions * np.log2(distributions / m), 0)
+        right = np.where(target > 0, target * np.log2(target / m), 0)
+    return 0.5 * left.sum(axis=-1) + 0.5 * right.sum(axis=-1)
+
+
+class ColorgramIndex:
+    """
+        In-process nearest neighbour index over the colour distributions of colorgram documents.
+        Distributions are held as one dense matrix, queries are a single vectorized Jensen-Shannon divergence against every row.
+    """
+
+    def __init__(
+        self,
+        documents: Iterable[Dict[str, Any]],
+        dist_field: str = "jzazbz_dist",
+    ) -> None:
+        if dist_field not in DISTRIBUTION_FIELDS:
+            raise ValueError(f"{dist_field} is not one of {DISTRIBUTION_FIELDS}")
+        self.dist_field = dist_field
+        self.documents: List[Dict[str, Any]] = list()
+        distributions = list()
+        for document in documents:
+            if document.get(dist_field) is None:
+                continue
+            distributions.append(
+                [np.nan if value is None else value for value in document[dist_field]]
+            )
+            self.documents.append(
+                {
+                    key: value
+                    for key, value in document.items()
+                    if key not in DISTRIBUTION_FIELDS and key != "downloads"
+                }
+            )
+        if len(self.documents) == 0:
+            raise NoImagesInElasticsearchError(
+                f"no colorgram documents with {dist_field} to index"
+            )
+        self.distributions = normalize_distributions(distributions)
+        self.queries = np.array([document.get("query") for document in self.documents])
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def distribution(self, word: str) -> np.ndarray:
+        """ mean distribution of every colorgram for word """
+        matches = self.queries == word
+        if not matches.any():
+            raise FileNotFoundError(f'no colorgram for "{word}" in the index')
+        return normalize_distributions(self.distributions[matches].mean(axis=0))
+
+    def nearest(
+        self,
+        distribution: np.ndarray,
+        k: int = 10,
+        exclude: Optional[str] = None,
+        one_per_query: bool = False,
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+            k documents closest to distribution, as (distance, document), optionally skipping colorgrams of the word exclude.
+            With one_per_query, a word with several colorgrams (one per trial or dimension) is ranked by its closest one, and only that one is returned.
+        """
+        distances = js_distances(
+            self.distributions, normalize_distributions(distribution)
+        )
+        if exclude is not None:
+            distances[self.queries == exclude] = np.inf
+        k = min(k, int(np.isfinite(distances).sum()))
+        if k <= 0:
+            return list()
+        if one_per_query:
+            closest: Dict[Any, int] = dict()
+            for ind in np.argsort(distances, kind="stable"):
+                if len(closest) == k or not np.isfinite(distances[ind]):
+                    break
+                closest.setdefault(self.queries[ind], ind)
+            nearest = list(closest.values())
+        else:
+            nearest = np.argpartition(distances, k - 1)[:k]
+            nearest = nearest[np.argsort(distances[nearest])]
+        return [(float(distances[ind]), self.documents[ind]) for ind in nearest]
+
+    def similar(
+        self, word: str, k: int = 10
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """ the k other words with colorgrams closest to word's, as (distance, closest colorgram of that word) """
+        return self.nearest(
+            self.distribution(word), k=k, exclude=word, one_per_query=True
+        )
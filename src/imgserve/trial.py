@@ -1,4 +1,5 @@
 from __future__ import annotations
+import contextlib
 import copy
 import hashlib
 import json
@@ -19,12 +20,13 @@ from .elasticsearch import (
     MTURK_HITS_INDEX_PATTERN,
     RAW_IMAGES_INDEX_PATTERN,
 )
-from .errors import UnimplementedError
+from .errors import NoDownloadsError, UnimplementedError
 from .logger import simple_logger
 from .s3 import s3_put_image
 from .utils import get_batch_slice
-from .vectors import get_vectors
-from .faces import facechop
+from .vectors import get_vectors_from_images
+from .dedup import load_face_hash_index, store_cropped_face
+from .faces import CascadeDetector, FaceDetectionPool, extract_faces_many
 
 QUERY_RUNNER_IMAGE = "mgraskertheband/qloader:4.6.2"
 
@@ -80,6 +82,12 @@ def run_trial(
     query_timeout: int = 600,
     no_compress: bool = False,
     cv2_cascade_min_neighbors: int = 5,
+    analysis_resolution: int = 300,
+    draft_decode: bool = False,
+    face_detection_workers: Optional[int] = None,
+    face_detector: Optional[FaceDetector] = None,
+    face_dedup_hamming_radius: Optional[int] = None,
+    face_detection_cache: Optional[Path] = None,
 ) -> None:
     """
         Wrapper around github.com/mgrasker/qloader containerized search gatherer.
@@ -95,6 +103,18 @@ def run_trial(
         "experiment_name": experiment_name,
     }
 
+    if face_detector is None and not skip_face_detection:
+        face_detector = CascadeDetector(cv2_cascade_min_neighbors=cv2_cascade_min_neighbors)
+
+    face_hash_index = None
+    if not skip_face_detection and face_dedup_hamming_radius is not None and not dry_run:
+        # faces seen in earlier trials (and earlier queries of this one) are linked to instead of uploaded again
+        face_hash_index = load_face_hash_index(
+            elasticsearch_client=elasticsearch_client,
+            experiment_name=experiment_name,
+            radius=face_dedup_hamming_radius,
+        )
+
     trial_config_items = list(trial_config.items())
     # optionally slice experiment into chunks and only run one
     if batch_slice is not None:
@@ -103,208 +123,221 @@ def run_trial(
     else:
         trial_slice = trial_config_items
 
-    # for each search_term in csv, launch docker query
-    # TODO: optional "user browser" query
-    for search_term, csv_metadata in trial_slice:
-
-        if search_term.strip() == "":
-            continue
+    # worker processes start once and load the detector once for every search term of the trial
+    face_detection_pool = (
+        contextlib.nullcontext()
+        if skip_face_detection
+        else FaceDetectionPool(
+            face_detector, workers=face_detection_workers, detection_cache_path=face_detection_cache
+        )
+    )
+    with face_detection_pool:
+        # for each search_term in csv, launch docker query
+        # TODO: optional "user browser" query
+        for search_term, csv_metadata in trial_slice:
 
-        if skip_already_searched and document_exists(
-            elasticsearch_client=elasticsearch_client,
-            doc={
-                "hostname": trial_hostname,
-                "query": search_term,
-                "trial_id": trial_id,
-            },
-            index="raw-images",
-            identity_fields=["hostname", "query", "trial_id"],
-        ):
-            log.info(f"already searched {search_term} from this host for {trial_id}")
-            continue
+            if search_term.strip() == "":
+                continue
 
-        regions = csv_metadata.pop("regions")
+            if skip_already_searched and document_exists(
+                elasticsearch_client=elasticsearch_client,
+                doc={
+                    "hostname": trial_hostname,
+                    "query": search_term,
+                    "trial_id": trial_id,
+                },
+                index="raw-images",
+                identity_fields=["hostname", "query", "trial_id"],
+            ):
+                log.info(f"already searched {search_term} from this host for {trial_id}")
+                continue
 
-        if dry_run:
-            log.info(f"[DRY RUN] would run search {search_term}")
-            continue
+            regions = csv_metadata.pop("regions")
 
-        image_document_shared = copy.deepcopy(shared_metadata)
-        image_document_shared.update({"region": trial_hostname})
-        image_document_shared.update(csv_metadata)
-        search_metadata_log = local_data_store.joinpath(trial_id).joinpath(
-            f".metadata-{trial_timestamp}.json"
-        )
-        search_metadata_log.parent.mkdir(exist_ok=True, parents=True)
-        search_metadata_log.write_text(json.dumps(image_document_shared, indent=2))
-        if run_user_browser_scrape:
-            raise UnimplementedError()
-        else:
-            log.info(f"running {QUERY_RUNNER_IMAGE} for query: {search_term}")
-            docker_run_command = f'docker run \
-                --user 1000:1000 \
-                --shm-size=2g \
-                -v {local_data_store}:/tmp/imgserve \
-                --rm \
-                --env QLOADER_BROWSER=Firefox \
-                --env S3_ACCESS_KEY_ID={s3_access_key_id} \
-                --env S3_SECRET_ACCESS_KEY={s3_secret_access_key} \
-                --env S3_ENDPOINT_URL={s3_endpoint_url} \
-                --env S3_REGION_NAME={s3_region_name} \
-                --env S3_BUCKET_NAME={s3_bucket_name} \
-                {QUERY_RUNNER_IMAGE} \
-                    --trial-id {trial_id} \
-                    --hostname {trial_hostname} \
-                    --ran-at {trial_timestamp} \
-                    --endpoint {endpoint} \
-                    --query-terms "{search_term}" \
-                    --max-images {max_images} \
-                    --output-path /tmp/imgserve/ \
-                    --metadata-path /tmp/imgserve/{trial_id}/.metadata-{trial_timestamp}.json'
-            #log.info(docker_run_command)
-            if no_compress:
-                docker_run_command += ' --no-compress'
-            try:
-                run_search(docker_run_command, timeout=query_timeout)
-            except subprocess.TimeoutExpired as e:
-                log.error(
-                    f"Query for {search_term} took longer than {query_timeout}, skipping."
-                )
+            if dry_run:
+                log.info(f"[DRY RUN] would run search {search_term}")
                 continue
 
-        query_downloads = (
-            local_data_store.joinpath(trial_id)
-            .joinpath(trial_hostname)
-            .joinpath(trial_timestamp)
-        )
-        trial_run_manifest = query_downloads.joinpath("manifest.json")
-        (
-            local_data_store.joinpath(trial_id)
-            .joinpath(trial_hostname)
-            .joinpath(trial_timestamp)
-            .joinpath("manifest.json")
-        )
-        if not trial_run_manifest.is_file():
-            from .pathtree import DisplayablePath
-
-            paths = DisplayablePath.make_tree(local_data_store)
+            image_document_shared = copy.deepcopy(shared_metadata)
+            image_document_shared.update({"region": trial_hostname})
+            image_document_shared.update(csv_metadata)
+            search_metadata_log = local_data_store.joinpath(trial_id).joinpath(
+                f".metadata-{trial_timestamp}.json"
+            )
+            search_metadata_log.parent.mkdir(exist_ok=True, parents=True)
+            search_metadata_log.write_text(json.dumps(image_document_shared, indent=2))
+            if run_user_browser_scrape:
+                raise UnimplementedError()
+            else:
+                log.info(f"running {QUERY_RUNNER_IMAGE} for query: {search_term}")
+                docker_run_command = f'docker run \
+                    --user 1000:1000 \
+                    --shm-size=2g \
+                    -v {local_data_store}:/tmp/imgserve \
+                    --rm \
+                    --env QLOADER_BROWSER=Firefox \
+                    --env S3_ACCESS_KEY_ID={s3_access_key_id} \
+                    --env S3_SECRET_ACCESS_KEY={s3_secret_access_key} \
+                    --env S3_ENDPOINT_URL={s3_endpoint_url} \
+                    --env S3_REGION_NAME={s3_region_name} \
+                    --env S3_BUCKET_NAME={s3_bucket_name} \
+                    {QUERY_RUNNER_IMAGE} \
+                        --trial-id {trial_id} \
+                        --hostname {trial_hostname} \
+                        --ran-at {trial_timestamp} \
+                        --endpoint {endpoint} \
+                        --query-terms "{search_term}" \
+                        --max-images {max_images} \
+                        --output-path /tmp/imgserve/ \
+                        --metadata-path /tmp/imgserve/{trial_id}/.metadata-{trial_timestamp}.json'
+                #log.info(docker_run_command)
+                if no_compress:
+                    docker_run_command += ' --no-compress'
+                try:
+                    run_search(docker_run_command, timeout=query_timeout)
+                except subprocess.TimeoutExpired as e:
+                    log.error(
+                        f"Query for {search_term} took longer than {query_timeout}, skipping."
+                    )
+                    continue
 
-            raise FileNotFoundError(
-                "\n".join(
-                    [
-                        f"The trial run should have created a manifest file at {trial_run_manifest}, but it did not!",
-                        f"here's what was at {local_data_store}:",
-                        "\n".join([path.displayable() for path in paths]),
-                    ]
-                )
+            query_downloads = (
+                local_data_store.joinpath(trial_id)
+                .joinpath(trial_hostname)
+                .joinpath(trial_timestamp)
+            )
+            trial_run_manifest = query_downloads.joinpath("manifest.json")
+            (
+                local_data_store.joinpath(trial_id)
+                .joinpath(trial_hostname)
+                .joinpath(trial_timestamp)
+                .joinpath("manifest.json")
             )
+            if not trial_run_manifest.is_file():
+                from .pathtree import DisplayablePath
 
-        mturk_hit_documents = list()
+                paths = DisplayablePath.make_tree(local_data_store)
 
-        if not skip_face_detection:
-            face_documents = list()
-            updated_trial_run_manifest = list()
-            # iterate over manifest documents
-            for raw_image_doc in json.loads(trial_run_manifest.read_text()):
-                downloaded_image = query_downloads.joinpath("images").joinpath(f"{raw_image_doc['image_id']}.jpg")
-                face_count = 0
-                face_batch = list()
-                # facechop crops each face out of each image and creates a new file in a nested folder under 'faces'
-                for face_image in facechop(downloaded_image, downloaded_image.with_suffix("").joinpath("faces"), cv2_cascade_min_neighbors=cv2_cascade_min_neighbors):
-                    face_doc = {
-                        "image_id": downloaded_image.stem,
-                        "face_id": "-".join([downloaded_image.stem, str(len(face_batch))]),
-                        "query": search_term
-                    }
-                    face_doc.update(image_document_shared)
-                    s3_put_image(
-                        s3_client=s3_client,
-                        image=face_image,
-                        bucket=mturk_s3_bucket_name,
-                        object_path=Path(experiment_name).joinpath("faces").joinpath(face_doc["face_id"]).with_suffix(".jpg"), # each unique face will have it's image bytes stored one time.
-                        overwrite=False,
+                raise FileNotFoundError(
+                    "\n".join(
+                        [
+                            f"The trial run should have created a manifest file at {trial_run_manifest}, but it did not!",
+                            f"here's what was at {local_data_store}:",
+                            "\n".join([path.displayable() for path in paths]),
+                        ]
                     )
-                    face_batch.append(face_doc)
-                    face_documents.append(face_doc)
+                )
 
-                # update raw image document with information about faces contained
-                raw_image_doc.update(number_of_faces=len(face_batch))
-                updated_trial_run_manifest.append(raw_image_doc)
+            mturk_hit_documents = list()
 
-            # finish face detection, update raw images data with metadata about faces
-            trial_run_manifest.write_text(json.dumps(updated_trial_run_manifest))
-            index_to_elasticsearch(
-                elasticsearch_client=elasticsearch_client,
-                index=CROPPED_FACE_INDEX_PATTERN,
-                docs=face_documents,
-                identity_fields=["face_id", "query"], # this makes it so that we only store each cropped face in elasticsearch once for the query that returned it.
-                overwrite=False
-            )
+            if not skip_face_detection:
+                face_documents = list()
+                updated_trial_run_manifest = list()
+                raw_image_docs = json.loads(trial_run_manifest.read_text())
+                downloaded_images = [
+                    query_downloads.joinpath("images").joinpath(f"{raw_image_doc['image_id']}.jpg")
+                    for raw_image_doc in raw_image_docs
+                ]
+                # crops of each face are detected and encoded in memory by worker processes, results come back in manifest order
+                detected = extract_faces_many(downloaded_images, pool=face_detection_pool)
+                for raw_image_doc, (downloaded_image, faces) in zip(raw_image_docs, detected):
+                    face_batch = list()
+                    for face in faces:
+                        face_doc = {
+                            "image_id": downloaded_image.stem,
+                            "face_id": "-".join([downloaded_image.stem, str(len(face_batch))]),
+                            "query": search_term,
+                        }
+                        face_doc.update(image_document_shared)
+                        store_cropped_face(
+                            s3_client=s3_client,
+                            bucket_name=mturk_s3_bucket_name,
+                            experiment_name=experiment_name,
+                            face=face,
+                            face_doc=face_doc,
+                            face_hash_index=face_hash_index,
+                        )
+                        face_batch.append(face_doc)
+                        face_documents.append(face_doc)
 
-        if not skip_mturk_raw_images:
-            raise UnimplementedError("Must implement MTurk HIT creation from raw images")
-        index_to_elasticsearch(
-            elasticsearch_client=elasticsearch_client,
-            index=RAW_IMAGES_INDEX_PATTERN,
-            docs=json.loads(trial_run_manifest.read_text()),
-            identity_fields=["trial_id", "trial_hostname", "ran_at"],
-        )
-        if not skip_vectors:
-            vector_stem = f"query={search_term}|hostname={trial_hostname}|trial_timestamp={trial_timestamp}"
-            trial_downloads = query_downloads.joinpath("vector").joinpath(vector_stem)
-            try:
-                shutil.rmtree(
-                    trial_downloads
-                )  # clear existing downloads folders from previous runs
-            except FileNotFoundError:
-                pass
-            trial_downloads.mkdir(parents=True)
-            for downloaded_image in query_downloads.joinpath("images").glob("*.jpg"):
-                trial_downloads.joinpath(downloaded_image.name).write_bytes(
-                    downloaded_image.read_bytes()
-                )
-            documents = list()
-            for vector, metadata in get_vectors(trial_downloads.parent):
-                s3_put_image(
-                    s3_client=s3_client,
-                    image=vector.colorgram,
-                    bucket=s3_bucket_name,
-                    object_path=Path(experiment_name).joinpath(metadata["s3_key"]),
-                    overwrite=True,
+                    # update raw image document with information about faces contained
+                    raw_image_doc.update(number_of_faces=len(face_batch))
+                    updated_trial_run_manifest.append(raw_image_doc)
+
+                # finish face detection, update raw images data with metadata about faces
+                trial_run_manifest.write_text(json.dumps(updated_trial_run_manifest))
+                index_to_elasticsearch(
+                    elasticsearch_client=elasticsearch_client,
+                    index=CROPPED_FACE_INDEX_PATTERN,
+                    docs=face_documents,
+                    identity_fields=["face_id", "query"], # this makes it so that we only store each cropped face in elasticsearch once for the query that returned it.
+                    overwrite=False
                 )
-                metadata.update(experiment_name=experiment_name)
-                documents.append(metadata)
-                if not no_local_data:
-                    save_to = (
-                        trial_downloads.parents[1]
-                        .joinpath("colorgrams")
-                        .joinpath(vector_stem)
-                        .with_suffix(".png")
-                    )
-                    save_to.parent.mkdir(exist_ok=True, parents=True)
-                    vector.colorgram.save(save_to)
-            if len(documents) > 1:
-                log.warning(f"multiple vectors created from a single search run")
-            if not skip_mturk_colorgrams:
-                raise UnimplementedError(f"Must implement Mturk task creation from colorgram documents")
 
+            if not skip_mturk_raw_images:
+                raise UnimplementedError("Must implement MTurk HIT creation from raw images")
             index_to_elasticsearch(
                 elasticsearch_client=elasticsearch_client,
-                index=COLORGRAMS_INDEX_PATTERN,
-                docs=documents,
-                identity_fields=["experiment_name", "downloads", "s3_key"],
-                overwrite=False,
+                index=RAW_IMAGES_INDEX_PATTERN,
+                docs=json.loads(trial_run_manifest.read_text()),
+                identity_fields=["trial_id", "trial_hostname", "ran_at"],
             )
-            log.info(
-                f"vector for '{search_term}' indexed and saved to s3"
-                + (
-                    f", and also here: {trial_downloads.with_suffix('.png')}"
-                    if not no_local_data
-                    else ""
+            if not skip_vectors:
+                vector_stem = f"query={search_term}|hostname={trial_hostname}|trial_timestamp={trial_timestamp}"
+                save_to = (
+                    query_downloads.joinpath("colorgrams")
+                    .joinpath(vector_stem)
+                    .with_suffix(".png")
+                )
+                vector_images = sorted(query_downloads.joinpath("images").glob("*.jpg"))
+                if len(vector_images) == 0:
+                    raise NoDownloadsError(
+                        f"No downloaded images available at {query_downloads.joinpath('images')}"
+                    )
+                documents = list()
+                # images are decoded straight from the trial's download folder, no staging copy is needed
+                for vector, metadata in get_vectors_from_images(
+                    (
+                        (vector_stem, downloaded_image.stem, downloaded_image)
+                        for downloaded_image in vector_images
+                    ),
+                    analysis_dims=(analysis_resolution, analysis_resolution),
+                    draft=draft_decode,
+                ):
+                    s3_put_image(
+                        s3_client=s3_client,
+                        image=vector.colorgram,
+                        bucket=s3_bucket_name,
+                        object_path=Path(experiment_name).joinpath(metadata["s3_key"]),
+                        overwrite=True,
+                    )
+                    metadata.update(experiment_name=experiment_name)
+                    documents.append(metadata)
+                    if not no_local_data:
+                        save_to.parent.mkdir(exist_ok=True, parents=True)
+                        vector.colorgram.save(save_to)
+                if len(documents) > 1:
+                    log.warning(f"multiple vectors created from a single search run")
+                if not skip_mturk_colorgrams:
+                    raise UnimplementedError(f"Must implement Mturk task creation from colorgram documents")
+
+                index_to_elasticsearch(
+                    elasticsearch_client=elasticsearch_client,
+                    index=COLORGRAMS_INDEX_PATTERN,
+                    docs=documents,
+                    identity_fields=["experiment_name", "downloads", "s3_key"],
+                    overwrite=False,
+                )
+                log.info(
+                    f"vector for '{search_term}' indexed and saved to s3"
+                    + (
+                        f", and also here: {save_to}"
+                        if not no_local_data
+                        else ""
+                    )
                 )
-            )
 
 
-        if no_local_data:
-            shutil.rmtree(query_downloads)
-            log.info(f"removed '{search_term}' data from local storage")
+            if no_local_data:
+                shutil.rmtree(query_downloads)
+                log.info(f"removed '{search_term}' data from local storage")
@@ -1,5 +1,9 @@
 from __future__ import annotations
+import hashlib
+import heapq
 import io
+import os
+import tempfile
 from copy import copy
 
 import requests
@@ -9,6 +13,22 @@ from .errors import InvalidSliceArgumentError
 from .logger import simple_logger
 
 
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+        write data to path through a temporary file renamed over it, so readers in any thread or process see the old file or all of the new one, never part of it
+    """
+    path.parent.mkdir(exist_ok=True, parents=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def download_image(url: str, path: Path, overwrite: bool = False) -> None:
     if path.is_file() and not overwrite:
         return
@@ -51,6 +71,32 @@ def get_batch_slice(items: List[Any], batch_slice: str) -> List[Any]:
     return slices[slice_index - 1]
 
 
+def reservoir_sample(
+    items: Iterable[Any], k: int, seed: str, key: Callable[[Any], str] = str
+) -> Tuple[List[Any], int]:
+    """
+        Sample k items from a stream of unknown length in O(k) memory, returns (sample, total items seen).
+        Each item gets a priority from a hash of seed and key(item) and the k lowest priorities are kept,
+        so the sample is deterministic for a given seed, whatever order the items arrive in.
+    """
+    if k < 1:
+        raise ValueError(f"sample size k must be at least 1, not {k}")
+    reservoir: List[Tuple[int, int, Any]] = list()  # max-heap on priority, by negation
+    total = 0
+    for item in items:
+        priority = int.from_bytes(
+            hashlib.sha256(f"{seed}|{key(item)}".encode("utf-8")).digest()[:8], "big"
+        )
+        entry = (-priority, total, item)
+        if len(reservoir) < k:
+            heapq.heappush(reservoir, entry)
+        elif -priority > reservoir[0][0]:
+            heapq.heapreplace(reservoir, entry)
+        total += 1
+    sample = [item for _, _, item in sorted(reservoir, key=lambda entry: entry[1])]
+    return sample, total
+
+
 class AsteriskNotAtListError(KeyError):
     pass
 
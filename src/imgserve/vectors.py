@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import hashlib
+import io
 from pathlib import Path
 
 import numpy as np
+from PIL import Image, UnidentifiedImageError
+from compsyn.analysis import ImageAnalysis
+from compsyn.datahelper import ImageData
 from compsyn.vectors import Vector
 
-from .errors import NoDownloadsError, MalformedTagsError
+from .errors import AmbiguousDataError, NoDownloadsError, MalformedTagsError
 from .logger import simple_logger
 
+# compsyn analyses images at this size, and colorgrams are rendered at it
+COMPRESS_DIMS = (300, 300)
+
 
 def tags_to_hash(tags: List[str]) -> str:
     m = hashlib.sha256()
@@ -27,36 +34,161 @@ def array_to_list(array: numpy.ndarray) -> List[float]:
     return out
 
 
-def get_vectors(
-    downloads_path: Path,
+def decode_image(
+    image: Union[bytes, Path], dims: Tuple[int, int] = COMPRESS_DIMS, draft: bool = False
+) -> np.ndarray:
+    """
+        decode image bytes or an image file to an RGB array of size dims, the same way compsyn loads images from a folder.
+        By default images are fully decoded, as compsyn does. With draft, JPEGs are downscaled in the DCT domain while decoding (to the smallest 1/2, 1/4 or 1/8 scale still larger than dims), so full resolution pixels are never produced.
+    """
+    img = Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+    if draft and img.format == "JPEG":
+        img.draft("RGB", dims)
+    img = img.convert("RGB")
+    if img.size != tuple(dims):
+        img = img.resize(dims, Image.LANCZOS)
+    return np.array(img)[:, :, :3]
+
+
+def load_vector(word: str, rgb_arrays: List[np.ndarray]) -> Vector:
+    """
+        Equivalent of compsyn.vectors.Vector(word).load_from_folder, for images that have already been decoded
+    """
+    img_object = ImageData()
+    img_object.dims = rgb_arrays[0].shape[:2]
+    img_object.rgb_dict[word] = rgb_arrays
+    img_object.labels_list = [word]
+    img_object.store_jzazbz_from_rgb(word)
+
+    img_analysis = ImageAnalysis(img_object)
+    img_analysis.compute_color_distributions(word, ["jzazbz", "rgb"])
+    img_analysis.get_composite_image()
+
+    vector = Vector(word)
+    vector.jzazbz_vector = np.mean(img_analysis.jzazbz_dict[word], axis=0)
+    vector.jzazbz_composite_dists = img_analysis.jzazbz_dist_dict[word]
+    vector.jzazbz_dist = np.mean(vector.jzazbz_composite_dists, axis=0)
+    vector.jzazbz_dist_std = np.std(vector.jzazbz_composite_dists, axis=0)
+
+    vector.rgb_vector = np.mean(img_analysis.rgb_dict[word], axis=0)
+    vector.rgb_dist = np.mean(img_analysis.rgb_dist_dict[word], axis=0)
+    vector.rgb_dist_std = np.std(img_analysis.rgb_dist_dict[word], axis=0)
+    vector.rgb_ratio = np.mean(img_analysis.rgb_ratio_dict[word], axis=0)
+
+    vector.colorgram_vector = img_analysis.compressed_img_dict[word]
+    vector.colorgram = Image.fromarray(vector.colorgram_vector.astype(np.uint8))
+    if vector.colorgram.size != COMPRESS_DIMS:
+        # analysis may run below colorgram resolution, colorgrams are always rendered at the same size
+        vector.colorgram = vector.colorgram.resize(COMPRESS_DIMS, Image.BICUBIC)
+
+    return vector
+
+
+def vector_metadata(
+    vector: Vector, downloads: List[str]
+) -> Optional[Dict[str, Any]]:
+    log = simple_logger("vector_metadata")
+    tags = str(vector.word).split("|")
+    try:
+        metadata = {key: value for key, value in (tag.split("=") for tag in tags)}
+    except ValueError as e:
+        log.error(f"Couldn't load metadata from colorgram stem: {tags}")
+        return None
+    metadata.update(
+        {
+            "downloads": downloads,
+            "s3_key": tags_to_hash(tags),
+            "rgb_dist": array_to_list(vector.rgb_dist),
+            "jzazbz_dist": array_to_list(vector.jzazbz_dist),
+        }
+    )
+    try:
+        metadata.update(rgb_dist_std=array_to_list(vector.rgb_dist_std))
+    except AttributeError:
+        pass
+
+    try:
+        metadata.update(jzazbz_dist_std=array_to_list(vector.jzazbz_dist_std))
+    except AttributeError:
+        pass
+
+    return metadata
+
+
+def get_vectors_from_images(
+    images: Iterable[Tuple[str, str, Union[bytes, Path]]],
+    analysis_dims: Tuple[int, int] = COMPRESS_DIMS,
+    draft: bool = False,
+    group_metadata: Optional[Dict[str, Dict[str, Any]]] = None,
 ) -> Generator[Tuple[Vector, Dict[str, Any]], None, None]:
-    log = simple_logger("get_vectors")
+    """
+        Compute vectors from a stream of (group key, image id, image bytes or path) tuples.
+        The group key plays the role of a downloads folder name (the colorgram stem), image ids become the "downloads" of the colorgram document.
+        Images must arrive grouped by key, each group is analysed as soon as the next one begins, so only one group of decoded images is held in memory.
+        A group none of whose images decode produces no vector.
+        Colour distributions are computed at analysis_dims, see decode_image for draft.
+        group_metadata, keyed by group key, is added to the metadata of each group's vector.
+    """
+    log = simple_logger("get_vectors_from_images")
+
+    finished = set()
+    group_key = None
+    rgb_arrays = list()
+    downloads = list()
+
+    def finish_group() -> Generator[Tuple[Vector, Dict[str, Any]], None, None]:
+        finished.add(group_key)
+        if len(rgb_arrays) == 0:
+            log.error(f"no decodable images for {group_key}, skipping it")
+            return
+        vector = load_vector(group_key, rgb_arrays)
+        metadata = vector_metadata(vector, downloads)
+        if metadata is not None:
+            if group_metadata is not None:
+                metadata.update(group_metadata.get(group_key, dict()))
+            yield vector, metadata
+
+    for key, image_id, image in images:
+        if key != group_key:
+            if group_key is not None:
+                yield from finish_group()
+            if key in finished:
+                raise AmbiguousDataError(
+                    f"images for {key} were not contiguous in the stream, group images by key before computing vectors"
+                )
+            group_key = key
+            rgb_arrays = list()
+            downloads = list()
+        try:
+            rgb_arrays.append(decode_image(image, dims=analysis_dims, draft=draft))
+        except (UnidentifiedImageError, OSError) as exc:
+            log.error(f"could not decode image {image_id} for {key}: {exc}")
+            continue
+        downloads.append(image_id)
+
+    if group_key is not None:
+        yield from finish_group()
+
+
+def iterate_downloads(
+    downloads_path: Path,
+) -> Generator[Tuple[str, str, Path], None, None]:
     for folder in downloads_path.iterdir():
         if len(list(folder.iterdir())) == 0:
             raise NoDownloadsError(f"No downloaded images available at {folder}")
-        vector = Vector(folder.name).load_from_folder(folder.parent)
-        tags = str(folder.name).split("|")
-        try:
-            metadata = {key: value for key, value in (tag.split("=") for tag in tags)}
-        except ValueError as e:
-            log.error(f"Couldn't load metadata from colorgram stem: {tags}")
-            continue
-        metadata.update(
-            {
-                "downloads": [img.stem for img in folder.iterdir()],
-                "s3_key": tags_to_hash(tags),
-                "rgb_dist": array_to_list(vector.rgb_dist),
-                "jzazbz_dist": array_to_list(vector.jzazbz_dist),
-            }
-        )
-        try:
-            metadata.update(rgb_dist_std=array_to_list(vector.rgb_dist_std))
-        except AttributeError:
-            pass
+        for img in folder.iterdir():
+            yield folder.name, img.stem, img
 
-        try:
-            metadata.update(jzazbz_dist_std=array_to_list(vector.jzazbz_dist_std))
-        except AttributeError:
-            pass
 
-        yield vector, metadata
+def get_vectors(
+    downloads_path: Path,
+    analysis_dims: Tuple[int, int] = COMPRESS_DIMS,
+    draft: bool = False,
+    group_metadata: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Generator[Tuple[Vector, Dict[str, Any]], None, None]:
+    yield from get_vectors_from_images(
+        iterate_downloads(downloads_path),
+        analysis_dims=analysis_dims,
+        draft=draft,
+        group_metadata=group_metadata,
+    )
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from imgserve.similarity import ColorgramIndex
+
+
+def colorgram_doc(query: str, dist: List[float]) -> Dict[str, Any]:
+    return {
+        "query": query,
+        "experiment_name": "test",
+        "s3_key": query,
+        "downloads": ["a", "b"],
+        "jzazbz_dist": dist,
+        "rgb_dist": dist,
+    }
+
+
+def test_colorgram_index_similar() -> None:
+    index = ColorgramIndex(
+        [
+            colorgram_doc("red", [0.9, 0.1, 0.0, 0.0]),
+            colorgram_doc("crimson", [0.8, 0.2, 0.0, 0.0]),
+            colorgram_doc("blue", [0.0, 0.0, 0.1, 0.9]),
+            colorgram_doc("purple", [0.4, 0.0, None, 0.6]),
+        ]
+    )
+    assert len(index) == 4
+
+    similar = index.similar("red", k=3)
+    assert [doc["query"] for distance, doc in similar] == ["crimson", "purple", "blue"]
+    distances = [distance for distance, doc in similar]
+    assert distances == sorted(distances)
+    # divergences are base 2, so bounded by 1
+    assert 0 < distances[0] and distances[-1] <= 1
+    # distributions and downloads are not carried in results
+    assert "jzazbz_dist" not in similar[0][1] and "downloads" not in similar[0][1]
+
+    assert len(index.similar("red", k=10)) == 3
+
+    with pytest.raises(FileNotFoundError):
+        index.similar("green")
+
+
+def test_colorgram_index_averages_repeated_queries() -> None:
+    index = ColorgramIndex(
+        [
+            colorgram_doc("sky", [0.0, 0.0, 0.0, 1.0]),
+            colorgram_doc("sky", [0.0, 0.0, 1.0, 0.0]),
+            colorgram_doc("sea", [0.0, 0.0, 0.5, 0.5]),
+            colorgram_doc("fire", [1.0, 0.0, 0.0, 0.0]),
+        ],
+        dist_field="rgb_dist",
+    )
+    np.testing.assert_allclose(index.distribution("sky"), [0.0, 0.0, 0.5, 0.5])
+    distance, doc = index.similar("sky", k=1)[0]
+    assert doc["query"] == "sea"
+    assert distance == pytest.approx(0.0)
+
+
+def test_colorgram_index_similar_one_colorgram_per_word() -> None:
+    index = ColorgramIndex(
+        [
+            colorgram_doc("red", [1.0, 0.0, 0.0, 0.0]),
+            colorgram_doc("crimson", [0.9, 0.1, 0.0, 0.0]),
+            colorgram_doc("crimson", [0.8, 0.2, 0.0, 0.0]),
+            colorgram_doc("crimson", [0.0, 0.0, 0.2, 0.8]),
+            colorgram_doc("orange", [0.6, 0.4, 0.0, 0.0]),
+            colorgram_doc("blue", [0.0, 0.0, 0.0, 1.0]),
+        ]
+    )
+    similar = index.similar("red", k=2)
+    # crimson's three colorgrams take one place, ranked by its closest
+    assert [doc["query"] for distance, doc in similar] == ["crimson", "orange"]
+    assert similar[0][0] == index.nearest(index.distribution("red"), k=1, exclude="red")[0][0]
+
+    assert [doc["query"] for distance, doc in index.similar("red", k=10)] == ["crimson", "orange", "blue"]
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from imgserve.export import export_colorgrams, load_colorgrams
+
+
+def test_export_roundtrip(tmp_path: Path) -> None:
+    documents = [
+        {
+            "query": f"word-{ind}",
+            "s3_key": str(ind),
+            "experiment_name": "test",
+            "downloads": ["a", "b"],
+            "rgb_dist": [0.5, 0.5, None, 0.0],
+            "jzazbz_dist": [0.25, 0.25, 0.25, 0.25],
+        }
+        for ind in range(5)
+    ]
+    # a late field, and a document without a distribution, must stay aligned
+    documents[3]["sample_size"] = 3
+    del documents[4]["rgb_dist"]
+
+    export_path = tmp_path.joinpath("colorgrams.npz")
+    # underestimating the row count grows the arrays as documents arrive
+    assert export_colorgrams(iter(documents), export_path, expected_rows=2) == 5
+
+    metadata, arrays = load_colorgrams(export_path)
+    assert list(metadata["query"]) == [f"word-{ind}" for ind in range(5)]
+    # a numeric field missing from some documents is still numeric, NaN where it is missing
+    assert metadata["sample_size"].dtype == np.float64
+    assert np.isnan(metadata["sample_size"][[0, 1, 2, 4]]).all()
+    assert metadata["sample_size"][3] == 3
+    assert "downloads" not in metadata
+    assert arrays["rgb_dist"].shape == (5, 4)
+    assert arrays["rgb_dist"].dtype == np.float32
+    assert np.isnan(arrays["rgb_dist"][0, 2])
+    assert np.isnan(arrays["rgb_dist"][4]).all()
+    np.testing.assert_allclose(arrays["jzazbz_dist"], 0.25)
+
+
+def test_export_rejects_unknown_suffix(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        export_colorgrams(iter([{"query": "word"}]), tmp_path.joinpath("colorgrams.csv"))
+    assert not tmp_path.joinpath("colorgrams.csv").exists()
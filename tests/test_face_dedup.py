@@ -0,0 +1,37 @@
+from __future__ import annotations
+import io
+from pathlib import Path
+
+from PIL import Image
+
+from imgserve.dedup import FaceHashIndex, face_hash
+
+
+EXTRACTED = Path(__file__).parent.joinpath("faces/extracted")
+
+
+def reencode(image: bytes, scale: float, quality: int) -> bytes:
+    img = Image.open(io.BytesIO(image))
+    img = img.resize((int(img.width * scale), int(img.height * scale)))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+def test_face_hash_index() -> None:
+    faces = sorted(EXTRACTED.glob("*.jpg"))
+    index = FaceHashIndex.from_documents(
+        {"face_id": face.stem, "face_hash": face_hash(face.read_bytes())} for face in faces
+    )
+    assert len(index) == len(faces)
+
+    for face in faces:
+        # the same face, rescaled and recompressed, links back to the original
+        match = index.lookup(face_hash(reencode(face.read_bytes(), scale=0.5, quality=60)))
+        assert match is not None and match[0] == face.stem
+
+    empty = FaceHashIndex(radius=0)
+    assert empty.lookup(face_hash(faces[0].read_bytes())) is None
+    for i in range(100):
+        empty.add(f"{i:016x}", str(i))
+    assert len(empty) == 100 and empty.lookup(f"{42:016x}") == ("42", 0)
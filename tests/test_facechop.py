@@ -2,11 +2,26 @@ from __future__ import annotations
 
 from pathlib import Path
 
+import pickle
+
+import cv2
+import numpy as np
 import pytest
 
-from imgserve.faces import facechop
+from imgserve.faces import (
+    CascadeDetector,
+    DetectionCache,
+    FaceDetectionPool,
+    FaceDetector,
+    extract_faces,
+    extract_faces_many,
+    facechop,
+    get_face_detector,
+)
 
-def test_facechop() -> None:
+
+def facechop_failures(output_dir: Path = Path(__file__).parent.joinpath("faces/extracted"), **facechop_kwargs: Any) -> List[str]:
+    """ run facechop over the test images, named after the number of faces they contain, and return the mismatches """
     successes = list()
     failures = list()
     for test_img in Path(__file__).parent.joinpath("faces").iterdir():
@@ -16,7 +31,8 @@ def test_facechop() -> None:
         face_count = 0
         for face_img in facechop(
             image=Path(__file__).parent.joinpath("faces").joinpath(test_img), 
-            output_dir=Path(__file__).parent.joinpath("faces/extracted")
+            output_dir=output_dir,
+            **facechop_kwargs,
         ):
             face_count += 1
         try: 
@@ -31,4 +47,88 @@ def test_facechop() -> None:
 
     print("successes:", len(successes))
     print("failures:", len(failures))
+    return failures
+
+
+def test_facechop() -> None:
+    failures = facechop_failures()
     assert len(failures) == 0, "\n".join(failures)
+
+
+def test_facechop_fast(tmp_path: Path) -> None:
+    # the default detection height downscales most test images, which costs the smallest faces of the crowd in 5to10-faces.jpg
+    # (see FAST_DETECTION_HEIGHT), every other image stays within its expected face count
+    failures = facechop_failures(output_dir=tmp_path, fast=True)
+    unexpected = [failure for failure in failures if not failure.startswith("5to10-faces.jpg")]
+    assert len(unexpected) == 0, "\n".join(unexpected)
+
+
+def test_extract_faces_in_memory() -> None:
+    image = Path(__file__).parent.joinpath("faces/2-faces.jpg")
+    from_bytes = extract_faces(image.read_bytes())
+    from_array = extract_faces(cv2.imread(str(image)))
+    assert len(from_bytes) == 2
+    assert [face.box for face in from_bytes] == [face.box for face in from_array]
+    for face in from_bytes:
+        crop = cv2.imdecode(np.frombuffer(face.image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        assert crop is not None and crop.shape[0] == 500
+
+
+def test_detection_cache(tmp_path: Path) -> None:
+    image = Path(__file__).parent.joinpath("faces/2-faces.jpg").read_bytes()
+    cache = DetectionCache(tmp_path.joinpath("detections.sqlite"))
+
+    detected = extract_faces(image, detection_cache=cache)
+    cached = extract_faces(image, detection_cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert [face.box for face in cached] == [face.box for face in detected]
+    assert [face.image for face in cached] == [face.image for face in detected]
+
+    # a different parameter is a different cache entry, another process sees the same entries
+    extract_faces(image, detection_cache=cache, cv2_cascade_min_neighbors=3)
+    assert cache.misses == 2
+    reopened = DetectionCache(tmp_path.joinpath("detections.sqlite"))
+    extract_faces(image, detection_cache=reopened, cv2_cascade_min_neighbors=3)
+    assert (reopened.hits, reopened.misses) == (1, 0)
+
+
+def test_face_detection_pool() -> None:
+    images = [Path(__file__).parent.joinpath(f"faces/{name}.jpg") for name in ["1-face", "2-faces", "3-faces"]]
+    expected = [[face.box for face in extract_faces(image)] for image in images]
+    with FaceDetectionPool(CascadeDetector(), workers=2) as pool:
+        first = [[face.box for face in faces] for _, faces in extract_faces_many(images, pool=pool)]
+        workers = set(pool.executor._processes)
+        second = [[face.box for face in faces] for _, faces in extract_faces_many(images[::-1], pool=pool)]
+        # later batches reuse the worker processes, and the detector each of them already loaded
+        assert set(pool.executor._processes) == workers
+    assert first == second[::-1] == expected
+    # time spent in the workers is added up for the caller
+    assert pool.images == 6 and pool.detection_seconds > 0
+    with pytest.raises(ValueError):
+        list(extract_faces_many(images, detector=CascadeDetector(), pool=pool))
+
+
+def test_face_detector_backends(tmp_path: Path) -> None:
+    image = Path(__file__).parent.joinpath("faces/2-faces.jpg").read_bytes()
+    detector = get_face_detector("haar", cv2_cascade_min_neighbors=5)
+    assert isinstance(detector, CascadeDetector)
+    assert [face.box for face in extract_faces(image, detector=detector)] == [face.box for face in extract_faces(image)]
+
+    # detectors are sent to worker processes without their loaded model, which each worker loads on first use
+    assert detector._model is not None
+    unpickled = pickle.loads(pickle.dumps(detector))
+    assert unpickled._model is None and unpickled.params_key == detector.params_key
+    assert len(extract_faces(image, detector=unpickled)) == 2
+
+    with pytest.raises(FileNotFoundError):
+        get_face_detector("lbp", model=tmp_path.joinpath("missing.xml"))
+    with pytest.raises(ValueError):
+        get_face_detector("yolo")
+
+    class Incomplete(FaceDetector):
+        def load(self) -> Any:
+            return None
+
+    # a backend missing params or boxes fails when it is made, not partway through a run
+    with pytest.raises(TypeError):
+        Incomplete(model_files=[])
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import io
+from pathlib import Path
+
+import pytest
+
+from imgserve.api import find_colorgrams, search_colorgrams
+
+
+class FakeElasticsearch:
+    def __init__(self, hits: List[Dict[str, Any]]) -> None:
+        self.hits = hits
+        self.searches = list()
+
+    def search(self, index: str, body: Dict[str, Any], size: int) -> Dict[str, Any]:
+        self.searches.append(body)
+        start = 0
+        if "search_after" in body:
+            start = [hit.get("sort") for hit in self.hits].index(body["search_after"]) + 1
+        return {"hits": {"hits": self.hits[start : start + size]}}
+
+
+class FakeS3:
+    def __init__(self) -> None:
+        self.gets = list()
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        self.gets.append(Key)
+        return {"Body": io.BytesIO(Key.encode("utf-8"))}
+
+
+def test_find_colorgrams(tmp_path: Path) -> None:
+    hits = [
+        {"_source": {"experiment_name": experiment_name, "s3_key": f"{experiment_name}-key", "query": "sky"}}
+        for experiment_name in ["concreteness", "top-100-wikipedia", "wind"]
+    ]
+    elasticsearch_client = FakeElasticsearch(hits)
+    s3_client = FakeS3()
+    tmp_path.joinpath("wind").mkdir()
+    tmp_path.joinpath("wind/wind-key").write_bytes(b"already synced")
+
+    found = list(
+        find_colorgrams(
+            elasticsearch_client=elasticsearch_client,
+            s3_client=s3_client,
+            bucket_name="compsyn",
+            local_data_store=tmp_path,
+            word="sky",
+            experiment_names=["concreteness", "top-100-wikipedia", "wind"],
+        )
+    )
+    # one search for every experiment, each colorgram synced once, results in search order
+    assert len(elasticsearch_client.searches) == 1
+    assert sorted(s3_client.gets) == ["concreteness/concreteness-key", "top-100-wikipedia/top-100-wikipedia-key"]
+    assert [doc for doc, path in found] == hits
+    assert [path.read_bytes() for doc, path in found] == [
+        b"concreteness/concreteness-key",
+        b"top-100-wikipedia/top-100-wikipedia-key",
+        b"already synced",
+    ]
+
+    with pytest.raises(FileNotFoundError):
+        list(
+            find_colorgrams(
+                elasticsearch_client=FakeElasticsearch(list()),
+                s3_client=s3_client,
+                bucket_name="compsyn",
+                local_data_store=tmp_path,
+                word="nothing",
+            )
+        )
+
+
+def test_search_colorgrams_pages() -> None:
+    hits = [
+        {"_source": {"experiment_name": experiment_name, "s3_key": s3_key, "query": "sky"}, "sort": [experiment_name, s3_key]}
+        for experiment_name in ["concreteness", "wind"]
+        for s3_key in ["a", "b", "c"]
+    ]
+    elasticsearch_client = FakeElasticsearch(hits)
+    docs = search_colorgrams(elasticsearch_client=elasticsearch_client, word="sky", size=4)
+    # nothing is dropped past the first page
+    assert docs == hits
+    assert [search.get("search_after") for search in elasticsearch_client.searches] == [None, ["wind", "a"]]
+
+    # a full last page takes one more, empty, search to find the end
+    elasticsearch_client = FakeElasticsearch(hits)
+    assert search_colorgrams(elasticsearch_client=elasticsearch_client, word="sky", size=3) == hits
+    assert len(elasticsearch_client.searches) == 3
@@ -0,0 +1,36 @@
+from __future__ import annotations
+import random
+from pathlib import Path
+
+import pytest
+
+from imgserve.utils import atomic_write_bytes, reservoir_sample
+
+
+def test_reservoir_sample_is_order_independent() -> None:
+    items = [f"image-{i}" for i in range(1000)]
+    sample, total = reservoir_sample(items, k=50, seed="query=red")
+    assert total == 1000
+    assert len(sample) == len(set(sample)) == 50
+
+    shuffled = list(items)
+    random.Random(0).shuffle(shuffled)
+    resampled, _ = reservoir_sample(iter(shuffled), k=50, seed="query=red")
+    assert set(resampled) == set(sample)
+
+    other, _ = reservoir_sample(items, k=50, seed="query=blue")
+    assert set(other) != set(sample)
+
+    assert reservoir_sample(items[:10], k=50, seed="query=red") == (items[:10], 10)
+
+    with pytest.raises(ValueError):
+        reservoir_sample(items, k=0, seed="query=red")
+
+
+def test_atomic_write_bytes(tmp_path: Path) -> None:
+    path = tmp_path.joinpath("colorgrams/concreteness/key")
+    atomic_write_bytes(path, b"first")
+    atomic_write_bytes(path, b"second")
+    assert path.read_bytes() == b"second"
+    # nothing is left behind next to it
+    assert list(path.parent.iterdir()) == [path]